@@ -0,0 +1,265 @@
+"""
+Pillow plugin for PSP files, so that Image.open('some_file.pspimage') works. It's registered when psp_scan
+is imported if Pillow already has been, or when psp_scan first uses Pillow - or call psp_scan.register_plugin().
+
+Image.open() only reads the file header and the General Image Attributes block, for the size. The pixels
+aren't found until load() (which thumbnail() etc call). For uncompressed files, the R/G/B channels of either
+the composite image that PSP saves in the Composite Image Bank, or a single full-size layer, are handed to
+Pillow as "raw" tiles - one per channel - so Pillow's C decoder unpacks them straight from the file. Anything
+else (several layers and no composite, transparency, etc) is decoded the long way, with PSPImage.
+
+thumbnail() (through draft()) can skip all that: PSP saves a JPEG thumbnail in the Composite Image Bank, and if
+that's still big enough, it's decoded instead, by Pillow's JPEG plugin.
+"""
+
+import io
+
+from image import *
+
+from PIL import Image, ImageFile
+
+channel_rawmodes = {1: 'R', 2: 'G', 3: 'B'}  # PSPChannelType -> Pillow band unpacker
+
+
+def _accept(prefix):
+    return accept(prefix)
+
+
+def read_channel_tiles(fp, channel_count, size):
+    """ Reads the channel headers (but not the channels) following the current position, and returns a raw
+        tile for each R/G/B channel - or None, if they aren't plain full-size uncompressed color channels.
+    """
+
+    tiles = []
+    for x in range(channel_count):
+        header = read_header(fp, generic_header)
+        block_start = fp.tell()
+        channel_info = read_chunk(fp, channel_info_chunk)
+        data_start = block_start + channel_info['chunk_size']
+
+        if channel_info['bitmap_type'] != dibs.PSP_DIB_IMAGE and channel_info['bitmap_type'] != dibs.PSP_DIB_COMPOSITE:
+            return None
+        rawmode = channel_rawmodes.get(channel_info['channel_type'])
+        if not rawmode or channel_info['comp_channel_len'] != size[0] * size[1]:
+            return None
+
+        tiles.append(('raw', (0, 0) + size, data_start, (rawmode, 0, 1)))
+        fp.seek(block_start + header['block_length'])
+
+    return tiles if len(tiles) == 3 else None
+
+
+def composite_bank_tiles(fp, block_end, size):
+    """ The Composite Image Bank has an attributes block for each image, then the images, in the same order. """
+
+    bank_start = fp.tell()
+    bank_info = read_chunk(fp, composite_image_bank_info_chunk)
+    fp.seek(bank_start + bank_info['chunk_size'])
+
+    attributes = []
+    while fp.tell() < block_end:
+        header = read_header(fp, generic_header)
+        block_start = fp.tell()
+        if header['block_id'] == blks.PSP_COMPOSITE_ATTRIBUTES:
+            attributes.append(read_chunk(fp, composite_image_attributes_chunk))
+        elif header['block_id'] in [blks.PSP_COMPOSITE_IMAGE_BLOCK, blks.PSP_JPEG_BLOCK]:
+            attrs = attributes.pop(0) if attributes else None
+            if header['block_id'] == blks.PSP_COMPOSITE_IMAGE_BLOCK and attrs and \
+                    attrs['composite_image_type'] == composite_types.keCITComposite and \
+                    attrs['compression_type'] == comps.PSP_COMP_NONE and \
+                    (attrs['width'], attrs['height']) == size:
+                image_info = read_chunk(fp, composite_image_info_chunk)
+                fp.seek(block_start + image_info['chunk_size'])
+                return read_channel_tiles(fp, image_info['channel_count'], size)
+        fp.seek(block_start + header['block_length'])
+
+    return None
+
+
+def composite_bank_thumbnail(fp, block_end):
+    """ Returns ((width, height), offset, length) of the JPEG thumbnail in the Composite Image Bank - or None. """
+
+    bank_start = fp.tell()
+    bank_info = read_chunk(fp, composite_image_bank_info_chunk)
+    fp.seek(bank_start + bank_info['chunk_size'])
+
+    attributes = []
+    while fp.tell() < block_end:
+        header = read_header(fp, generic_header)
+        block_start = fp.tell()
+        if header['block_id'] == blks.PSP_COMPOSITE_ATTRIBUTES:
+            attributes.append(read_chunk(fp, composite_image_attributes_chunk))
+        elif header['block_id'] in [blks.PSP_COMPOSITE_IMAGE_BLOCK, blks.PSP_JPEG_BLOCK]:
+            attrs = attributes.pop(0) if attributes else None
+            if header['block_id'] == blks.PSP_JPEG_BLOCK and attrs and \
+                    attrs['composite_image_type'] == composite_types.keCITThumbnail:
+                jpeg_info = read_chunk(fp, jpeg_info_chunk)
+                return (attrs['width'], attrs['height']), block_start + jpeg_info['chunk_size'], \
+                    jpeg_info['compressed_length']
+        fp.seek(block_start + header['block_length'])
+
+    return None
+
+
+def single_layer_tiles(fp, size):
+    """ A file with just one layer has no composite image - but if that layer is a plain visible Raster layer
+        covering the whole image, with no transparency, its channels *are* the image.
+    """
+
+    block_header = read_header(fp, generic_header)
+    if block_header['block_id'] != blks.PSP_LAYER_BLOCK:
+        return None
+
+    info_start = fp.tell()
+    chunk_start = read_chunk(fp, layer_info_chunk_start)
+    read_name(fp, chunk_start['name_length'])
+    info = read_chunk(fp, layer_info_chunk_rest)
+
+    full_rect = (0, 0) + size
+    img_rect = (info['img_rect_tl_x'], info['img_rect_tl_y'], info['img_rect_br_x'], info['img_rect_br_y'])
+    saved_rect = (info['saved_img_rect_tl_x'], info['saved_img_rect_tl_y'], info['saved_img_rect_br_x'], info['saved_img_rect_br_y'])
+    if info['layer_type'] != layer_types.keGLTRaster or img_rect != full_rect or saved_rect != full_rect or \
+            not info['layer_flags'] & layer_props.keVisibleFlag or info['layer_opacity'] != 255:
+        return None
+
+    fp.seek(info_start + chunk_start['chunk_size'])
+    bitmap_start = fp.tell()
+    bitmap_info = read_chunk(fp, layer_bitmap_chunk)
+    if bitmap_info['channel_count'] != 3:  # a 4th channel is the transparency mask
+        return None
+    fp.seek(bitmap_start + bitmap_info['chunk_size'])
+
+    return read_channel_tiles(fp, bitmap_info['channel_count'], size)
+
+
+class PspImageFile(ImageFile.ImageFile):
+
+    format = 'PSP'
+    format_description = 'Paint Shop Pro image'
+
+    def _open(self):
+
+        if not accept(self.fp.read(len(valid_file_marker))):
+            raise SyntaxError('Not a PSP file')
+
+        self.fp.seek(0)
+        file_header = read_chunk(self.fp, PSP_file_header)
+        if file_header['major_version'] not in supported_versions:
+            raise SyntaxError("PSP version [{0}] not supported".format(file_header['major_version']))
+
+        # The General Image Attributes block always comes first
+        header = read_header(self.fp, generic_header)
+        if header['block_id'] != blks.PSP_IMAGE_BLOCK:
+            raise SyntaxError('PSP file missing General Image Attributes')
+        self.blocks_start = self.fp.tell() + header['block_length']
+        self.gia_info = read_chunk(self.fp, general_image_attributes_chunk)
+
+        self.mode = 'RGB'
+        self.set_size((self.gia_info['image_width'], self.gia_info['image_height']))
+        self.info['compression'] = PSPCompression[self.gia_info['compression_type']] \
+            if self.gia_info['compression_type'] < len(PSPCompression) else 'unknown'
+        self.tile = []
+        self.tiles_found = False
+        self.thumbnail_jpeg = None  # (offset, length) of the JPEG thumbnail, if draft() picked it
+
+    def set_size(self, size):
+
+        # Pillow 5.3+ keeps the size in _size, behind a read-only property - before that, size is just an attribute
+        if isinstance(getattr(Image.Image, 'size', None), property):
+            self._size = size
+        else:
+            self.size = size
+
+    def top_level_blocks(self):
+        """ Yields (header, block_start, block_end) for each top-level block - the file pointer is at block_start,
+            and anything left there is skipped.
+        """
+
+        file_fp = self.fp
+        file_fp.seek(self.blocks_start)
+        while True:
+            peek = file_fp.read(len(valid_header_identifier))
+            if len(peek) < len(valid_header_identifier):
+                return
+            file_fp.seek(-len(peek), os.SEEK_CUR)
+
+            header = read_header(file_fp, generic_header)
+            block_start = file_fp.tell()
+            block_end = block_start + header['block_length']
+            yield header, block_start, block_end
+            file_fp.seek(block_end)
+
+    def find_tiles(self):
+        """ Walks the top-level block headers, seeking past their contents, looking for channels to use as tiles. """
+
+        if self.gia_info['compression_type'] != comps.PSP_COMP_NONE or self.gia_info['bit_depth'] != 24:
+            return None
+
+        for header, block_start, block_end in self.top_level_blocks():
+            if header['block_id'] == blks.PSP_COMPOSITE_IMAGE_BANK:
+                tiles = composite_bank_tiles(self.fp, block_end, self.size)
+                if tiles:
+                    return tiles
+            elif header['block_id'] == blks.PSP_LAYER_BANK_BLOCK:
+                if self.gia_info['layer_count'] == 1:
+                    return single_layer_tiles(self.fp, self.size)
+                return None
+
+        return None
+
+    def draft(self, mode, size):
+        """ Called by thumbnail() - if the JPEG thumbnail is smaller than the image (same shape), but still at least
+            size, load() uses that instead, and the image's size becomes the thumbnail's (as with a JPEG's draft()).
+            Only the size is taken into account - the image stays RGB.
+        """
+
+        if self.tiles_found or not size:
+            return
+
+        for header, block_start, block_end in self.top_level_blocks():
+            if header['block_id'] == blks.PSP_COMPOSITE_IMAGE_BANK:
+                thumbnail = composite_bank_thumbnail(self.fp, block_end)
+                break
+        else:
+            return
+        if not thumbnail:
+            return
+
+        (width, height), offset, length = thumbnail
+        pic_width, pic_height = self.size
+        if width >= pic_width or height >= pic_height or width < size[0] or height < size[1]:
+            return
+        if abs(width * pic_height - height * pic_width) > max(pic_width, pic_height):  # more than a pixel off
+            return
+
+        self.thumbnail_jpeg = (offset, length)
+        self.set_size((width, height))
+
+    def load(self):
+
+        if not self.tiles_found and self.thumbnail_jpeg:
+            self.tiles_found = True
+            offset, length = self.thumbnail_jpeg
+            self.fp.seek(offset)
+            jpeg = Image.open(io.BytesIO(self.fp.read(length)))
+            jpeg.draft('RGB', self.size)
+            img = jpeg.convert('RGB') if jpeg.mode != 'RGB' else jpeg
+            img.load()
+            if img.size != self.size:  # a corrupt thumbnail's header could say anything
+                img = img.resize(self.size)
+            self.im = img.im
+
+        if not self.tiles_found:
+            self.tiles_found = True
+            self.tile = self.find_tiles() or []
+            if not self.tile:
+                self.fp.seek(0)
+                with PSPImage(self.fp, {'RETAIN': 'composite'}) as p:
+                    img = p.as_PIL
+                self.im = img.im
+
+        return ImageFile.ImageFile.load(self)
+
+
+Image.register_open(PspImageFile.format, PspImageFile, _accept)
+Image.register_extensions(PspImageFile.format, ['.pspimage', '.psp'])
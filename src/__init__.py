@@ -1 +1,51 @@
-from image import *
+"""
+psp_scan's public names - each one is imported from its module the first time it's used, so importing psp_scan
+is quick, and doesn't pull in Pillow (or anything else slow) until it's needed. Everything else is still in the
+modules themselves: psp_scan.layers.Layer, psp_scan.masks.SpanMask and so on.
+"""
+
+import importlib
+import sys
+import types
+
+# module => its public names
+public_names = {
+    'structs': ['blks', 'layer_types', 'blend_modes', 'layer_props', 'composite_types', 'comps', 'dibs'],
+    'utils': ['Rect'],
+    'files': ['register_plugin', 'png_options', 'png_presets', 'PixelView', 'artifact_kinds'],
+    'stages': ['register_stage', 'load_stage', 'load_stages', 'stage_factories'],
+    'image': ['PSPImage', 'retention_policies', 'default_options'],
+    'jobs': ['Job', 'Converter', 'open_psp', 'export', 'export_image', 'default_converter'],
+    'shared': ['SharedBatch', 'SharedBuffer', 'share_image'],
+    'archives': ['ArchiveWriter', 'archive_members', 'is_archive'],
+    'check': ['check_image', 'CONVERTIBLE', 'UNSUPPORTED', 'CORRUPT'],
+    'atlas': ['Sprite', 'MaxRects', 'pack_sprites', 'save_atlas'],
+}
+
+__all__ = sorted(name for names in public_names.values() for name in names)
+name_modules = dict((name, module) for module, names in public_names.items() for name in names)
+
+
+class LazyPackage(types.ModuleType):
+    """ Stands in for this package, in sys.modules - a public name is imported from its module on first use,
+        then kept. (Python 2 modules can't have a __getattr__ of their own.)
+    """
+
+    def __getattr__(self, name):
+
+        if name not in name_modules:
+            raise AttributeError("module [{0}] has no attribute [{1}]".format(self.__name__, name))
+        value = getattr(importlib.import_module(self.__name__ + '.' + name_modules[name]), name)
+        setattr(self, name, value)
+
+        return value
+
+
+package = LazyPackage(__name__)
+package.__dict__.update(sys.modules[__name__].__dict__)
+package.module = sys.modules[__name__]  # Python 2 empties a module's globals when it's freed - LazyPackage uses them
+sys.modules[__name__] = package
+
+# Pillow isn't imported until it's needed - but if it already has been, PSP files should open with it right away
+if 'PIL.Image' in sys.modules:
+    package.register_plugin()
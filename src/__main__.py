@@ -11,7 +11,7 @@ Currently supports:
  - Files saved in PSP X format (file-format version 8)
  - Layers of type Raster/Mask/Group (adjustment-layers, etc, are silently ignored)
  - Layers saved in Uncompressed format (RLE/LZ77 formats not yet supported, code will raise exception)
- - Layer Groups, max of two layers in group (raster + mask)
+ - Layer Groups, including nested groups (Mask layers mask everything below them in the group)
  - One Alpha-channel mask (only first one is saved in PNGs)
 
 # Requirements:
@@ -30,11 +30,7 @@ to name this file `__main__.py` (instead of `psp_scan.py`). Still working
 on the whole Python packaging thing...
 """
 
-# TODO - allow CLI to select mask-layers for input-directories, not just single files
-# TODO - allow CLI to save formats other than BMP/PNG
-# TODO - check visibility flag on layers
 # TODO - add decompression code for RLE/LZ77 compressed channels
-# TODO - handle more than two grouped layers - currently only layer + mask is parsed
 # TODO - mask_to_alpha() - add 'use_raster' flag, convert RGB layers to greyscale
 # TODO - refactor various layer/mask saving functions
 
@@ -0,0 +1,125 @@
+"""
+Reading .pspimage files out of zip/tar archives, and writing converted files into them, without unpacking
+anything to disk. Only one archive member is in memory at a time - each one is read, converted, and written out,
+before the next one is read.
+"""
+
+import io
+import ntpath
+
+from shared import *
+
+tarfile = LazyModule('tarfile')
+zipfile = LazyModule('zipfile')
+
+zip_extensions = ('.zip',)
+tar_extensions = {'.tar': 'w', '.tar.gz': 'w:gz', '.tgz': 'w:gz', '.tar.bz2': 'w:bz2', '.tbz2': 'w:bz2'}
+
+
+def is_archive(file_name):
+
+    if not isinstance(file_name, str):
+        return False
+    return file_name.lower().endswith(zip_extensions + tuple(tar_extensions.keys()))
+
+
+def archive_members(archive_file, non_recursive=False):
+    """ Yields (member name, file data) for each .pspimage file in a zip/tar archive, one at a time. With
+        non_recursive, only members at the top of the archive (not in a directory) are read.
+    """
+
+    def wanted(name):
+        return name and name.endswith('.pspimage') and not (non_recursive and '/' in name)
+
+    if archive_file.lower().endswith(zip_extensions):
+        with zipfile.ZipFile(archive_file) as zip_file:
+            for info in zip_file.infolist():
+                name = member_path(info.filename)
+                if wanted(name):
+                    yield name, zip_file.read(info)
+        return
+
+    tar_file = tarfile.open(archive_file, 'r:*')
+    try:
+        for info in tar_file:
+            name = member_path(info.name)
+            if info.isfile() and wanted(name):
+                yield name, tar_file.extractfile(info).read()
+    finally:
+        tar_file.close()
+
+
+def member_path(name):
+    """ An archive member's name, with / between directories - or None if it could land outside the output
+        directory (member names end up as output file names): absolute, a drive letter or UNC share, or with a
+        '..' in it. Archives made on Windows can use backslashes, so those are separators too, on any OS.
+    """
+
+    name = name.replace('\\', '/')
+    if name.startswith('/') or os.path.isabs(name) or ntpath.splitdrive(name)[0] or os.path.splitdrive(name)[0]:
+        return None
+    if '..' in name.split('/'):
+        return None
+
+    return name
+
+
+class ArchiveWriter(object):
+    """ Writes files into a new zip/tar archive. It's used like a directory, in out_path() - calling it with a
+        file name returns a file-like object to save into, which becomes an archive member at the next flush()
+        (or when the archive is closed). Flushing after each image keeps just that image's files in memory.
+    """
+    def __init__(self, archive_file):
+
+        self.archive_file = archive_file
+        self.pending = []
+        self.names = []
+
+        if archive_file.lower().endswith(zip_extensions):
+            self.zip_file = zipfile.ZipFile(archive_file, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+            self.tar_file = None
+        else:
+            mode = [v for k, v in tar_extensions.items() if archive_file.lower().endswith(k)][0]
+            self.zip_file = None
+            self.tar_file = tarfile.open(archive_file, mode)
+
+    def __call__(self, file_name):
+
+        member_fp = io.BytesIO()
+        self.pending.append((file_name.replace(os.sep, '/'), member_fp))
+
+        return member_fp
+
+    def flush(self):
+
+        for name, member_fp in self.pending:
+            data = member_fp.getvalue()
+            if self.zip_file:
+                # PNGs are already compressed, deflating them again just wastes time
+                compress_type = zipfile.ZIP_STORED if name.endswith('.png') else zipfile.ZIP_DEFLATED
+                info = zipfile.ZipInfo(name, time.localtime()[:6])
+                info.external_attr = 0o644 << 16
+                self.zip_file.writestr(info, data, compress_type)
+            else:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = time.time()
+                self.tar_file.addfile(info, io.BytesIO(data))
+            self.names.append(name)
+            member_fp.close()
+
+        self.pending = []
+
+    def close(self):
+
+        self.flush()
+        if self.zip_file:
+            self.zip_file.close()
+        else:
+            self.tar_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -0,0 +1,188 @@
+"""
+Sprite sheets - packing a batch of images into texture atlases, instead of writing (and having some other tool
+re-read) a PNG for every sprite. Each image is converted to RGBA (the Alpha channel as in save_as_PNG()), trimmed
+to its non-transparent pixels, and only the trimmed part is kept - the PSPImage itself is dropped right away.
+Then they're all packed with MaxRects (best short side fit), into as many atlases as it takes:
+
+    sprites = [Sprite.from_psp(name, PSPImage(name)) for name in file_names]
+    frame_map = save_atlas('out_dir', 'sprites', sprites)
+
+writes sprites-0.png, sprites-1.png, ... and sprites.json - the frame map, in the usual TexturePacker (hash) layout:
+where each sprite is in which atlas, and where its trimmed rectangle goes in the original image.
+"""
+
+from shared import *
+
+
+class Sprite(object):
+    """ One trimmed image - trim_rect is where the trimmed part was, in the original image (source_size).
+        img is converted to RGBA first, if it isn't already.
+    """
+
+    def __init__(self, name, img):
+
+        img = img if img.mode == 'RGBA' else img.convert('RGBA')
+        self.name = name
+        self.source_size = img.size
+        bbox = img.split()[-1].getbbox()  # the Alpha channel - Image.getchannel() needs Pillow 4.3
+        if not bbox:  # nothing visible - keep one transparent pixel, so it still has a frame
+            bbox = (0, 0, 1, 1)
+        self.trim_rect = Rect(*bbox)
+        self.image = img.crop(bbox)
+        self.image.load()
+
+    @classmethod
+    def from_psp(cls, name, p, mask_num=None, stages=None):
+        """ The sprite for a PSPImage - the image is run through any stages (see stages.py) before it's trimmed. """
+
+        layer_bank = p.get_block(blks.PSP_LAYER_BANK_BLOCK)
+        mask, img_rect = p.alpha_mask(mask_num)
+        img = apply_stages(RGBA_image(p.gia, layer_bank.bitmap, mask, img_rect), load_stages(stages))
+        sprite = cls(name, img)
+        img.close()
+
+        return sprite
+
+    @property
+    def trimmed(self):
+        return self.image.size != self.source_size
+
+    def __repr__(self):
+        return "<Sprite {0} {1}x{2}>".format(self.name, self.image.size[0], self.image.size[1])
+
+
+class MaxRects(object):
+    """ Bin-packer for one atlas: keeps a list of the largest free rectangles (they can overlap), and puts each new
+        rectangle where it leaves the least space on its shorter side.
+    """
+
+    def __init__(self, width, height):
+
+        self.width = width
+        self.height = height
+        self.free = [Rect(0, 0, width, height)]
+
+    def insert(self, width, height):
+        """ Returns where a width x height rectangle goes - or None, if it doesn't fit. """
+
+        best = None
+        best_fit = None
+        for free in self.free:
+            if free.width >= width and free.height >= height:
+                leftover_x = free.width - width
+                leftover_y = free.height - height
+                fit = (min(leftover_x, leftover_y), max(leftover_x, leftover_y))
+                if best is None or fit < best_fit:
+                    best, best_fit = free, fit
+
+        if best is None:
+            return None
+
+        placed = Rect(best.tl_x, best.tl_y, best.tl_x + width, best.tl_y + height)
+        self.split_free(placed)
+
+        return placed
+
+    def split_free(self, placed):
+        """ Replaces each free rectangle that overlaps the placed one with the (up to four) parts of it that
+            don't - then drops any free rectangle that's inside another.
+        """
+
+        new_free = []
+        for free in self.free:
+            if placed.tl_x >= free.br_x or placed.br_x <= free.tl_x or \
+               placed.tl_y >= free.br_y or placed.br_y <= free.tl_y:
+                new_free.append(free)
+                continue
+            if placed.tl_x > free.tl_x:
+                new_free.append(Rect(free.tl_x, free.tl_y, placed.tl_x, free.br_y))
+            if placed.br_x < free.br_x:
+                new_free.append(Rect(placed.br_x, free.tl_y, free.br_x, free.br_y))
+            if placed.tl_y > free.tl_y:
+                new_free.append(Rect(free.tl_x, free.tl_y, free.br_x, placed.tl_y))
+            if placed.br_y < free.br_y:
+                new_free.append(Rect(free.tl_x, placed.br_y, free.br_x, free.br_y))
+
+        def inside(inner, outer):
+            return inner.tl_x >= outer.tl_x and inner.tl_y >= outer.tl_y and \
+                inner.br_x <= outer.br_x and inner.br_y <= outer.br_y
+
+        self.free = [free for x, free in enumerate(new_free)
+                     if not any(inside(free, other) and (free != other or y < x)
+                                for y, other in enumerate(new_free) if y != x)]
+
+
+def pack_sprites(sprites, max_size=2048, padding=2, power_of_two=True):
+    """ Packs sprites into as few max_size x max_size atlases as it can, with padding pixels between sprites
+        (biggest sprites first). Returns a list of ((width, height), [(sprite, Rect), ...]) - one per atlas, each
+        only as big as it needs to be (rounded up to a power of two, by default, which GPUs like).
+    """
+
+    order = sorted(sprites, key=lambda s: (-max(s.image.size), -s.image.size[0] * s.image.size[1], s.name))
+    bins = []
+
+    for sprite in order:
+        width, height = sprite.image.size
+        if width > max_size or height > max_size:
+            raise ValueError("sprite [{0}] is {1}x{2}, bigger than the atlas size [{3}]".format(
+                sprite.name, width, height, max_size))
+
+        # The padding goes after each sprite - the bins have room for it after the last one, too
+        for packer, placed in bins:
+            spot = packer.insert(width + padding, height + padding)
+            if spot:
+                break
+        else:
+            packer, placed = MaxRects(max_size + padding, max_size + padding), []
+            bins.append((packer, placed))
+            spot = packer.insert(width + padding, height + padding)
+        placed.append((sprite, Rect(spot.tl_x, spot.tl_y, spot.tl_x + width, spot.tl_y + height)))
+
+    atlases = []
+    for packer, placed in bins:
+        width = max(rect.br_x for _, rect in placed)
+        height = max(rect.br_y for _, rect in placed)
+        if power_of_two:
+            width, height = next_power_of_two(width), next_power_of_two(height)
+        atlases.append(((width, height), placed))
+
+    return atlases
+
+
+def save_atlas(out_dir, name, sprites, max_size=2048, padding=2, power_of_two=True, png=None):
+    """ Packs the sprites (see pack_sprites()), and saves each atlas as name-0.png, name-1.png... with the frame
+        map as name.json, in out_dir (a directory, or a function - see out_path()). Returns the frame map.
+        The frame map is keyed by sprite name, so the names have to be different.
+    """
+
+    names = set()
+    for sprite in sprites:
+        if sprite.name in names:
+            raise ValueError("more than one sprite named [{0}] - frame map names have to be unique".format(sprite.name))
+        names.add(sprite.name)
+
+    frames = {}
+    images = []
+
+    for x, (size, placed) in enumerate(pack_sprites(sprites, max_size, padding, power_of_two)):
+        image_name = "{0}-{1}.png".format(name, x)
+        atlas = Image.new('RGBA', size, (0, 0, 0, 0))
+        for sprite, rect in placed:
+            atlas.paste(sprite.image, (rect.tl_x, rect.tl_y))
+            trim = sprite.trim_rect
+            frames[sprite.name] = {
+                'atlas': x,
+                'frame': {'x': rect.tl_x, 'y': rect.tl_y, 'w': rect.width, 'h': rect.height},
+                'rotated': False,
+                'trimmed': sprite.trimmed,
+                'spriteSourceSize': {'x': trim.tl_x, 'y': trim.tl_y, 'w': trim.width, 'h': trim.height},
+                'sourceSize': {'w': sprite.source_size[0], 'h': sprite.source_size[1]}}
+
+        write_PNG(atlas, out_path(out_dir, image_name), png)
+        atlas.close()
+        images.append({'image': image_name, 'size': {'w': size[0], 'h': size[1]}})
+
+    frame_map = {'frames': frames, 'meta': {'app': 'psp_scan', 'format': 'RGBA8888', 'images': images}}
+    write_json(out_path(out_dir, name + '.json'), frame_map)
+
+    return frame_map
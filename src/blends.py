@@ -0,0 +1,176 @@
+"""
+Layer blending modes. Each kernel takes a row (or any run) of lower-layer RGB triples, and the matching run
+of upper-layer triples, and returns the blended triples - before the omega-mask is applied, which is still
+done by apply_mask_to_layer(). Normal mode has no kernel, the upper layer is used as-is.
+
+Most modes work on each color channel separately, so those are computed once into a 256x256 lookup table,
+and then a whole run is just table lookups. The Hue/Saturation/Color/Luminosity modes need all three channels
+at once, so they go through colorsys instead.
+
+Formulas are the usual ones (https://en.wikipedia.org/wiki/Blend_modes) - like the alpha-compositing code,
+they won't exactly match PaintShop Pro's own rounding.
+"""
+
+import colorsys
+import random
+import threading
+
+from structs import blend_modes
+
+
+def _multiply(src, dst):
+    return src * dst // 255
+
+
+def _screen(src, dst):
+    return 255 - (255 - src) * (255 - dst) // 255
+
+
+def _overlay(src, dst):
+    if dst < 128:
+        return 2 * src * dst // 255
+    return 255 - 2 * (255 - src) * (255 - dst) // 255
+
+
+def _hard_light(src, dst):
+    return _overlay(dst, src)
+
+
+def _soft_light(src, dst):
+    # Pegtop's formula - no discontinuity at 50% grey, unlike the Photoshop one
+    return ((255 - 2 * src) * dst * dst // 255 + 2 * src * dst) // 255
+
+
+def _difference(src, dst):
+    return abs(src - dst)
+
+
+def _dodge(src, dst):
+    if src == 255:
+        return 255
+    return min(255, dst * 255 // (255 - src))
+
+
+def _burn(src, dst):
+    if src == 0:
+        return 0
+    return max(0, 255 - (255 - dst) * 255 // src)
+
+
+def _exclusion(src, dst):
+    return src + dst - 2 * src * dst // 255
+
+
+channel_funcs = {
+    blend_modes.LAYER_BLEND_DARKEN:     min,
+    blend_modes.LAYER_BLEND_LIGHTEN:    max,
+    blend_modes.LAYER_BLEND_MULTIPLY:   _multiply,
+    blend_modes.LAYER_BLEND_SCREEN:     _screen,
+    blend_modes.LAYER_BLEND_OVERLAY:    _overlay,
+    blend_modes.LAYER_BLEND_HARD_LIGHT: _hard_light,
+    blend_modes.LAYER_BLEND_SOFT_LIGHT: _soft_light,
+    blend_modes.LAYER_BLEND_DIFFERENCE: _difference,
+    blend_modes.LAYER_BLEND_DODGE:      _dodge,
+    blend_modes.LAYER_BLEND_BURN:       _burn,
+    blend_modes.LAYER_BLEND_EXCLUSION:  _exclusion,
+}
+
+# blend mode => its table, built the first time the mode is used (all of them up front would slow every import
+# by ~0.2s) - images blending in different threads share it, so it's only ever filled under _lookup_lock
+_lookup_tables = {}
+_lookup_lock = threading.Lock()
+
+
+def lookup_table(blend_mode):
+    """ A flat 256x256 table of func(src, dst), indexed by (src << 8) | dst - built once, by whichever thread
+        gets here first; the rest wait for it, rather than building their own.
+    """
+
+    with _lookup_lock:
+        if blend_mode not in _lookup_tables:
+            func = channel_funcs[blend_mode]
+            _lookup_tables[blend_mode] = [func(s, d) for s in range(256) for d in range(256)]
+        return _lookup_tables[blend_mode]
+
+
+def channel_kernel(blend_mode):
+    """ Returns a kernel that blends a whole run of pixels through the mode's lookup_table(). """
+
+    table = lookup_table(blend_mode)
+
+    def kernel(dest_row, source_row):
+        return [(table[(s[0] << 8) | d[0]], table[(s[1] << 8) | d[1]], table[(s[2] << 8) | d[2]])
+                for d, s in zip(dest_row, source_row)]
+
+    return kernel
+
+
+def _to_hls(pixel):
+    return colorsys.rgb_to_hls(pixel[0] / 255.0, pixel[1] / 255.0, pixel[2] / 255.0)
+
+
+def _from_hls(h, l, s):
+    r, g, b = colorsys.hls_to_rgb(h, l, s)
+    return int(r * 255 + 0.5), int(g * 255 + 0.5), int(b * 255 + 0.5)
+
+
+def _hue(src, dst):
+    return src[0], dst[1], dst[2]
+
+
+def _saturation(src, dst):
+    return dst[0], dst[1], src[2]
+
+
+def _color(src, dst):
+    return src[0], dst[1], src[2]
+
+
+def _luminosity(src, dst):
+    return dst[0], src[1], dst[2]
+
+
+# Both the Legacy and True versions use plain HLS - the True ones are a perceptual variant in PSP
+hls_funcs = {
+    blend_modes.LAYER_BLEND_LEGACY_HUE:         _hue,
+    blend_modes.LAYER_BLEND_LEGACY_SATURATION:  _saturation,
+    blend_modes.LAYER_BLEND_LEGACY_COLOR:       _color,
+    blend_modes.LAYER_BLEND_LEGACY_LUMINOSITY:  _luminosity,
+    blend_modes.LAYER_BLEND_TRUE_HUE:           _hue,
+    blend_modes.LAYER_BLEND_TRUE_SATURATION:    _saturation,
+    blend_modes.LAYER_BLEND_TRUE_COLOR:         _color,
+    blend_modes.LAYER_BLEND_TRUE_LIGHTNESS:     _luminosity,
+}
+
+
+def hls_kernel(blend_mode):
+
+    func = hls_funcs[blend_mode]
+
+    def kernel(dest_row, source_row):
+        return [_from_hls(*func(_to_hls(s), _to_hls(d))) for d, s in zip(dest_row, source_row)]
+
+    return kernel
+
+
+def get_blend_kernel(blend_mode):
+    """ Returns the kernel for a blending mode, or None if the upper layer is used as-is (Normal, and
+        Dissolve, which is handled by dissolve_mask() instead). Unknown modes are treated as Normal.
+    """
+
+    if blend_mode in channel_funcs:
+        return channel_kernel(blend_mode)
+    if blend_mode in hls_funcs:
+        return hls_kernel(blend_mode)
+
+    return None
+
+
+def dissolve_mask(bits, seed):
+    """ Dissolve mode doesn't blend colors at all - each partially transparent pixel is either fully
+        shown or fully hidden, at random, weighted by its alpha. Seeded, so the same file always
+        renders the same way.
+    """
+
+    rng = random.Random(seed)
+    return [alpha if alpha in (0, 255) else (255 if rng.randint(1, 255) <= alpha else 0) for alpha in bits]
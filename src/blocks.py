@@ -4,10 +4,20 @@ Contains all the blocks except for Layer, which is in a class by itself...
 
 from files import *
 
-supported_versions = [8]
-supported_layers = [layer_types.keGLTGroup, layer_types.keGLTMask, layer_types.keGLTRaster]
-supported_compression = [comps.PSP_COMP_NONE]
-gia_wanted_fields = ['image_width', 'image_height', 'total_image_size', 'layer_count', 'color_count', 'bit_depth']
+supported_versions = (8,)
+supported_layers = (layer_types.keGLTGroup, layer_types.keGLTMask, layer_types.keGLTRaster)
+supported_compression = (comps.PSP_COMP_NONE,)
+gia_wanted_fields = ('image_width', 'image_height', 'total_image_size', 'layer_count', 'color_count', 'bit_depth')
+
+# The blocks that get decoded (the rest are skipped), and the info-chunk each one starts with, if any.
+# (Which class decodes each block is in image.block_classes.)
+block_formats = {blks.PSP_IMAGE_BLOCK:            general_image_attributes_chunk,
+                 blks.PSP_LAYER_BANK_BLOCK:       None,
+                 blks.PSP_LAYER_BLOCK:            None,
+                 blks.PSP_GROUP_EXTENSION_BLOCK:  group_layer_info_chunk,
+                 blks.PSP_MASK_EXTENSION_BLOCK:   mask_layer_info_chunk,
+                 blks.PSP_ALPHA_BANK_BLOCK:       alpha_bank_info_chunk_header,
+                 }
 
 
 class Block(object):
@@ -26,7 +36,7 @@ class Block(object):
 
         # Note: block-length does not include length of header itself, just the following data-length,
         # thus making it easy to skip blocks.
-        if self.block_id not in self.gia['used_blocks']:
+        if self.block_id not in block_formats:
             skip_block(img_fp, self.block_length)
             return
 
@@ -35,18 +45,18 @@ class Block(object):
 
     def read_any_info_chunks(self, img_fp):
 
-        chunk_format = self.gia['used_blocks'][self.block_id]['format']
+        chunk_format = block_formats[self.block_id]
         self.info_chunk = read_chunk(img_fp, chunk_format, self.gia['DEBUG'])
 
     def read_any_sub_blocks(self, img_fp):
         pass
 
-    def save_block_to_file(self, tmp_dir):
+    def save_block_to_file(self, tmp_dir, kinds=artifact_kinds):
 
         for b in self.sub_blocks:
             func = getattr(b, 'save_block_to_file', None)
             if func:
-                func(tmp_dir)
+                func(tmp_dir, kinds)
 
     @property
     def header(self):
@@ -132,10 +142,20 @@ class Channel(object):
 
         self.decompress()
 
+        # Once decoded, the file's bytes are only needed for listing/viewing them (see the RETAIN option)
+        if gia['RETAIN'] != 'all':
+            self.content_chunk = None
+
     def decompress(self):
 
         self.uncompressed_data = [ord(x) for x in self.content_chunk]  # for format=uncompressed - other formats TBD
 
+    def release(self):
+        """ Drops the channel's data - once its layer has taken what it needs from it. """
+
+        self.content_chunk = None
+        self.uncompressed_data = None
+
     def __repr__(self):
 
         color = PSPChannelType[self.channel_type]
@@ -147,7 +167,7 @@ class Channel(object):
         block_str = "\n\tBlock[{0}:{1}]: {2:,} bytes, type = {3}, Bitmap type = {4}{5}"
         block_str = block_str.format(self.block_type, self.channel_number, self.channel_length, color, dib, comp_type)
 
-        if self.gia['DEBUG']:
+        if self.gia['DEBUG'] and self.content_chunk is not None:
             bar = string_to_hex(self.content_chunk)[:100]
             foo = self.uncompressed_data[:20]
             block_str += "\n\t\t{0}\n\t\t{1}".format(foo, bar)
@@ -156,6 +176,9 @@ class Channel(object):
 
     def save_block_to_file(self, tmp_dir, layer_name, width, height):
 
+        if self.uncompressed_data is None:
+            return
+
         short_channel_desc = {
             'PSP_CHANNEL_COMPOSITE': 'rect_mask',
             'PSP_CHANNEL_RED': 'red',
@@ -165,7 +188,7 @@ class Channel(object):
         # Note - mask isn't applied at the channel level, so the debug-output file for merged channels won't be transparent.
         channel_type = short_channel_desc[PSPChannelType[self.channel_type]]
         channel_name = "{0}--chan_{1}--{2}".format(layer_name, self.channel_number, channel_type)
-        out_file = os.path.join(tmp_dir, channel_name + '.bmp')
+        out_file = out_path(tmp_dir, channel_name + '.bmp')
         save_rect_mask_debug(out_file, self.uncompressed_data, Rect(0, 0, width, height))
 
 
@@ -231,10 +254,27 @@ class AlphaChannel(object):
 
         return block_str
 
-    def save_block_to_file(self, tmp_dir):
+    @property
+    def view(self):
+        """ The Alpha channel, [height, width] of saved_alpha_rect - a read-only PixelView of the file's own bytes
+            (uncompressed files only), or if those were dropped (see RETAIN), packed from the decoded channel.
+            None if the channel is empty.
+        """
+
+        if not self.channel:
+            return None
+        data = self.channel.content_chunk
+        if data is None:
+            data = pack_pixels(self.channel.uncompressed_data)
+        return PixelView(data, [self.saved_alpha_rect.height, self.saved_alpha_rect.width])
+
+    def save_block_to_file(self, tmp_dir, kinds=artifact_kinds):
+
+        if 'masks' not in kinds or not self.channel:
+            return
 
         channel_name = "Alpha--{0}".format(self.alpha_name)
-        out_file = os.path.join(tmp_dir, channel_name + '.bmp')
+        out_file = out_path(tmp_dir, channel_name + '.bmp')
         save_layer_mask_debug(self.gia, out_file, self.channel.uncompressed_data, self.saved_alpha_rect)
 
 
@@ -0,0 +1,144 @@
+"""
+Compositing buffers. A Canvas is an RGB bitmap plus its own alpha (coverage) list, over some rectangle of
+the image. The LayerBank composites every layer into one image-sized Canvas, and each Group layer composites
+its children into its own Canvas (only as big as the children), which is kept around and then blended into
+its parent like any other layer.
+
+All the blend/mask functions take an optional clip rectangle (image coordinates), so just part of a Canvas
+can be re-composited.
+"""
+
+from masks import *
+
+
+def clipped_runs(spans, clip):
+    """ Walks the runs of a SpanMask, cut down to a clip rectangle. Yields (y, kind, start, end, alphas),
+        with y/start/end relative to the SpanMask's own rectangle.
+    """
+
+    rect = spans.rect
+    area = find_intersection_rect(rect, clip) if clip else rect
+    if area.width <= 0 or area.height <= 0:
+        return
+
+    x_lo = area.tl_x - rect.tl_x
+    x_hi = area.br_x - rect.tl_x
+    for y in range(area.tl_y - rect.tl_y, area.br_y - rect.tl_y):
+        for kind, start, end, alphas in spans.rows[y]:
+            if end <= x_lo or start >= x_hi:
+                continue
+            new_start = max(start, x_lo)
+            new_end = min(end, x_hi)
+            if alphas is not None:
+                alphas = alphas[new_start - start:new_end - start]
+            yield y, kind, new_start, new_end, alphas
+
+
+def composite_pixel(dest, dest_alpha, source, alpha):
+    """ Alpha-compositing "over" operator, for a lower pixel that might itself be partially transparent.
+        When the lower pixel is opaque, this is just apply_mask_to_layer().
+    :return: (RGB triple, alpha)
+    """
+
+    if alpha == 0:
+        return dest, dest_alpha
+
+    if alpha == 255 or dest_alpha == 0:
+        return source, alpha
+
+    if dest_alpha == 255:
+        return apply_mask_to_layer(dest, source, alpha), 255
+
+    alpha_pct = alpha / 255.0
+    dest_pct = dest_alpha / 255.0 * (1 - alpha_pct)
+    out_pct = alpha_pct + dest_pct
+    new_rgb = (int((source[0] * alpha_pct + dest[0] * dest_pct) / out_pct),
+               int((source[1] * alpha_pct + dest[1] * dest_pct) / out_pct),
+               int((source[2] * alpha_pct + dest[2] * dest_pct) / out_pct))
+
+    return new_rgb, int(out_pct * 255 + 0.5)
+
+
+class Canvas(object):
+    def __init__(self, rect, color=(0, 0, 0), alpha=0):
+        self.rect = rect
+        size = rect.width * rect.height
+        self.bitmap = [color] * size
+        self.alpha = [alpha] * size
+
+    def _area(self, clip):
+        return find_intersection_rect(self.rect, clip) if clip else self.rect
+
+    def _row_start(self, x, y):
+        return (x - self.rect.tl_x) + (y - self.rect.tl_y) * self.rect.width
+
+    def clear(self, clip=None, color=(0, 0, 0), alpha=0):
+
+        area = self._area(clip)
+        for y in range(area.tl_y, area.br_y):
+            lo = self._row_start(area.tl_x, y)
+            self.bitmap[lo:lo + area.width] = [color] * area.width
+            self.alpha[lo:lo + area.width] = [alpha] * area.width
+
+    def blend(self, rect, bitmap, spans, kernel=None, clip=None):
+        """ Composites a bitmap (covering rect, with alpha from spans) over this Canvas. Opaque runs are copied
+            as slices, transparent runs are skipped, and only partial runs are blended pixel by pixel.
+            A blending-mode kernel is mixed in where the Canvas already has something to blend with.
+        """
+
+        area = self._area(clip)
+        for y, kind, start, end, alphas in clipped_runs(spans, area):
+            if kind == SPAN_TRANSPARENT:
+                continue
+
+            lo = self._row_start(rect.tl_x + start, rect.tl_y + y)
+            hi = lo + (end - start)
+            higher = bitmap[y * rect.width + start:y * rect.width + end]
+            lower = self.bitmap[lo:hi]
+            lower_alpha = self.alpha[lo:hi]
+            if kernel:
+                mixed = kernel(lower, higher)
+                higher = [apply_mask_to_layer(src, mix, a) for src, mix, a in zip(higher, mixed, lower_alpha)]
+
+            if kind == SPAN_OPAQUE:
+                self.bitmap[lo:hi] = higher
+                self.alpha[lo:hi] = [255] * (end - start)
+            else:
+                combined = [composite_pixel(dest, dest_alpha, source, alpha)
+                            for dest, dest_alpha, source, alpha in zip(lower, lower_alpha, higher, alphas)]
+                self.bitmap[lo:hi] = [pixel for pixel, _ in combined]
+                self.alpha[lo:hi] = [alpha for _, alpha in combined]
+
+    def apply_mask(self, spans, clip=None):
+        """ Multiplies the alpha of this Canvas by a greyscale mask - everything outside the mask rectangle
+            is hidden.
+        """
+
+        area = self._area(clip)
+        mask_rect = spans.rect
+        inside = find_intersection_rect(area, mask_rect)
+
+        for y in range(area.tl_y, area.br_y):
+            lo = self._row_start(area.tl_x, y)
+            if y < inside.tl_y or y >= inside.br_y or inside.width <= 0:
+                self.alpha[lo:lo + area.width] = [0] * area.width
+                continue
+            # Left and right of the mask rectangle
+            self.alpha[lo:lo + inside.tl_x - area.tl_x] = [0] * (inside.tl_x - area.tl_x)
+            right = self._row_start(inside.br_x, y)
+            self.alpha[right:lo + area.width] = [0] * (area.br_x - inside.br_x)
+
+        for y, kind, start, end, alphas in clipped_runs(spans, inside):
+            if kind == SPAN_OPAQUE:
+                continue
+            lo = self._row_start(mask_rect.tl_x + start, mask_rect.tl_y + y)
+            hi = lo + (end - start)
+            if kind == SPAN_TRANSPARENT:
+                self.alpha[lo:hi] = [0] * (end - start)
+            else:
+                self.alpha[lo:hi] = [apply_rect_mask_to_layer(src, alpha) for src, alpha in zip(self.alpha[lo:hi], alphas)]
+
+    def flatten(self, color=(0, 0, 0)):
+        """ Returns the bitmap, composited onto a solid background color. """
+
+        return [apply_mask_to_layer(color, pixel, alpha) for pixel, alpha in zip(self.bitmap, self.alpha)]
@@ -0,0 +1,191 @@
+"""
+Pre-flight check for batches - sorts files into convertible, unsupported (a PSP file, but a version or compression
+psp_scan can't do) and corrupt, without decoding anything. Only the block headers (and the few chunks that say
+where the next header is) are read, seeking past everything else:
+
+    - every block, sub-block, layer and channel has to start with the ~BK marker, and fit inside its parent
+    - the top-level blocks have to add up to exactly the file size
+    - the layer bank has to hold as many layers as the General Image Attributes say
+
+Passing doesn't promise the pixels are good (the channel data isn't read), just that the file's put together right.
+"""
+
+from image import *
+
+CONVERTIBLE = 'convertible'
+UNSUPPORTED = 'unsupported'
+CORRUPT = 'corrupt'
+
+_, header_length = transmute_struct(generic_header)
+
+
+def check_header(fp, end, what):
+    """ Reads the block header at the current position, and returns it, with where the block's data starts - if
+        it *is* a block header, and the block fits before end. Otherwise, raises ValueError.
+    """
+
+    start = fp.tell()
+    if end - start < header_length:
+        raise ValueError("{0} at offset [{1}]: [{2}] bytes left, not enough for a block".format(what, start, end - start))
+
+    header = read_chunk(fp, generic_header)
+    if header['header_id'] != valid_header_identifier:
+        raise ValueError("{0} at offset [{1}]: no block marker".format(what, start))
+
+    data_start = fp.tell()
+    if data_start + header['block_length'] > end:
+        raise ValueError("{0} at offset [{1}]: [{2:,}] byte block runs past its end at [{3}]".format(
+            what, start, header['block_length'], end))
+
+    return header, data_start
+
+
+def check_chunk(fp, chunk_struct, end, what):
+    """ Reads a chunk that starts with its own size, and seeks past the whole thing - returns the chunk. """
+
+    start = fp.tell()
+    _, chunk_length = transmute_struct(chunk_struct)
+    if start + chunk_length > end:
+        raise ValueError("{0} at offset [{1}] runs past its block".format(what, start))
+
+    chunk = read_chunk(fp, chunk_struct)
+    chunk_size = chunk[chunk_struct.keys()[0]]  # chunk_size (or chunk_length, in the Alpha Bank)
+    if chunk_size < chunk_length or start + chunk_size > end:
+        raise ValueError("{0} at offset [{1}] has a bad size [{2}]".format(what, start, chunk_size))
+    fp.seek(start + chunk_size)
+
+    return chunk
+
+
+def check_channels(fp, channel_count, end, layer_name):
+
+    for x in range(channel_count):
+        header, data_start = check_header(fp, end, "layer [{0}] channel {1}".format(layer_name, x))
+        info = check_chunk(fp, channel_info_chunk, data_start + header['block_length'], 'channel info')
+        if info['chunk_size'] + info['comp_channel_len'] > header['block_length']:
+            raise ValueError("layer [{0}] channel {1}: [{2:,}] bytes of data, in a [{3:,}] byte block".format(
+                layer_name, x, info['comp_channel_len'], header['block_length']))
+        fp.seek(data_start + header['block_length'])
+
+
+def check_layer(fp, end):
+    """ A layer block: info chunk, an extension block for Group/Mask layers, the bitmap chunk, then its channels.
+        Layer types that psp_scan skips are only checked as far as the info chunk.
+    """
+
+    info_start = fp.tell()
+    chunk_start = check_chunk(fp, layer_info_chunk_start, end, 'layer info')
+    fp.seek(info_start + transmute_struct(layer_info_chunk_start)[1])
+    layer_name = read_name(fp, chunk_start['name_length'])
+    layer_type = read_chunk(fp, layer_info_chunk_rest)['layer_type']
+    fp.seek(info_start + chunk_start['chunk_size'])
+
+    if layer_type not in supported_layers:
+        return
+
+    if layer_type in [layer_types.keGLTGroup, layer_types.keGLTMask]:
+        header, data_start = check_header(fp, end, "layer [{0}] extension".format(layer_name))
+        fp.seek(data_start + header['block_length'])
+
+    bitmap_chunk = check_chunk(fp, layer_bitmap_chunk, end, "layer [{0}] bitmap info".format(layer_name))
+    check_channels(fp, bitmap_chunk['channel_count'], end, layer_name)
+
+
+def check_sub_blocks(fp, end, what):
+    """ Sub-blocks (after any info chunk), one after the other to the end of their parent - returns how many. """
+
+    count = 0
+    while fp.tell() < end:
+        header, data_start = check_header(fp, end, "{0} {1}".format(what, count))
+        if header['block_id'] == blks.PSP_LAYER_BLOCK:
+            check_layer(fp, data_start + header['block_length'])
+        fp.seek(data_start + header['block_length'])
+        count += 1
+
+    return count
+
+
+def check_blocks(fp, file_size, report):
+    """ The top-level blocks, which have to fill the file exactly. Fills in the report from the General Image
+        Attributes on the way.
+    """
+
+    _, file_header_length = transmute_struct(PSP_file_header)
+    fp.seek(file_header_length)
+
+    block_count = 0
+    while fp.tell() < file_size:
+        header, data_start = check_header(fp, file_size, "block {0}".format(block_count))
+        block_id = header['block_id']
+        block_end = data_start + header['block_length']
+
+        if block_count == 0 and block_id != blks.PSP_IMAGE_BLOCK:
+            raise ValueError('first block is not the General Image Attributes')
+
+        if block_id == blks.PSP_IMAGE_BLOCK:
+            gia = check_chunk(fp, general_image_attributes_chunk, block_end, 'General Image Attributes')
+            report.update({'width': gia['image_width'], 'height': gia['image_height'],
+                           'layer_count': gia['layer_count'], 'compression': gia['compression_type']})
+        elif block_id == blks.PSP_LAYER_BANK_BLOCK:
+            layer_count = check_sub_blocks(fp, block_end, 'layer')
+            if layer_count != report['layer_count']:
+                raise ValueError("layer bank holds [{0}] layers, General Image Attributes say [{1}]".format(
+                    layer_count, report['layer_count']))
+        elif block_id == blks.PSP_ALPHA_BANK_BLOCK:
+            check_chunk(fp, alpha_bank_info_chunk_header, block_end, 'alpha bank info')
+            check_sub_blocks(fp, block_end, 'alpha channel')
+
+        fp.seek(block_end)
+        block_count += 1
+
+    if report['width'] is None:
+        raise ValueError('no General Image Attributes block')
+
+
+def check_image(file_thing, name=None):
+    """ Checks one file (a file name, seekable file pointer, or the file's contents), and returns a report:
+        {'file', 'status', 'reason', 'version', 'file_size', 'width', 'height', 'layer_count', 'compression'}
+        with status one of CONVERTIBLE/UNSUPPORTED/CORRUPT, and the reason for anything not convertible.
+    """
+
+    file_name = file_thing if isinstance(file_thing, str) and not is_image_data(file_thing) else None
+    report = {'file': name or file_name, 'status': CONVERTIBLE,
+              'reason': None, 'version': None, 'file_size': None,
+              'width': None, 'height': None, 'layer_count': None, 'compression': None}
+
+    fp = file_thing
+    if is_image_data(file_thing):
+        fp = BufferReader(file_thing)
+    elif file_name:
+        try:
+            fp = open(file_thing, 'rb')
+        except IOError as e:
+            report.update({'status': CORRUPT, 'reason': "can't read file: {0}".format(e.strerror)})
+            return report
+
+    try:
+        fp.seek(0, os.SEEK_END)
+        report['file_size'] = file_size = fp.tell()
+        fp.seek(0)
+
+        if not accept(fp.read(len(valid_file_marker))):
+            raise ValueError('not a PSP file')
+        fp.seek(0)
+        report['version'] = read_chunk(fp, PSP_file_header)['major_version']
+        if report['version'] not in supported_versions:
+            report.update({'status': UNSUPPORTED, 'reason': "version [{0}] not supported".format(report['version'])})
+            return report
+
+        check_blocks(fp, file_size, report)
+
+        if report['compression'] not in supported_compression:
+            comp = report['compression']
+            comp_name = PSPCompression[comp] if comp < len(PSPCompression) else 'unknown'
+            report.update({'status': UNSUPPORTED, 'reason': "compression [{0}] not supported".format(comp_name)})
+    except (ValueError, struct.error, UnicodeDecodeError) as e:
+        report.update({'status': CORRUPT, 'reason': str(e)})
+    finally:
+        if file_name:
+            fp.close()
+
+    return report
@@ -3,117 +3,491 @@ Able to convert single files, or full directories
 """
 
 import argparse
+import io
+import json
 from argparse import RawTextHelpFormatter
 
-from image import *
+from archives import *
+from atlas import *
+from check import *
 
+server = LazyModule(sibling_module('server'))  # only needed for --serve
 
-BASE_DIR = os.getcwd()
+
+STDIO = '-'  # file name for stdin/stdout
 
 
 def run_command_line():
+
+    parser = make_parser()
+
+    # You would think an empty argument list would *default* to printing help, but no...
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parse_cli_args(parser)
+
+    if not args.test:
+        handle_cli(args)
+
+    return args
+
+
+def make_parser():
     usage = """
        psp_scan some_file.pspimage            # converts a single file to .png (default)
        psp_scan some_file.pspimage -m 3       # converts a single file to .png, and uses layer 3 mask in Alpha channel
+       psp_scan some_file.pspimage -m all     # saves one .png per mask-layer/Alpha channel (or a list: -m 3,5)
        psp_scan some_file.pspimage -f bmp     # converts a single file to .bmp
 
+       psp_scan - < some_file.pspimage > x.png  # converts stdin to stdout (or: psp_scan some_file.pspimage --stdout)
+       find . -name '*.pspimage' -print0 | psp_scan -0 -o new_dir  # converts files named on stdin, prints new names
+
        psp_scan -i some_dir -v                # converts all files (recursively) inside directory, prints output
        psp_scan -i some_dir -o new_dir        # converts all files (recursively) to new directory
+       psp_scan -i some.zip -o new.tar.gz     # converts all files in a zip/tar archive, into another archive
 
        psp_scan -l some_file.pspimage         # lists basic block information for file (add -v for more detail)
-       psp_scan -x some_file.pspimage         # expands file into blocks/layers, saves to new directory """
+       psp_scan --check -i some_dir           # sorts files into convertible/unsupported/corrupt, one JSON line each
+       psp_scan -x some_file.pspimage         # expands file into blocks/layers, saves to new directory
+
+       psp_scan --serve /tmp/psp.sock         # runs jobs sent by client.py (or --serve - for JSON lines on stdin) """
 
     def hp(**kwargs):
         return RawTextHelpFormatter(max_help_position=50, width=120, **kwargs)
 
     parser = argparse.ArgumentParser(description=usage, formatter_class=hp)
 
-    parser.add_argument('file_in', nargs='?', help='single file to convert (optional)')
-
-    parser.add_argument('-f', '--format', choices=['png', 'bmp'], default='png', help='format to convert file into (optional, default=png)')
-    parser.add_argument('-m', '--mask', type=int, help='mask-layer to use for PNG Alpha channel, for single file')
-    parser.add_argument('-i', '--input-dir', metavar='DIR', default=BASE_DIR, help='directory to read files from (optional)')
-    parser.add_argument('-o', '--output-dir', metavar='DIR', default=None, help='directory to save converted files (optional)')
+    parser.add_argument('file_in', nargs='?', help='single file to convert (optional), or - to read it from stdin')
+
+    parser.add_argument('-f', '--format', choices=['png', 'bmp', 'raw', 'npy'], default='png',
+                        help='format to convert file into (optional, default=png) - raw is RGBA bytes, with a .json\n'
+                             'sidecar describing them, npy is a NumPy array [height, width, 4]')
+    parser.add_argument('--stack-layers', action="store_true", help='raw/npy: every Raster/Mask layer, full-size,\n'
+                                                                     'instead of the image - npy is [layers, height, width, 4]')
+    parser.add_argument('-m', '--mask', type=mask_list, help='mask-layer to use for PNG Alpha channel - or "all"/a list (3,5), one PNG each')
+    parser.add_argument('--png', choices=sorted(png_presets), default='balanced',
+                        help='PNG encoding: fast, balanced or smallest (optional, default=balanced)')
+    parser.add_argument('--png-level', metavar='N', type=int, choices=range(10), help='PNG compress-level 0-9, instead of the preset\'s')
+    parser.add_argument('--png-optimize', action="store_true", default=None, help='PNG: extra pass to pick the smallest encoding')
+    parser.add_argument('--png-strategy', choices=sorted(png_strategies), help='PNG zlib strategy, instead of the preset\'s')
+    parser.add_argument('--png-reduce', action="store_true", default=None, help='PNG: save grey images as greyscale, and\n'
+                                                                                'images of 256 colours or less with a palette')
+    parser.add_argument('--stage', metavar='STAGE', dest='stages', action='append', type=stage_arg,
+                        help='post-process each image before it\'s saved - trim, resize=WxH (or Wx, xH, N%%), pad\n'
+                             '(to a power of two, or =WxH), sharpen[=PERCENT], or module:factory[=ARG] -\n'
+                             'repeat for more stages, run in order')
+    parser.add_argument('--trim', action="store_true", help='save just the visible part of each image, with a .json sidecar\n'
+                                                             'saying where it goes in the full image')
+    parser.add_argument('-i', '--input-dir', metavar='DIR', default=os.getcwd(), help='directory (or zip/tar archive) to read files from (optional)')
+    parser.add_argument('-o', '--output-dir', metavar='DIR', default=None, help='directory (or zip/tar archive) to save converted files (optional),\n'
+                                                                                     'or - for stdout')
+    parser.add_argument('--stdout', action="store_true", help='write the converted file to stdout (single file only)')
+    parser.add_argument('-0', '--null', action="store_true", help='read null-delimited file names from stdin (find -print0),\n'
+                                                                     'print each converted file name, null-delimited')
     parser.add_argument('-n', '--non-recursive', action="store_true", help='read directories non-recursively (default is recursive)')
+    parser.add_argument('--atlas', metavar='NAME', help='pack the converted images (trimmed) into texture atlases,\n'
+                                                       'NAME-0.png, NAME-1.png... plus a NAME.json frame map')
+    parser.add_argument('--atlas-size', metavar='N', type=int, default=2048, help='largest atlas width/height (default=2048)')
+    parser.add_argument('--atlas-padding', metavar='N', type=int, default=2, help='pixels between sprites (default=2)')
     parser.add_argument('-x', '--expand', action="store_true", help='expand file into layers/blocks, save into directory')
+    parser.add_argument('--artifacts', type=artifact_list, default=artifact_kinds,
+                        help='what -x writes out: a list of ' + '/'.join(artifact_kinds) + ' (default=all)')
     parser.add_argument('-l', '--list', action="store_true", help='list basic block info (no file conversion) - add -v for more detail')
+    parser.add_argument('--check', action="store_true", help='quick check of the file(s), without converting - prints a JSON report\n'
+                                                                'line per file: convertible, unsupported or corrupt')
     parser.add_argument('-v', '--verbose', action="store_true", help='extra output when processing files')
+    parser.add_argument('--recover', action="store_true", help='skip damaged blocks/layers (listed on stderr), and convert what\'s left')
+    parser.add_argument('--retain', choices=retention_policies, help='what each image keeps in memory once loaded (default=composite\n'
+                                                                      'when converting, layers with --stack-layers or -m)')
+    parser.add_argument('--serve', metavar='SOCKET', help='server mode - run jobs from a Unix socket, or - for stdin')
+    parser.add_argument('--workers', metavar='N', type=int, default=None, help='worker processes for server mode (default=one per CPU)')
     parser.add_argument('-t', '--test', action="store_true", help=argparse.SUPPRESS)
 
-    # You would think an empty argument list would *default* to printing help, but no...
-    if len(sys.argv) == 1:
-        parser.print_help()
-        sys.exit(1)
+    return parser
 
-    args = parser.parse_args()
 
-    if args.input_dir and not args.output_dir:
-        args.output_dir = args.input_dir
+def parse_cli_args(parser, argv=None):
+    """ Parses the command-line (or a server job's list of arguments), and fills in the defaults that depend
+        on other arguments.
+    """
 
-    if not args.test:
-        handle_cli(args)
+    args = parser.parse_args(argv)
+
+    # Reading from stdin, the output goes to stdout unless there's somewhere else to put it
+    if args.output_dir == STDIO or (args.file_in == STDIO and not args.output_dir):
+        args.stdout = True
+    if args.stdout and (args.null or not args.file_in):
+        parser.error('--stdout only works when converting a single file')
+
+    # Null-delimited files are saved next to the originals, by default - and files from an archive, next to it
+    if args.input_dir and not args.output_dir and not args.null:
+        args.output_dir = os.path.dirname(args.input_dir) or os.curdir if is_archive(args.input_dir) else args.input_dir
 
     return args
 
 
+def mask_list(mask_arg):
+    """ Parses the --mask argument: 'all', or a comma-separated list of layer numbers. """
+
+    if mask_arg == 'all':
+        return mask_arg
+
+    try:
+        return [int(x) for x in mask_arg.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("mask must be a layer number, a list (3,5), or 'all': [{0}]".format(mask_arg))
+
+
+def artifact_list(artifacts_arg):
+    """ Parses the --artifacts argument: a comma-separated list of artifact_kinds. """
+
+    kinds = tuple(x.strip() for x in artifacts_arg.split(','))
+    unknown = [x for x in kinds if x not in artifact_kinds]
+    if unknown:
+        raise argparse.ArgumentTypeError("artifacts must be from [{0}]: [{1}]".format(
+            ', '.join(artifact_kinds), ', '.join(unknown)))
+
+    return kinds
+
+
+def stage_arg(stage_spec):
+    """ Checks a --stage argument loads (see stages.py) - but keeps the spec, which is what gets passed around. """
+
+    try:
+        load_stage(stage_spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+    return stage_spec
+
+
+def stdin_fp():
+    """ stdin/stdout in binary mode (Python 3 has a separate binary .buffer, for Python 2 they're the same thing) """
+    return getattr(sys.stdin, 'buffer', sys.stdin)
+
+
+def stdout_fp():
+    return getattr(sys.stdout, 'buffer', sys.stdout)
+
+
+def null_delimited(in_fp, chunk_size=4096):
+    """ Yields each null-delimited name from a stream, as soon as it's complete - so files can be converted
+        while something like `find -print0` is still running.
+    """
+
+    leftover = ''
+    while True:
+        chunk = in_fp.read(chunk_size)
+        if not chunk:
+            break
+        names = (leftover + chunk).split('\0')
+        leftover = names.pop()
+        for name in names:
+            if name:
+                yield name
+
+    if leftover.strip():
+        yield leftover.strip()
+
+
+def cli_png_options(cli_args):
+    """ png_options() from the --png preset, and any of --png-level/--png-optimize/--png-strategy/--png-reduce """
+
+    return png_options(getattr(cli_args, 'png', None) or 'balanced',
+                       compress_level=getattr(cli_args, 'png_level', None),
+                       optimize=getattr(cli_args, 'png_optimize', None),
+                       strategy=getattr(cli_args, 'png_strategy', None),
+                       reduce=getattr(cli_args, 'png_reduce', None))
+
+
+def format_ext(cli_args):
+
+    return {'bmp': '.bmp', 'raw': '.raw', 'npy': '.npy'}.get(cli_args.format, '.png')
+
+
+def save_converted(p, cli_args, out_file, sidecar=None):
+    """ Saves an image in the requested format - with a mask-list, that's one PNG per mask. sidecar is where the
+        raw/npy description (or the --trim) goes, if out_file isn't a file name (see PSPImage.save_as_raw()).
+    """
+
+    masks = cli_args.mask
+    stages = getattr(cli_args, 'stages', None)
+    trim = getattr(cli_args, 'trim', False)
+    several_masks = masks == 'all' or (masks and len(masks) > 1)
+    if not isinstance(out_file, str) and several_masks:
+        raise ValueError("can't write one PNG per mask to a stream - pick one mask")
+    if trim and several_masks:
+        raise ValueError("can't trim one PNG per mask - pick one mask")
+    if cli_args.format in ['raw', 'npy']:
+        if several_masks:
+            raise ValueError("one mask per {0} file - pick one mask".format(cli_args.format))
+        save_array = p.save_as_raw if cli_args.format == 'raw' else p.save_as_npy
+        save_array(out_file, masks[0] if masks else None, getattr(cli_args, 'stack_layers', False), sidecar, stages,
+                   trim)
+    elif cli_args.format == 'bmp':
+        p.save_as_bitmap(out_file, stages=stages, trim=trim, sidecar=sidecar)
+    elif several_masks:
+        p.save_mask_variants(out_file, masks, png=cli_png_options(cli_args), stages=stages)
+    else:
+        p.save_as_PNG(out_file, masks[0] if masks else None, cli_png_options(cli_args), stages, trim, sidecar)
+
+
+def open_output(cli_args):
+    """ The output directory (created if needed) - or, if it's the name of an archive, an ArchiveWriter. """
+
+    if is_archive(cli_args.output_dir):
+        return ArchiveWriter(cli_args.output_dir)
+    return get_or_create_dir(cli_args.output_dir, None, None)
+
+
+def close_output(out_dir):
+
+    if isinstance(out_dir, ArchiveWriter):
+        out_dir.close()
+
+
+def save_output(p, cli_args, out_dir, file_name):
+    """ save_converted(), to a file in an output directory/archive - file_name can include sub-directories.
+        A mask-list saves one PNG per mask (named as in save_mask_variants()), even in an archive.
+    """
+
+    masks = cli_args.mask
+    if callable(out_dir) and cli_args.format == 'png' and (masks == 'all' or (masks and len(masks) > 1)) and \
+            not getattr(cli_args, 'trim', False):
+        base_name = os.path.splitext(file_name)[0]
+        p.save_mask_variants(lambda mask_file: out_dir("{0}--{1}".format(base_name, mask_file)), masks,
+                             png=cli_png_options(cli_args), stages=getattr(cli_args, 'stages', None))
+    else:
+        out_file = out_path(out_dir, file_name)
+        sidecar = None
+        if not callable(out_dir):
+            get_or_create_dir(os.path.dirname(out_file), None, None)
+        elif cli_args.format == 'raw' or getattr(cli_args, 'trim', False) or \
+                (cli_args.format == 'npy' and getattr(cli_args, 'stack_layers', False)):
+            sidecar = out_dir(file_name + '.json')
+        save_converted(p, cli_args, out_file, sidecar)
+
+    if isinstance(out_dir, ArchiveWriter):
+        out_dir.flush()
+
+
 def cli_expand_file(cli_args):
 
     in_file = cli_args.file_in
-    if not in_file:
+    if not in_file or in_file == STDIO:
         raise ValueError("filename required to expand")
 
     out_dir = cli_args.output_dir
-    layer_dir = get_or_create_dir(out_dir, in_file, 'layers', expand=True)
-    block_dir = get_or_create_dir(out_dir, in_file, 'blocks', expand=True)
+    kinds = getattr(cli_args, 'artifacts', artifact_kinds)
+
+    with open_image(cli_args, in_file, cli_options={'RETAIN': 'all'}) as p:
+        if 'layers' in kinds:
+            p.save_layers_to_file(get_or_create_dir(out_dir, in_file, 'layers', expand=True))
+        p.save_blocks_to_file(get_or_create_dir(out_dir, in_file, 'blocks', expand=True), kinds)
+
+
+def open_image(cli_args, file_thing, name=None, cli_options=None):
+    """ PSPImage(), plus the --recover option - any damaged blocks/layers that were skipped are listed on stderr.
+        A conversion only needs the composite (unless it stacks the layers, or uses one as the mask), so by default
+        that's all that's kept (see retention_policies) - --retain overrides that, and any RETAIN in cli_options.
+    """
 
-    p = PSPImage(in_file)
-    p.save_layers_to_file(layer_dir)
-    p.save_blocks_to_file(block_dir)
+    cli_options = dict(cli_options or {})
+    if getattr(cli_args, 'recover', False):
+        cli_options['RECOVER'] = True
+    if getattr(cli_args, 'retain', None):
+        cli_options['RETAIN'] = cli_args.retain
+    elif 'RETAIN' not in cli_options:
+        cli_options['RETAIN'] = 'layers' if getattr(cli_args, 'stack_layers', False) or cli_args.mask else 'composite'
+
+    p = PSPImage(file_thing, cmd_options=cli_options)
+    for damage in p.damaged:
+        sys.stderr.write("damaged [{0}], skipped {1}\n".format(name or file_thing, damage))
+
+    return p
 
 
 def cli_list_file(cli_args):
 
-    cli_options = {'VERBOSE': False, 'API_FORMAT': False}
+    cli_options = {'VERBOSE': False, 'API_FORMAT': False, 'RETAIN': 'all'}
     cli_options['VERBOSE'] = True if cli_args.verbose else False
 
     in_file = cli_args.file_in
-    p = PSPImage(in_file, cmd_options=cli_options)
-    p.list_blocks()
+    with open_image(cli_args, stdin_fp() if in_file == STDIO else in_file, in_file, cli_options) as p:
+        p.list_blocks()
+
+
+def check_sources(cli_args):
+    """ Yields (name, file name/contents) for each file to --check - the same files the conversion would use. """
+
+    if cli_args.null:
+        for in_file in null_delimited(stdin_fp()):
+            yield in_file, in_file
+    elif cli_args.file_in == STDIO:
+        yield STDIO, stdin_fp().read()
+    elif cli_args.file_in:
+        yield cli_args.file_in, cli_args.file_in
+    elif is_archive(cli_args.input_dir):
+        for member_name, member_data in archive_members(cli_args.input_dir, cli_args.non_recursive):
+            yield "{0}:{1}".format(cli_args.input_dir, member_name), member_data
+    else:
+        for in_file, _, _ in walk_dir(cli_args, cli_args.output_dir, os.walk):
+            yield in_file, in_file
+
+
+def sprite_name(cli_args, name):
+    """ A check_sources() name, as a sprite name - the path inside the input directory/archive, no extension. """
+
+    if is_archive(cli_args.input_dir) and not cli_args.file_in and not cli_args.null:
+        name = name[len(cli_args.input_dir) + 1:]
+    elif os.path.abspath(name).startswith(os.path.join(os.path.abspath(cli_args.input_dir), '')):
+        name = os.path.relpath(name, cli_args.input_dir)
+
+    return os.path.splitext(name)[0].replace(os.sep, '/')
+
+
+def cli_atlas_files(cli_args):
+    """ Converts the files (same as a normal conversion would), and packs them into texture atlases - only the
+        trimmed RGBA of each one is kept, until they're packed. Files that can't be read are skipped.
+    """
+
+    masks = cli_args.mask
+    if masks == 'all' or (masks and len(masks) > 1):
+        raise ValueError("one mask per sprite - pick one mask")
+
+    sprites = []
+    for name, file_thing in check_sources(cli_args):
+        if cli_args.verbose:
+            sys.stderr.write("adding: {0}\n".format(name))
+        try:
+            with open_image(cli_args, file_thing, name) as p:
+                sprites.append(Sprite.from_psp(sprite_name(cli_args, name), p, masks[0] if masks else None,
+                                               cli_args.stages))
+        except Exception as e:
+            sys.stderr.write("skipping file [{0}]:\n\t{1}\n".format(name, e))
+
+    if not sprites:
+        raise ValueError('no images to pack')
+
+    out_dir = open_output(cli_args) if cli_args.output_dir else os.curdir
+    try:
+        frame_map = save_atlas(out_dir, cli_args.atlas, sprites, cli_args.atlas_size, cli_args.atlas_padding,
+                               png=cli_png_options(cli_args))
+    finally:
+        close_output(out_dir)
+
+    if cli_args.verbose:
+        sys.stderr.write("packed [{0}] sprites into [{1}] atlases\n".format(
+            len(frame_map['frames']), len(frame_map['meta']['images'])))
+
+
+def cli_check_files(cli_args, out_fp=None):
+    """ Prints a check_image() report for each file, as a line of JSON - with -v, totals go to stderr after. """
+
+    out_fp = out_fp or sys.stdout
+    totals = {CONVERTIBLE: 0, UNSUPPORTED: 0, CORRUPT: 0}
+
+    for name, file_thing in check_sources(cli_args):
+        report = check_image(file_thing, name)
+        totals[report['status']] += 1
+        out_fp.write(json.dumps(report, sort_keys=True) + '\n')
+
+    if cli_args.verbose:
+        sys.stderr.write("{0} convertible, {1} unsupported, {2} corrupt\n".format(
+            totals[CONVERTIBLE], totals[UNSUPPORTED], totals[CORRUPT]))
+
+    return totals
 
 
 def cli_single_file(cli_args):
-    """ Saves a single file, to specified output directory (possibly created), in a specified format. """
+    """ Saves a single file, to specified output directory (possibly created), in a specified format.
+        The file can come from stdin (read a block at a time, see load_stream_blocks()), and go to stdout.
+    """
 
     in_file = cli_args.file_in
-    _, base_file = os.path.split(in_file)
-    format_str = '.bmp' if cli_args.format == 'bmp' else '.png'
-    base_file = base_file.replace('.pspimage', format_str)
-    out_dir = get_or_create_dir(cli_args.output_dir, None, None)
-    out_file = os.path.join(out_dir, base_file)
-    mask_num = cli_args.mask
+    with open_image(cli_args, stdin_fp() if in_file == STDIO else in_file, in_file) as p:
+        if cli_args.stdout:
+            if cli_args.verbose:
+                sys.stderr.write("converting: {0} => stdout\n".format(in_file))
+            # Pillow writes to the file-descriptor of real files, bypassing (and mixing badly with) the buffered
+            # stdout, so convert into memory first
+            out_buffer = io.BytesIO()
+            save_converted(p, cli_args, out_buffer)
+            out_fp = stdout_fp()
+            out_fp.write(out_buffer.getvalue())
+            out_fp.flush()
+            return
+
+        _, base_file = os.path.split('stdin.pspimage' if in_file == STDIO else in_file)
+        format_str = format_ext(cli_args)
+        base_file = base_file.replace('.pspimage', format_str)
+        out_dir = open_output(cli_args)
+
+        if cli_args.verbose:
+            out_file = os.path.join(cli_args.output_dir, base_file)
+            print ("converting: {0}{1}=> {2}".format(in_file, ' ' * (70 - len(in_file)), out_file))
 
-    if cli_args.verbose:
-        print ("converting: {0}{1}=> {2}".format(in_file, ' ' * (70 - len(in_file)), out_file))
+        try:
+            save_output(p, cli_args, out_dir, base_file)
+        finally:
+            close_output(out_dir)
 
-    p = PSPImage(in_file)
-    func = p.save_as_bitmap if cli_args.format == 'bmp' else p.save_as_PNG
-    func(out_file, mask_num)
+
+def cli_null_files(cli_args, in_fp=None, out_fp=None):
+    """ Converts each file named (null-delimited) on stdin, as the names arrive, and prints the name of each
+        converted file to stdout (also null-delimited, for xargs -0). Files go to the output directory if
+        there is one, otherwise next to the original file. Progress/errors go to stderr, to keep stdout clean.
+        With an output archive, the names printed are the archive members.
+    """
+
+    in_fp = in_fp or stdin_fp()
+    out_fp = out_fp or stdout_fp()
+    format_str = format_ext(cli_args)
+    archive = open_output(cli_args) if is_archive(cli_args.output_dir) else None
+
+    try:
+        for in_file in null_delimited(in_fp):
+            in_dir, base_file = os.path.split(in_file)
+            out_dir = archive or (open_output(cli_args) if cli_args.output_dir else in_dir or os.curdir)
+            base_file = os.path.splitext(base_file)[0] + format_str
+            out_file = base_file if archive else os.path.join(out_dir, base_file)
+
+            if cli_args.verbose:
+                sys.stderr.write("converting: {0} => {1}\n".format(in_file, out_file))
+            try:
+                with open_image(cli_args, in_file) as p:
+                    save_output(p, cli_args, out_dir, base_file)
+            except Exception as e:
+                sys.stderr.write("skipping file [{0}]:\n\t{1}\n".format(in_file, e))
+                continue
+
+            out_fp.write(out_file + '\0')
+            out_fp.flush()
+    finally:
+        close_output(archive)
 
 
 def cli_many_files(cli_args):
     """ Saves all files, from specified directory, to specified directory, in a specified format.
-        Recurses down the input directory, unless specified otherwise.
+        Recurses down the input directory, unless specified otherwise. Either one can be an archive instead.
     """
 
+    if is_archive(cli_args.input_dir):
+        cli_archive_files(cli_args)
+        return
+
     in_dir = cli_args.input_dir
-    out_dir = get_or_create_dir(cli_args.output_dir, None, None)
+    out_dir = open_output(cli_args)
     is_verbose = cli_args.verbose
 
-    files = walk_dir(cli_args, out_dir, os.walk)
+    files = walk_dir(cli_args, cli_args.output_dir, os.walk)
 
     if not len(files):
         if is_verbose:
             print ("no files found in directory [{0}]".format(in_dir))
+        close_output(out_dir)
         return
 
     # I got tired of PyCharm telling me "'file' is overshadowing another variable" - so fyle, it is...
@@ -121,17 +495,42 @@ def cli_many_files(cli_args):
     fyles = [FileData(*fyle) for fyle in files]
     max_size = max([len(fyle.in_file) for fyle in fyles]) + 5
 
-    for fd in fyles:
-        if is_verbose:
-            print ("converting: {0}{1}=> {2}".format(fd.in_file, ' ' * (max_size - len(fd.in_file)), fd.out_file))
-        try:
-            p = PSPImage(fd.in_file)
-            get_or_create_dir(fd.out_dir, None, None)
-            func = p.save_as_bitmap if cli_args.format == 'bmp' else p.save_as_PNG
-            func(fd.out_file)
-        except Exception as e:
-            print ("skipping file [{0}]:".format(fd.in_file))
-            print ("\t", e)
+    try:
+        for fd in fyles:
+            if is_verbose:
+                print ("converting: {0}{1}=> {2}".format(fd.in_file, ' ' * (max_size - len(fd.in_file)), fd.out_file))
+            try:
+                with open_image(cli_args, fd.in_file) as p:
+                    save_output(p, cli_args, out_dir, os.path.relpath(fd.out_file, cli_args.output_dir))
+            except Exception as e:
+                print ("skipping file [{0}]:".format(fd.in_file))
+                print ("\t", e)
+    finally:
+        close_output(out_dir)
+
+
+def cli_archive_files(cli_args):
+    """ Same as cli_many_files(), for the .pspimage files inside a zip/tar archive - each one is read into memory
+        and converted in turn, never unpacked to disk.
+    """
+
+    in_archive = cli_args.input_dir
+    out_dir = open_output(cli_args)
+    format_str = format_ext(cli_args)
+
+    try:
+        for member_name, member_data in archive_members(in_archive, cli_args.non_recursive):
+            out_file = os.path.splitext(member_name)[0] + format_str
+            if cli_args.verbose:
+                print ("converting: {0}:{1} => {2}".format(in_archive, member_name, out_file))
+            try:
+                with open_image(cli_args, BufferReader(member_data), "{0}:{1}".format(in_archive, member_name)) as p:
+                    save_output(p, cli_args, out_dir, out_file)
+            except Exception as e:
+                print ("skipping file [{0}:{1}]:".format(in_archive, member_name))
+                print ("\t", e)
+    finally:
+        close_output(out_dir)
 
 
 def warp_dirs(top_dir, full_dir, new_dir):
@@ -173,7 +572,7 @@ def walk_dir(cli_args, out_dir, walker):
     """
 
     in_dir = cli_args.input_dir
-    format_str = '.bmp' if cli_args.format == 'bmp' else '.png'
+    format_str = format_ext(cli_args)
     no_recurse = cli_args.non_recursive
 
     files = []
@@ -196,12 +595,61 @@ def walk_dir(cli_args, out_dir, walker):
     return new_files
 
 
+def run_job(job):
+    """ Runs one server-mode job (see server.py) in a worker process - the job's arguments are parsed just like the
+        command-line, relative to the job's directory (the worker goes back to its own after). Anything the job
+        prints is returned, instead.
+    """
+
+    result = {'id': job.get('id'), 'ok': False, 'output': '', 'error': None}
+    old_stdout, old_stderr = sys.stdout, sys.stderr
+    old_cwd = os.getcwd()  # the worker runs other jobs after this one
+    sys.stdout = sys.stderr = captured = io.BytesIO()
+
+    try:
+        os.chdir(job.get('cwd') or os.curdir)
+        args = parse_cli_args(make_parser(), [str(arg) for arg in job.get('args', [])])
+        if args.file_in == STDIO or args.stdout or args.null or args.serve:
+            raise ValueError("stdin/stdout aren't available to server jobs")
+        handle_cli(args)
+        result['ok'] = True
+    except SystemExit:
+        result['error'] = 'bad arguments'  # argparse already said why, in the output
+    except Exception as e:
+        result['error'] = str(e)
+    finally:
+        sys.stdout, sys.stderr = old_stdout, old_stderr
+        os.chdir(old_cwd)
+
+    result['output'] = captured.getvalue().decode('utf-8', 'replace')
+
+    return result
+
+
+def cli_serve(cli_args):
+
+    if cli_args.serve == STDIO:
+        server.serve_lines(stdin_fp(), stdout_fp(), run_job, cli_args.workers)
+    else:
+        server.serve_socket(cli_args.serve, run_job, cli_args.workers)
+
+
 def handle_cli(cli_args):
 
-    if cli_args.expand:
+    if cli_args.serve:
+        cli_serve(cli_args)
+        return
+
+    if cli_args.check:
+        cli_check_files(cli_args)
+    elif cli_args.atlas:
+        cli_atlas_files(cli_args)
+    elif cli_args.expand:
         cli_expand_file(cli_args)
     elif cli_args.list:
         cli_list_file(cli_args)
+    elif cli_args.null:
+        cli_null_files(cli_args)
     elif cli_args.file_in:
         cli_single_file(cli_args)
     else:
@@ -0,0 +1,53 @@
+"""
+The other end of server.py - sends one job to a running psp_scan server, waits for it to finish, and prints
+whatever the job printed. Run it as a script, not with -m, so that it doesn't import the rest of psp_scan
+(or Pillow) - skipping all that is the whole point:
+
+    python -m psp_scan --serve /tmp/psp_scan.sock &
+    python path/to/psp_scan/client.py /tmp/psp_scan.sock ship.pspimage -f bmp -o out
+
+Exits with 0 if the job worked, 1 if it didn't.
+"""
+
+import json
+import os
+import socket
+import sys
+
+
+def send_job(socket_path, args, cwd=None, job_id=None):
+    """ Sends a job (a list of psp_scan command-line arguments, relative to cwd), and returns the result dict. """
+
+    job = {'id': job_id, 'cwd': cwd or os.getcwd(), 'args': args}
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(job) + '\n')
+        sock.shutdown(socket.SHUT_WR)
+        result_line = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+
+    if not result_line:
+        raise IOError("no result from server [{0}]".format(socket_path))
+
+    return json.loads(result_line)
+
+
+def main():
+
+    if len(sys.argv) < 3:
+        sys.stderr.write("usage: client.py SOCKET [psp_scan arguments]\n")
+        sys.exit(2)
+
+    result = send_job(sys.argv[1], sys.argv[2:])
+    if result['output']:
+        sys.stdout.write(result['output'].encode('utf-8'))
+    if not result['ok']:
+        sys.stderr.write("{0}\n".format(result['error']))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,52 @@
 I'll take, "things that write out to a file", for $500, Alex...
 """
 
-from PIL import Image
+import json
 
 from utils import *
 
 
+def register_plugin(_=None):
+    """ Registers PSP as a Pillow file-format (see PspImagePlugin) - psp_scan does this itself when it imports Pillow. """
+
+    importlib.import_module(sibling_module('PspImagePlugin'))
+
+
+Image = LazyModule('PIL.Image', register_plugin)
+pool_module = LazyModule('multiprocessing.pool')
+
+# What save_layers_to_file()/save_blocks_to_file() can write out (psp_scan -x --artifacts):
+#   layers - each layer's own bitmap, channels - each channel, masks - rectangle-masks and Alpha channels,
+#   merges - each layer (or group) merged with its mask, over a checkerboard
+artifact_kinds = ('layers', 'channels', 'masks', 'merges')
+
+
+def run_threaded(func, items, threads=None):
+    """ func(item) for each item, from a pool of threads (default: one per CPU) - Pillow lets go of the GIL
+        while it encodes and writes, so saving files this way overlaps.
+    """
+
+    pool = pool_module.ThreadPool(threads)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def checkerboard(width, height, square=16):
+    """ Greyscale checkerboard (192/255), for showing what's transparent - built a row of squares at a time. """
+
+    def square_row(first, second):
+        row = (first * square + second * square) * (width // (square * 2) + 1)
+        return row[:width] * square
+
+    band = square_row('\xc0', '\xff') + square_row('\xff', '\xc0')
+    board = band * (height // (square * 2) + 1)
+
+    return Image.frombytes('L', (width, height), board[:width * height])
+
+
 def save_rect_mask_debug(out_file, bitmap_data, img_rect):
     """ Save pixel data as bitmap - convert greyscale pixels into byte-string, then create new bitmap image.
     When writing the mask/transparency code, I found it very helpful to be able to generate a bitmap-image file
@@ -36,20 +77,15 @@ def save_layer_mask_debug(gia, out_file, bitmap_data, img_rect):
     img_mask.close()
 
 
-def save_layer_merge_debug(gia, out_file, bitmap_data, img_rect, rect_mask_bits):
-    """ Saves an entire merged layer, both with and without the rectangle-mask applied.
+def save_layer_merge_debug(gia, out_dir, file_name, trans_name, bitmap_data, img_rect, rect_mask_bits):
+    """ Saves an entire merged layer, both with and without the rectangle-mask applied (two files, file_name and
+        trans_name, hence the directory instead of just a file - see out_path()).
         Uses a cool checkerboard effect for background of transparent section. Mainly for debugging.
     """
 
     pic_width = gia['width']
     pic_height = gia['height']
 
-    def is_checkered(x, y):
-        x_foo = (((x / 16) % 2) == 0)
-        y_foo = (((y / 16) % 2) == 0)
-        final = (x_foo == y_foo)
-        return final
-
     mask_width = img_rect.width
     mask_height = img_rect.height
 
@@ -58,7 +94,7 @@ def save_layer_merge_debug(gia, out_file, bitmap_data, img_rect, rect_mask_bits)
     img_rect_bitmap = Image.frombytes('RGB', (mask_width, mask_height), bitmap_bytes)
     img_black.paste(img_rect_bitmap, (img_rect.tl_x, img_rect.tl_y))
 
-    img_black.save(out_file, 'bmp')
+    img_black.save(out_path(out_dir, file_name), 'bmp')
 
     # Expand rect_mask, if any, to image-size - apply with cool checkerboard effect.
     if rect_mask_bits:
@@ -66,21 +102,11 @@ def save_layer_merge_debug(gia, out_file, bitmap_data, img_rect, rect_mask_bits)
         mask = Image.frombytes('L', (mask_width, mask_height), string_to_bytes(rect_mask_bits))
         img_greyscale.paste(mask, (img_rect.tl_x, img_rect.tl_y))
 
-        checkers = []
-        for height in range(pic_height):
-            for width in range(pic_width):
-                color = 192 if is_checkered(width, height) else 255
-                checkers.append(color)
-        check_bytes = string_to_bytes(checkers)
-        checker_gray = Image.frombytes('L', (pic_width, pic_height), check_bytes)
+        checker_gray = checkerboard(pic_width, pic_height)
         checker_rgb = checker_gray.convert(mode='RGB')
         checker_rgb.paste(img_black, img_greyscale)
 
-        # Rename file from 'layer-' to 'layer-trans'
-        out_dir, base = os.path.split(out_file)
-        base = base.replace('layer', 'layer-trans')
-        layer_file = os.path.join(out_dir, base)
-        checker_rgb.save(layer_file, 'bmp')
+        checker_rgb.save(out_path(out_dir, trans_name), 'bmp')
 
         mask.close()
         checker_gray.close()
@@ -90,11 +116,28 @@ def save_layer_merge_debug(gia, out_file, bitmap_data, img_rect, rect_mask_bits)
     img_rect_bitmap.close()
 
 
-def save_bitmap(out_file, bitmap_data, img_rect):
-    """ Save pixel data as bitmap - flatten pixel RGB triplets into byte-string, then create new bitmap image. """
+def apply_stages(img, stages):
+    """ Runs a Pillow.Image through a list of stage functions (see stages.py), in order - any image a stage
+        replaces is closed. Returns the last one.
+    """
+
+    for stage in stages or []:
+        new_img = stage(img)
+        if new_img is not img:
+            img.close()
+        img = new_img
+
+    return img
+
+
+def save_bitmap(out_file, bitmap_data, img_rect, stages=None):
+    """ Save pixel data as bitmap - flatten pixel RGB triplets into byte-string, then create new bitmap image.
+        stages are run on the image before it's saved (same for the other save-functions).
+    """
 
     bitmap_bytes = string_to_bytes(flatten_RGB(bitmap_data))
     img = Image.frombytes('RGB', (img_rect.width, img_rect.height), bitmap_bytes)
+    img = apply_stages(img, stages)
     img.save(out_file, 'bmp')
     img.close()
 
@@ -105,8 +148,121 @@ def save_stuff_to_file(out_file, bitmap_img, extension='bmp'):
     bitmap_img.close()
 
 
-def save_PNG(gia, out_file, bitmap_data, mask=None, img_rect=None):
-    """ Same as save_bitmap(), but with a mask - if the mask exists, it's saved to the PNG's Alpha channel. """
+def expand_mask(gia, mask, img_rect, region=None):
+    """ Turns a greyscale mask, for some rectangle of the image, into a full image-sized Pillow.Image - or just
+        the part of it that's in region.
+    """
+
+    region = region or Rect(0, 0, gia['width'], gia['height'])
+
+    new_mask = Image.frombytes('L', (img_rect.width, img_rect.height), string_to_bytes(mask))
+    img_back = Image.new('L', (region.width, region.height))
+    img_back.paste(new_mask, (img_rect.tl_x - region.tl_x, img_rect.tl_y - region.tl_y))
+    new_mask.close()
+
+    return img_back
+
+
+# PNG encoding - how hard zlib works (compress_level 0-9, and optimize, which is level 9 plus picking the best
+# filters), the zlib strategy, and whether to reduce the image to greyscale/a palette first, when that loses nothing.
+# 'balanced' is Pillow's own default. (psp_scan --png fast, etc)
+png_strategies = {'default': 0, 'filtered': 1, 'huffman': 2, 'rle': 3, 'fixed': 4}
+png_presets = {
+    'fast':     {'compress_level': 1, 'optimize': False, 'strategy': 'default', 'reduce': False},
+    'balanced': {'compress_level': 6, 'optimize': False, 'strategy': 'default', 'reduce': False},
+    'smallest': {'compress_level': 9, 'optimize': True,  'strategy': 'default', 'reduce': True},
+}
+
+
+def png_options(preset='balanced', **settings):
+    """ A preset's PNG settings, with any of them overridden - png_options('fast', reduce=True).
+        Settings that are None are left at the preset's value.
+    """
+
+    if preset not in png_presets:
+        raise ValueError("PNG preset [{0}] must be one of [{1}]".format(preset, ', '.join(sorted(png_presets))))
+
+    options = dict(png_presets[preset])
+    for name, value in settings.items():
+        if name not in options:
+            raise TypeError("unknown PNG setting [{0}]".format(name))
+        if value is not None:
+            options[name] = value
+
+    if options['strategy'] not in png_strategies:
+        raise ValueError("zlib strategy [{0}] must be one of [{1}]".format(
+            options['strategy'], ', '.join(sorted(png_strategies))))
+    if not 0 <= options['compress_level'] <= 9:
+        raise ValueError("compress_level [{0}] must be 0-9".format(options['compress_level']))
+
+    return options
+
+
+def reduce_colors(img):
+    """ An RGB/RGBA image as greyscale (L/LA) if all its pixels are grey, or as a palette (P) if it's RGB with no
+        more than 256 colours - or the image itself, if neither fits. Only reduces when it's exact.
+    """
+
+    bands = img.split()
+    if bands[0].tobytes() == bands[1].tobytes() == bands[2].tobytes():
+        return Image.merge('LA', (bands[0], bands[3])) if img.mode == 'RGBA' else bands[0]
+
+    if img.mode != 'RGB':
+        return img
+    colors = img.getcolors(256)
+    if not colors:
+        return img
+
+    reduced = img.quantize(colors=len(colors))
+    if reduced.convert('RGB').tobytes() != img.tobytes():
+        return img
+
+    return reduced
+
+
+def write_PNG(img, out_file, png=None):
+    """ Saves a Pillow.Image as PNG, with png_options() (or a preset name) - default is 'balanced'. """
+
+    options = png_options(png) if isinstance(png, str) else png or png_presets['balanced']
+    settings = {'compress_level': options['compress_level'], 'optimize': options['optimize'],
+                'compress_type': png_strategies[options['strategy']]}
+
+    if options['reduce']:
+        img = reduce_colors(img)
+        if img.mode == 'P':
+            # quantize() leaves a 256-colour palette - pack the pixels by how many colours are actually used
+            color_count = len(img.getcolors(256))
+            settings['bits'] = [bits for bits in [1, 2, 4, 8] if color_count <= 1 << bits][0]
+
+    img.save(out_file, 'png', **settings)
+
+
+def save_PNG(gia, out_file, bitmap_data, mask=None, img_rect=None, png=None, stages=None, region=None):
+    """ Same as save_bitmap(), but with a mask - if the mask exists, it's saved to the PNG's Alpha channel.
+        png is the encoding (see png_options()). To save just part of the image, bitmap_data only covers
+        region (the mask is cut to fit).
+    """
+
+    region = region or Rect(0, 0, gia['width'], gia['height'])
+
+    bitmap_bytes = string_to_bytes(flatten_RGB(bitmap_data))
+    img_main = Image.frombytes('RGB', (region.width, region.height), bitmap_bytes)
+
+    if mask:
+        img_back = expand_mask(gia, mask, img_rect, region)
+        img_main.putalpha(img_back)
+        img_back.close()
+
+    img_main = apply_stages(img_main, stages)
+    write_PNG(img_main, out_file, png)
+    img_main.close()
+
+
+def save_PNG_variants(gia, bitmap_data, variants, threads=None, png=None, stages=None):
+    """ Same as save_PNG(), for a list of (out_file, mask, img_rect) - but the RGB image is only built once,
+        then each mask is attached to a copy of it in turn. The PNGs are written from a pool of threads
+        (Pillow lets go of the GIL while it compresses), defaulting to one per CPU.
+    """
 
     pic_width = gia['width']
     pic_height = gia['height']
@@ -114,14 +270,167 @@ def save_PNG(gia, out_file, bitmap_data, mask=None, img_rect=None):
     bitmap_bytes = string_to_bytes(flatten_RGB(bitmap_data))
     img_main = Image.frombytes('RGB', (pic_width, pic_height), bitmap_bytes)
 
+    def save_one(variant):
+        out_file, mask, img_rect = variant
+        img = img_main.copy()
+        if mask:
+            img_back = expand_mask(gia, mask, img_rect)
+            img.putalpha(img_back)
+            img_back.close()
+        img = apply_stages(img, stages)
+        write_PNG(img, out_file, png)
+        img.close()
+        return out_file
+
+    try:
+        return run_threaded(save_one, variants, threads)
+    finally:
+        img_main.close()
+
+
+def pack_pixels(pixels):
+    """ Greyscale values [0, 255, ...] or RGB triples [(0, 255, 0), ...], as a bytearray """
+
+    if pixels and isinstance(pixels[0], tuple):
+        return bytearray(itertools.chain.from_iterable(pixels))
+    return bytearray(pixels)
+
+
+def rgba_bytes(bitmap, alpha=None):
+    """ RGB triples -> RGBA bytes, with the alpha from a greyscale mask - or all 255 """
+
+    rgb = pack_pixels(bitmap)
+    pixel_count = len(rgb) // 3
+
+    rgba = bytearray('\xff' * (pixel_count * 4))
+    for x in range(3):
+        rgba[x::4] = rgb[x::3]
+    if alpha:
+        rgba[3::4] = pack_pixels(alpha)
+
+    return rgba
+
+
+class PixelView(object):
+    """ Pixels packed into a buffer (a bytearray, or the file's own bytes, read-only), with their shape -
+        [height, width] for masks, [height, width, 3] for RGB, [height, width, 4] for RGBA. numpy.asarray(view)
+        wraps the buffer without copying (see __array_interface__), and view.data is the buffer itself, for
+        memoryview() or anything else that takes one. Views of a bytearray are writable, and see later edits.
+    """
+
+    def __init__(self, data, shape):
+
+        self.data = data
+        self.shape = tuple(shape)
+
+    @property
+    def __array_interface__(self):
+        return {'version': 3, 'shape': self.shape, 'typestr': '|u1', 'data': self.data}
+
+    @property
+    def width(self):
+        return self.shape[1]
+
+    @property
+    def height(self):
+        return self.shape[0]
+
+    @property
+    def mode(self):
+        return 'L' if len(self.shape) == 2 else {3: 'RGB', 4: 'RGBA'}[self.shape[2]]
+
+    def tobytes(self):
+        return str(self.data)
+
+    def as_PIL(self):
+        """ A Pillow.Image of the pixels - sharing the buffer for L/RGBA, a copy for RGB. """
+
+        if self.mode == 'RGB':
+            return Image.frombytes(self.mode, (self.width, self.height), self.tobytes())
+        return Image.frombuffer(self.mode, (self.width, self.height), self.data, 'raw', self.mode, 0, 1)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return "<PixelView {0} {1}>".format(self.mode, 'x'.join(str(x) for x in self.shape))
+
+
+def RGBA_image(gia, bitmap_data, mask=None, img_rect=None, bitmap_rect=None, region=None):
+    """ Full image-size RGBA Pillow.Image (or just the part in region), from RGB triples (covering bitmap_rect -
+        default is the region) and a mask (covering img_rect). With no mask, the alpha is 255 wherever there's
+        bitmap, 0 elsewhere.
+    """
+
+    region = region or Rect(0, 0, gia['width'], gia['height'])
+    bitmap_rect = bitmap_rect or region
+
+    bitmap_bytes = string_to_bytes(flatten_RGB(bitmap_data))
+    img_rect_bitmap = Image.frombytes('RGB', (bitmap_rect.width, bitmap_rect.height), bitmap_bytes)
+    img_main = Image.new('RGBA', (region.width, region.height), (0, 0, 0, 0))
+    img_main.paste(img_rect_bitmap, (bitmap_rect.tl_x - region.tl_x, bitmap_rect.tl_y - region.tl_y))
+    img_rect_bitmap.close()
+
     if mask:
-        mask_bits = ''.join([chr(x) for x in mask])
-        new_mask = Image.frombytes('L', (img_rect.width, img_rect.height), mask_bits)
-        img_back = Image.new('L', (pic_width, pic_height))
-        img_back.paste(new_mask, (img_rect.tl_x, img_rect.tl_y))
+        img_back = expand_mask(gia, mask, img_rect, region)
         img_main.putalpha(img_back)
-        new_mask.close()
         img_back.close()
 
-    img_main.save(out_file, 'png')
-    img_main.close()
+    return img_main
+
+
+def npy_header(shape, dtype='|u1'):
+    """ Header of a .npy file (format 1.0) - the array follows it, in C order. numpy.load() reads the whole thing,
+        numpy.load(mmap_mode='r') maps it without reading, and no numpy is needed here to write one.
+    """
+
+    header = "{{'descr': '{0}', 'fortran_order': False, 'shape': {1}, }}".format(dtype, tuple(shape))
+    # magic, version, 2-byte header length, header - padded with spaces (then a newline) to a multiple of 64 bytes
+    header += ' ' * (63 - (10 + len(header)) % 64) + '\n'
+
+    return '\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header
+
+
+def save_RGBA(out_file, images, file_format='raw', names=None, sidecar=None, trim=None):
+    """ Saves same-size RGBA Pillow.Images as raw bytes, for something to memory-map - 'raw' is interleaved RGBA
+        rows, one image after another, 'npy' is the same bytes behind a .npy header. One image has shape
+        [height, width, 4], more than one (names is the list of their names) is [images, height, width, 4].
+        Returns a description (shape, offset of the first byte, etc - and trim, if given), which is also written as
+        JSON to sidecar, if given - a file name or file-like object.
+    """
+
+    width, height = images[0].size
+    shape = [height, width, 4] if names is None else [len(images), height, width, 4]
+    header = npy_header(shape) if file_format == 'npy' else ''
+
+    info = {'format': file_format, 'dtype': 'uint8', 'mode': 'RGBA', 'width': width, 'height': height,
+            'channels': 4, 'shape': shape, 'offset': len(header)}
+    if names is not None:
+        info['layers'] = names
+    if trim:
+        info['trim'] = trim
+
+    out_fp = open(out_file, 'wb') if isinstance(out_file, str) else out_file
+    try:
+        out_fp.write(header)
+        for img in images:
+            out_fp.write(img.tobytes())
+    finally:
+        if isinstance(out_file, str):
+            out_fp.close()
+
+    if sidecar:
+        write_json(sidecar, info)
+
+    return info
+
+
+def write_json(out_file, info):
+    """ Writes a sidecar - info as (readable) JSON, to a file name or file-like object. """
+
+    out_fp = open(out_file, 'wb') if isinstance(out_file, str) else out_file
+    try:
+        out_fp.write(json.dumps(info, indent=2, separators=(',', ': '), sort_keys=True) + '\n')
+    finally:
+        if isinstance(out_file, str):
+            out_fp.close()
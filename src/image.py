@@ -7,39 +7,68 @@ Note the self.gia attribute (for General Image Attributes, the PSP file's data b
 variables that can be considered "global" (originally they were global, then I refactored them out) to
 the image. For some reason, PSP has blocks that need information from other blocks, mostly from the GIA
 block. Also, self.gia gets any command-line arguments that might be relevant (for instance, --verbose).
+
+Everything an image changes is in its own gia and blocks - the module-level tables (default_options,
+block_classes, the structs, etc) are only ever read. So separate PSPImages can be loaded and saved at the
+same time, from different threads. (Just not the *same* PSPImage from two threads at once.)
 """
 
 from layers import *
+from stages import *
 
 default_options = {
     'VERBOSE': False,
     'DEBUG': False,
     'API_FORMAT': True,
+    'SKIP_HIDDEN': True,  # don't decode hidden layers - set False to be able to un-hide them with set_layer_visible()
+    'RECOVER': False,  # skip damaged blocks/layers (listed in .damaged) instead of failing - see load_blocks()
+    'RETAIN': 'all',  # what's kept once the image is loaded - see retention_policies
 }
 
-used_blocks = {blks.PSP_IMAGE_BLOCK:            {'format': general_image_attributes_chunk,    'func': GeneralImage},
-               blks.PSP_LAYER_BANK_BLOCK:       {'format': None,                              'func': LayerBank},
-               blks.PSP_LAYER_BLOCK:            {'format': None,                              'func': Block},
-               blks.PSP_GROUP_EXTENSION_BLOCK:  {'format': group_layer_info_chunk,            'func': Block},
-               blks.PSP_MASK_EXTENSION_BLOCK:   {'format': mask_layer_info_chunk,             'func': Block},
-               blks.PSP_ALPHA_BANK_BLOCK:       {'format': alpha_bank_info_chunk_header,      'func': AlphaBank},
-               }
+# What a PSPImage holds on to, once it's loaded (the RETAIN option):
+#   all       - everything: the file's channel bytes, every layer's bitmap and masks, and the composites
+#   layers    - the same, except the channel bytes, which are dropped as each channel is decoded - still editable
+#   composite - just the final image, the Mask layers and the Alpha channels (which can be the saved Alpha) -
+#               everything else is dropped as soon as the image is composited. No editing, or saving layers.
+retention_policies = ('all', 'layers', 'composite')
+
+# Top-level blocks that need more than the generic Block (see blocks.block_formats for the info-chunks)
+block_classes = {blks.PSP_IMAGE_BLOCK:       GeneralImage,
+                 blks.PSP_LAYER_BANK_BLOCK:  LayerBank,
+                 blks.PSP_ALPHA_BANK_BLOCK:  AlphaBank,
+                 }
+
+# Blocks that can be at the top level of a file - when recovering, anything else is a sub-block of a damaged block
+top_level_blocks = (blks.PSP_IMAGE_BLOCK, blks.PSP_CREATOR_BLOCK, blks.PSP_COLOR_BLOCK, blks.PSP_LAYER_BANK_BLOCK,
+                    blks.PSP_SELECTION_BLOCK, blks.PSP_ALPHA_BANK_BLOCK, blks.PSP_EXTENDED_DATA_BLOCK,
+                    blks.PSP_TUBE_BLOCK, blks.PSP_COMPOSITE_IMAGE_BANK, blks.PSP_TABLE_BANK_BLOCK)
 
 
 class PSPImage(object):
-    """ A PSPImage object can be created with either a file string, or open file pointer. """
+    """ A PSPImage object can be created with either a file string, an open file pointer, or the file's
+        contents (bytes/bytearray/memoryview), which are read in place, without being copied.
+    """
 
     def __init__(self, file_thing, cmd_options=None):
 
-        # Don't really need to copy the default dict, but it's remotely possible the code
-        # might someday support having multiple Images open at once, so...
+        # Each image gets its own copy of the options - its blocks add to it while loading
         full_options = default_options.copy()
         if cmd_options:
             full_options.update(cmd_options)
 
+        if full_options['RETAIN'] not in retention_policies:
+            raise ValueError("RETAIN [{0}] must be one of [{1}]".format(full_options['RETAIN'], ', '.join(retention_policies)))
+
         self.gia = full_options
+        self.gia['damaged'] = []
         self._blocks = []
         self.file_name = None
+        self.closed = False
+
+        # Check if we were passed the image itself, already in memory
+        if is_image_data(file_thing):
+            self._open(BufferReader(file_thing))
+            return
 
         # Check if we were passed a valid filename string, and one that is a .pspimage file
         if isinstance(file_thing, str) and os.path.isfile(file_thing):
@@ -62,16 +91,21 @@ class PSPImage(object):
 
     def _open(self, file_fp):
 
+        # Sockets/pipes can't seek, so the file header is read into memory, and the file size isn't known up front
+        streaming = not is_seekable(file_fp)
+        _, file_header_length = transmute_struct(PSP_file_header)
+        header_fp = BufferReader(read_exactly(file_fp, file_header_length)) if streaming else file_fp
+
         # Quick check that file is correct type, similar to what Pillow does
-        if not accept(file_fp.read(len(valid_file_marker))):
+        if not accept(header_fp.read(len(valid_file_marker))):
             raise TypeError('Not a PSP file')
 
         # Get file size and version numbers
-        file_fp.seek(0, os.SEEK_END)
-        self.file_size = file_fp.tell()
-        file_fp.seek(0, os.SEEK_SET)
+        header_fp.seek(0, os.SEEK_END)
+        self.file_size = header_fp.tell()
+        header_fp.seek(0, os.SEEK_SET)
 
-        file_header = read_chunk(file_fp, PSP_file_header, self.gia['DEBUG'])
+        file_header = read_chunk(header_fp, PSP_file_header, self.gia['DEBUG'])
         self.major_version = file_header['major_version']
         self.minor_version = file_header['minor_version']
 
@@ -82,10 +116,12 @@ class PSPImage(object):
 
         self.gia['major_version'] = self.major_version
         self.gia['minor_version'] = self.minor_version  # Currently always zero, per the specs...
-        self.gia['used_blocks'] = used_blocks
 
         try:
-            self.load_blocks(file_fp)
+            if streaming:
+                self.load_stream_blocks(file_fp)
+            else:
+                self.load_blocks(file_fp)
         except Exception as e:
             err_msg = "File loading error: [{0}]".format(e)
             raise SyntaxError(err_msg)
@@ -93,28 +129,99 @@ class PSPImage(object):
     def load_blocks(self, file_fp):
         """ Reads the top-level blocks only - note that blocks with sub-blocks (such as LayerBank), are
             responsible for reading their own sub-blocks.
+
+            With the RECOVER option, a block that can't be read (a bad header, usually from a wrong block-length
+            in the block before it) is noted in .damaged, and reading carries on from the next good block header -
+            looking first inside the block before, in case its length was too long, then after the damaged one.
+            The General Image Attributes can't be skipped, though - nothing else makes sense without them.
         """
 
-        cur_block = 0
+        _, header_length = transmute_struct(generic_header)
+        last_data_start = file_fp.tell()
+
         while more_blocks(file_fp, self.file_size):
-            new_block_header = read_header(file_fp, generic_header, self.gia['DEBUG'])
-            new_block_id = new_block_header['block_id']
-            block_dict = self.gia['used_blocks'].get(new_block_id)
-            create_block_func = block_dict['func'] if block_dict else Block
-            new_block = create_block_func(file_fp, self.gia, new_block_header)
-            new_block.block_number = cur_block
-            self._blocks.append(new_block)
-            cur_block += 1
-
-            if self.gia['DEBUG']:
-                print ("Appended block %s: %s bytes" % (PSP_Block_ID[new_block.block_id], new_block.block_length))
+            block_start = file_fp.tell()
+            try:
+                new_block_header = read_header(file_fp, generic_header, self.gia['DEBUG'])
+                self.add_block(file_fp, new_block_header)
+                last_data_start = block_start + header_length
+            except Exception as e:
+                if not self.gia['RECOVER'] or 'width' not in self.gia:
+                    raise
+                self.gia['damaged'].append("block at offset [{0}]: {1}".format(block_start, e))
+                if find_block(file_fp, last_data_start, block_start, top_level_blocks, self.file_size) is None and \
+                        find_block(file_fp, block_start + 1, self.file_size, top_level_blocks) is None:
+                    break
+
+    def load_stream_blocks(self, stream_fp):
+        """ Same as load_blocks(), for streams that can't seek/tell. Each top-level block is read with a single
+            read() - the header's block_length says how much - and then parsed (sub-blocks and all) from memory,
+            so only one raw block is buffered at a time. The image ends where the stream does.
+            (RECOVER can still skip damaged layers, but not top-level blocks - a stream can't be searched.)
+        """
+
+        _, header_length = transmute_struct(generic_header)
+
+        while True:
+            header_data = read_exactly(stream_fp, header_length)
+            if not header_data:
+                break
+            new_block_header = read_header(BufferReader(header_data), generic_header, self.gia['DEBUG'])
+            block_data = read_exactly(stream_fp, new_block_header['block_length'])
+            if len(block_data) < new_block_header['block_length']:
+                raise EOFError("stream ended in the middle of a block")
+            self.file_size += header_length + len(block_data)
+            self.add_block(BufferReader(block_data), new_block_header)
+
+    def add_block(self, file_fp, new_block_header):
+
+        new_block_id = new_block_header['block_id']
+        create_block_func = block_classes.get(new_block_id, Block)
+        new_block = create_block_func(file_fp, self.gia, new_block_header)
+        new_block.block_number = len(self._blocks)
+        self._blocks.append(new_block)
+
+        if self.gia['DEBUG']:
+            print ("Appended block %s: %s bytes" % (PSP_Block_ID[new_block.block_id], new_block.block_length))
 
     def get_block(self, block_id):
 
+        if self.closed:
+            raise ValueError('image is closed')
+
         foo = [blk for blk in self._blocks if blk.block_id == block_id]
         foo = foo[0] if foo else None
         return foo
 
+    def close(self):
+        """ Lets go of everything the image holds - the blocks, layers and bitmaps - right away, rather than when
+            the garbage collector gets around to it (the layers refer to each other, so it's not as soon as the
+            PSPImage goes). A file pointer it was opened from is left open. The image can't be used after this.
+        """
+
+        if self.closed:
+            return
+
+        bank = self.get_block(blks.PSP_LAYER_BANK_BLOCK)
+        if bank:
+            bank.release(keep_masks=False)
+        self._blocks = []
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def layer_bank(self, what):
+        """ The LayerBank, for anything that needs every layer - which isn't there with RETAIN = 'composite'. """
+
+        if self.gia['RETAIN'] == 'composite':
+            raise ValueError("can't {0}: only the composite was kept (RETAIN = 'composite')".format(what))
+
+        return self.get_block(blks.PSP_LAYER_BANK_BLOCK)
+
     def list_blocks(self):
 
         print ("\nImage File [{0}]: {1:,} bytes.".format(self.file_name, self.file_size))
@@ -138,68 +245,341 @@ class PSPImage(object):
 
         return new_img
 
-    def save_as_bitmap(self, out_file, mask_num=None):
+    def set_layer_visible(self, layer_num, visible=True):
+        """ Shows/hides a layer, and re-composites just the part of the image it covers.
+            Returns the rectangle of the image that changed (or None).
+        """
+
+        bank = self.layer_bank('edit layers')
+        bank.set_visible(self.layers[layer_num], visible)
+
+        return bank.update()
+
+    def replace_layer_bitmap(self, layer_num, img, position=None):
+        """ Replaces the bitmap of a Raster layer with a Pillow.Image - if it has an Alpha channel, that becomes
+            the layer's rectangle-mask. The image is placed with its top-left corner at position (x, y), or
+            where the layer already was. Returns the rectangle of the image that changed.
+        """
+
+        layer = self.layers[layer_num]
+        if layer.layer_type != layer_types.keGLTRaster:
+            err_msg = "Layer must be of type Raster. Layer[{0}] = {1}".format(layer_num, layer.layer_str)
+            raise TypeError(err_msg)
+
+        tl_x, tl_y = position if position else (layer.abs_rect.tl_x, layer.abs_rect.tl_y)
+        new_rect = Rect(tl_x, tl_y, tl_x + img.width, tl_y + img.height)
+        bitmap = list(img.convert('RGB').getdata())
+        rect_mask_bits = list(img.split()[3].getdata()) if img.mode == 'RGBA' else None
+
+        bank = self.layer_bank('edit layers')
+        bank.replace_bitmap(layer, bitmap, new_rect, rect_mask_bits)
+
+        return bank.update()
+
+    def replace_layer_mask(self, layer_num, img, position=None):
+        """ Replaces a mask with a greyscale Pillow.Image - the rectangle-mask of a Raster layer (must be the same
+            size as the layer), or a Mask layer's mask (placed at position (x, y), or where the mask already was).
+            Returns the rectangle of the image that changed.
+        """
+
+        layer = self.layers[layer_num]
+        if layer.layer_type not in [layer_types.keGLTRaster, layer_types.keGLTMask]:
+            raise TypeError("Layer [{0}] is of type {1}".format(layer_num, layer.layer_str))
+
+        if layer.layer_type == layer_types.keGLTRaster and (img.width, img.height) != (layer.width, layer.height):
+            err_msg = "Mask size {0}x{1} doesn't match layer size {2}x{3}".format(img.width, img.height, layer.width, layer.height)
+            raise ValueError(err_msg)
+
+        tl_x, tl_y = position if position else (layer.abs_rect.tl_x, layer.abs_rect.tl_y)
+        new_rect = Rect(tl_x, tl_y, tl_x + img.width, tl_y + img.height)
+
+        bank = self.layer_bank('edit layers')
+        bank.replace_mask(layer, list(img.convert('L').getdata()), new_rect)
+
+        return bank.update()
+
+    def move_layer(self, layer_num, new_position):
+        """ Moves a layer up/down within its group (or the top level, if it isn't in one) - new_position is
+            counted from the bottom of the group, starting at zero. Note this renumbers the layers.
+            Returns the rectangle of the image that changed.
+        """
+
+        bank = self.layer_bank('edit layers')
+        bank.move(self.layers[layer_num], new_position)
+
+        return bank.update()
+
+    def save_as_bitmap(self, out_file, mask_num=None, stages=None, trim=False, sidecar=None):
+        """ out_file can be a file name, or any writable file-like object (same for the other save-functions).
+            stages are post-processing steps for the image, before it's encoded - stage functions, or names of
+            them (see stages.py) - same for the other save-functions.
+            With trim, only the visible part of the image is saved (see trim_rect()), and where it goes in the
+            full image is written to sidecar (see save_trim()) - and returned. The layers are still composited
+            full-size when the file's loaded (trim_rect() needs what they cover); it's the composite that's cut
+            to the visible part, before it's packed into bytes, run through the stages and encoded.
+        """
+
+        full_rect = Rect(0, 0, self.gia['width'], self.gia['height'])
+        region = self.trim_region(mask_num) if trim else full_rect
+
+        layer_bank = self.get_block(blks.PSP_LAYER_BANK_BLOCK)
+        save_bitmap(out_file, compute_sub_mask(layer_bank.bitmap, full_rect, region), region, load_stages(stages))
+
+        return self.save_trim(out_file, region, sidecar) if trim else None
+
+    def trim_rect(self, mask_num=None):
+        """ The smallest rectangle holding everything visible in the saved image (see save_as_PNG()) - None if
+            nothing is. It starts from rectangles the image already has: with an Alpha channel (mask layer, or the
+            first Alpha channel), the mask's - otherwise, the union of the visible layers' (outside them, there's
+            only the black background). Then the mask (or what the layers cover) is scanned just at the edges of
+            that, in from each side, until something shows (see trim_mask_rect()).
+        """
+
+        full_rect = Rect(0, 0, self.gia['width'], self.gia['height'])
+        mask, img_rect = self.alpha_mask(mask_num)
+        if mask:
+            return trim_mask_rect(mask, img_rect, full_rect)
+
+        bank = self.get_block(blks.PSP_LAYER_BANK_BLOCK)
+        rects = [layer.omega_rect for layer in bank.children
+                 if layer.visible and layer.omega_rect and layer.layer_type != layer_types.keGLTMask]
+        if not rects:
+            return None
+        coverage = bank.canvas.alpha if bank.canvas else bank.coverage
+
+        return trim_mask_rect(coverage, full_rect, find_union_rect(rects))
+
+    def trim_region(self, mask_num=None):
+        """ trim_rect() - or if nothing's visible, one (transparent) pixel, so there's still an image to save. """
+
+        return self.trim_rect(mask_num) or Rect(0, 0, 1, 1)
+
+    def trim_info(self, region):
+        """ Where a trimmed image (region) goes in the full-size one - laid out like a frame in save_atlas()'s
+            frame map. (That's before any stages - a stage that resizes changes the scale.)
+        """
 
         pic_width = self.gia['width']
         pic_height = self.gia['height']
 
-        layer_bank = self.get_block(blks.PSP_LAYER_BANK_BLOCK)
-        save_bitmap(out_file, layer_bank.bitmap, Rect(0, 0, pic_width, pic_height))
+        return {'trimmed': region != Rect(0, 0, pic_width, pic_height),
+                'spriteSourceSize': {'x': region.tl_x, 'y': region.tl_y, 'w': region.width, 'h': region.height},
+                'sourceSize': {'w': pic_width, 'h': pic_height}}
 
-    def save_as_PNG(self, out_file, mask_num=None):
+    def save_trim(self, out_file, region, sidecar=None):
+        """ Writes trim_info() as JSON to sidecar - by default, for a file name, the same name plus .json - and
+            returns it.
+        """
+
+        info = self.trim_info(region)
+        if sidecar is None and isinstance(out_file, str):
+            sidecar = out_file + '.json'
+        if sidecar:
+            write_json(sidecar, info)
+
+        return info
+
+    def alpha_mask(self, mask_num=None):
+        """ (mask, rect) for the Alpha channel of a saved image - the mask_num layer, or the first Alpha channel.
+            (None, None) if there isn't one.
+        """
 
-        layer_bank = self.get_block(blks.PSP_LAYER_BANK_BLOCK)
         alpha_bank = self.get_block(blks.PSP_ALPHA_BANK_BLOCK)
-        layer_count = self.gia['layer_count']
-        mask = None
-        img_rect = None
 
         if mask_num:
-            if mask_num >= layer_count:
-                raise ValueError("Layer [{0}] greater than max layer [{1}]".format(mask_num, layer_count - 1))
-            maybe_mask = layer_bank.sub_blocks[mask_num]
-            if maybe_mask.layer_type not in [layer_types.keGLTRaster, layer_types.keGLTMask]:
-                raise TypeError("Layer [{0}] is of type {1}".format(mask_num, maybe_mask.layer_str))
-            mask = maybe_mask.as_mask
-            img_rect = maybe_mask.rect
+            return self.layer_mask(mask_num)
+
+        # TODO - currently just grabs first channel, could be others - make a parameter?
+        if alpha_bank:
+            first_alpha = alpha_bank.sub_blocks[0]
+            if first_alpha.channel:
+                return first_alpha.channel.uncompressed_data, first_alpha.saved_alpha_rect
+
+        return None, None
+
+    def save_as_PNG(self, out_file, mask_num=None, png=None, stages=None, trim=False, sidecar=None):
+        """ Saves the image as PNG, with a mask layer (or the first Alpha channel) in its Alpha channel -
+            png is a preset name ('fast', 'balanced', 'smallest') or png_options(), for the encoding.
+            With trim, just the visible part is cut from the composite, and encoded - see save_as_bitmap().
+        """
+
+        full_rect = Rect(0, 0, self.gia['width'], self.gia['height'])
+        region = self.trim_region(mask_num) if trim else full_rect
+
+        layer_bank = self.get_block(blks.PSP_LAYER_BANK_BLOCK)
+        mask, img_rect = self.alpha_mask(mask_num)
+
+        png_file = out_file.replace('.bmp', '.png') if isinstance(out_file, str) else out_file
+
+        save_PNG(self.gia, png_file, compute_sub_mask(layer_bank.bitmap, full_rect, region), mask, img_rect, png,
+                 load_stages(stages), region)
+
+        return self.save_trim(png_file, region, sidecar) if trim else None
+
+    def save_as_raw(self, out_file, mask_num=None, layers=False, sidecar=None, stages=None, trim=False):
+        """ Saves the image as raw RGBA bytes (alpha as in save_as_PNG(), or 255), and a JSON sidecar describing
+            them - by default, for a file name, the same name plus .json. With layers, it's every Raster/Mask layer
+            instead, full-size, one after another (see Layer.as_RGBA). Returns the description (see save_RGBA()).
+            With trim, it's just the visible part of the image (every layer cut to the same part), and the
+            description has the trim_info().
+        """
+
+        if sidecar is None and isinstance(out_file, str):
+            sidecar = out_file + '.json'
+
+        return self.save_as_array(out_file, 'raw', mask_num, layers, sidecar, stages, trim)
+
+    def save_as_npy(self, out_file, mask_num=None, layers=False, sidecar=None, stages=None, trim=False):
+        """ Same as save_as_raw(), as a .npy file, [height, width, 4] - or with layers, [layers, height, width, 4].
+            The .npy describes itself, so the sidecar is only written by default with layers, for their names
+            (or with trim, for where it goes).
+        """
+
+        if sidecar is None and (layers or trim) and isinstance(out_file, str):
+            sidecar = out_file + '.json'
+
+        return self.save_as_array(out_file, 'npy', mask_num, layers, sidecar, stages, trim)
+
+    def save_as_array(self, out_file, file_format, mask_num=None, layers=False, sidecar=None, stages=None, trim=False):
+        """ With layers, the stages are run on each layer - and have to leave them all the same size. Whatever mode
+            the stages leave an image in, it's saved as RGBA.
+        """
+
+        full_rect = Rect(0, 0, self.gia['width'], self.gia['height'])
+        region = self.trim_region(mask_num) if trim else full_rect
+        stages = load_stages(stages)
+
+        if layers:
+            self.layer_bank('stack layers')
+            stacked = [layer for layer in self.layers
+                       if layer.layer_type in [layer_types.keGLTRaster, layer_types.keGLTMask] and layer.bitmap]
+            if not stacked:
+                raise ValueError('no Raster/Mask layers to stack')
+            images = [layer.as_RGBA for layer in stacked]
+            names = [layer.layer_name for layer in stacked]
+            if trim:
+                stages = [lambda img: img.crop((region.tl_x, region.tl_y, region.br_x, region.br_y))] + stages
         else:
-            # TODO - currently just grabs first channel, could be others - make a parameter?
-            if alpha_bank:
-                first_alpha = alpha_bank.sub_blocks[0]
-                if first_alpha.channel:
-                    mask = first_alpha.channel.uncompressed_data
-                    img_rect = first_alpha.saved_alpha_rect
+            layer_bank = self.get_block(blks.PSP_LAYER_BANK_BLOCK)
+            mask, img_rect = self.alpha_mask(mask_num)
+            images = [RGBA_image(self.gia, compute_sub_mask(layer_bank.bitmap, full_rect, region), mask, img_rect,
+                                 region=region)]
+            names = None
 
-        png_file = out_file.replace('.bmp', '.png')
+        try:
+            for x, img in enumerate(images):
+                img = apply_stages(img, stages)
+                images[x] = img if img.mode == 'RGBA' else img.convert('RGBA')  # a stage can change the mode
+            if len(set(img.size for img in images)) > 1:
+                raise ValueError('the stages left the layers different sizes - they have to be the same, to stack')
+            return save_RGBA(out_file, images, file_format, names, sidecar, self.trim_info(region) if trim else None)
+        finally:
+            for img in images:
+                img.close()
+
+    def layer_mask(self, mask_num):
+        """ Returns (mask, rect) for a layer to be used as an Alpha channel - a Mask layer as-is, or a Raster
+            layer converted to a mask.
+        """
+
+        layer_bank = self.get_block(blks.PSP_LAYER_BANK_BLOCK)
+        layer_count = self.gia['layer_count']
+
+        if mask_num >= layer_count:
+            raise ValueError("Layer [{0}] greater than max layer [{1}]".format(mask_num, layer_count - 1))
+        maybe_mask = layer_bank.sub_blocks[mask_num]
+        if maybe_mask.layer_type not in [layer_types.keGLTRaster, layer_types.keGLTMask]:
+            raise TypeError("Layer [{0}] is of type {1}".format(mask_num, maybe_mask.layer_str))
+        if maybe_mask.layer_type == layer_types.keGLTRaster:
+            self.layer_bank('use a Raster layer as a mask')
+
+        return maybe_mask.as_mask, maybe_mask.rect
+
+    def alpha_sources(self, mask_nums='all'):
+        """ Returns a list of (name, mask, rect) that can be used as an Alpha channel. For 'all', that's every
+            Mask layer, and every Alpha channel in the file - otherwise, just the listed layer numbers.
+        """
+
+        if mask_nums != 'all':
+            return [(self.layers[x].layer_name, ) + self.layer_mask(x) for x in mask_nums]
+
+        sources = [(layer.layer_name, layer.bitmap, layer.rect) for layer in self.layers
+                   if layer.layer_type == layer_types.keGLTMask and layer.bitmap]
+
+        alpha_bank = self.get_block(blks.PSP_ALPHA_BANK_BLOCK)
+        if alpha_bank:
+            sources.extend([(alpha.alpha_name, alpha.channel.uncompressed_data, alpha.saved_alpha_rect)
+                            for alpha in alpha_bank.sub_blocks if alpha.channel])
+
+        return sources
+
+    def save_mask_variants(self, out_file, mask_nums='all', threads=None, png=None, stages=None):
+        """ Saves one PNG per mask (see alpha_sources()), each with that mask in the Alpha channel, named after
+            out_file plus the mask name - 'ship.png' => 'ship--Mask - hull.png'. The full image is only composited
+            once, and the PNGs are written concurrently. Returns the list of files written.
+            out_file can also be a function, which gets each mask's file name ('Mask - hull.png') and returns
+            a writable file-like object (see out_path()). png is the encoding, as in save_as_PNG().
+        """
+
+        layer_bank = self.get_block(blks.PSP_LAYER_BANK_BLOCK)
 
-        save_PNG(self.gia, png_file, layer_bank.bitmap, mask, img_rect)
+        variants = []
+        for name, mask, img_rect in self.alpha_sources(mask_nums):
+            safe_name = name.replace('/', '_').replace(os.sep, '_')
+            if callable(out_file):
+                variants.append((out_file(safe_name + '.png'), mask, img_rect))
+            else:
+                base_name, ext = os.path.splitext(out_file.replace('.bmp', '.png'))
+                variants.append(("{0}--{1}{2}".format(base_name, safe_name, ext or '.png'), mask, img_rect))
 
-    def save_layers_to_file(self, tmp_dir=None, full_size=True):
+        return save_PNG_variants(self.gia, layer_bank.bitmap, variants, threads, png, load_stages(stages))
+
+    def save_layers_to_file(self, tmp_dir=None, full_size=True, threads=None):
         """ Write out all layer bitmap data as an actual file bitmap, for debugging. Either tmp_dir must be
             supplied, or the original image must have come from a file-string (and a tmp_dir will be
             placed there). If full_size is requested (the default), will expand the layers to full-image size.
+            tmp_dir can also be a function returning file-like objects, instead of a directory - see out_path().
+            The files are written from a pool of threads (see run_threaded()).
         """
 
+        self.layer_bank('save layers')
         new_dir = get_or_create_dir(tmp_dir, self.file_name, 'layers')
 
-        visible_layers = [layer for layer in self.layers if layer.layer_type in [layer_types.keGLTRaster, layer_types.keGLTMask]]
-        for layer in visible_layers:
-            l_name = layer.layer_name + '.bmp'
-            full_name = os.path.join(new_dir, l_name)
+        visible_layers = [layer for layer in self.layers
+                          if layer.layer_type in [layer_types.keGLTRaster, layer_types.keGLTMask] and layer.bitmap]
+        # File-like objects are created up front, so they come out in layer order
+        out_files = [out_path(new_dir, layer.layer_name + '.bmp') for layer in visible_layers]
+
+        def save_one(layer_file):
+            layer, full_name = layer_file
             img = layer.as_XL if full_size else layer.as_PIL
-            img.save(full_name)
+            img.save(full_name, 'bmp')
             img.close()
 
-    def save_blocks_to_file(self, tmp_dir=None):
+        run_threaded(save_one, zip(visible_layers, out_files), threads)
+
+    def save_blocks_to_file(self, tmp_dir=None, kinds=artifact_kinds, threads=None):
         """ Write out all block bitmap data as an actual file bitmap, for debugging. Either tmp_dir must be
             supplied, or the original image must have come from a file-string (and a tmp_dir will be
-            placed there). (block-data = bitmaps/channels/masks)
+            placed there). (block-data = bitmaps/channels/masks) Like save_layers_to_file(), tmp_dir can be a function.
+            kinds picks which files are written (see artifact_kinds) - each layer and alpha channel is written
+            from a pool of threads.
         """
 
+        self.layer_bank('save blocks')
         new_dir = get_or_create_dir(tmp_dir, self.file_name, 'blocks')
 
+        # Group composites are cached as they're rendered - get that done before the threads start
+        if 'merges' in kinds:
+            for layer in self.layers:
+                if layer.layer_type == layer_types.keGLTGroup:
+                    layer.render()
+
+        parts = []
         for b in self._blocks:
-            b.save_block_to_file(new_dir)
+            parts.extend(b.sub_blocks if isinstance(b, (LayerBank, AlphaBank)) else [b])
+
+        run_threaded(lambda part: part.save_block_to_file(new_dir, kinds), parts, threads)
 
     @property
     def doc(self):
@@ -213,9 +593,21 @@ class PSPImage(object):
                   "    .blocks\n" + \
                   "    .layers" + \
                   "    .as_PIL" + \
+                  "    .composite" + \
+                  "    .alpha_views" + \
+                  "    .close()" + \
                   "    .save_layers_to_file(tmp_dir)" + \
-                  "    .save_blocks_to_file(tmp_dir)" + \
-                  "    .mask_to_alpha(layer_num)"
+                  "    .save_blocks_to_file(tmp_dir, kinds, threads)" + \
+                  "    .mask_to_alpha(layer_num)" + \
+                  "    .trim_rect(mask_num)" + \
+                  "    .save_as_PNG(out_file, mask_num, png, stages, trim, sidecar)" + \
+                  "    .save_as_raw(out_file, mask_num, layers, sidecar, stages, trim)" + \
+                  "    .save_as_npy(out_file, mask_num, layers, sidecar, stages, trim)" + \
+                  "    .save_mask_variants(out_file, mask_nums, threads, png, stages)" + \
+                  "    .set_layer_visible(layer_num, visible)" + \
+                  "    .replace_layer_bitmap(layer_num, img, position)" + \
+                  "    .replace_layer_mask(layer_num, img, position)" + \
+                  "    .move_layer(layer_num, new_position)"
 
         return gia_doc
 
@@ -250,12 +642,35 @@ class PSPImage(object):
     def blocks(self):
         return self._blocks
 
+    @property
+    def damaged(self):
+        """ What was skipped while loading with the RECOVER option - a description of each damaged block/layer """
+        return self.gia['damaged']
+
     @property
     def layers(self):
         bank = self.get_block(blks.PSP_LAYER_BANK_BLOCK)
 
         return bank.sub_blocks
 
+    @property
+    def composite(self):
+        """ The combined bitmap, as a PixelView [height, width, 3] - numpy.asarray(pic.composite) doesn't copy it,
+            and edits (set_layer_visible() etc) show up in it.
+        """
+
+        bank = self.get_block(blks.PSP_LAYER_BANK_BLOCK)
+        return bank.composite_view
+
+    @property
+    def alpha_views(self):
+        """ A PixelView for each (non-empty) Alpha channel - see AlphaChannel.view """
+
+        alpha_bank = self.get_block(blks.PSP_ALPHA_BANK_BLOCK)
+        if not alpha_bank:
+            return []
+        return [alpha.view for alpha in alpha_bank.sub_blocks if alpha.channel]
+
     @property
     def as_PIL(self):
         """ Returns a Pillow.Image object, using the file's combined bitmap and width/height.  """
@@ -0,0 +1,224 @@
+"""
+Converting in the background, for programs that can't sit and wait on a conversion - a GUI, or a service with
+its own event loop. open_psp() and export() return a Job right away, and the file reading, parsing, compositing,
+encoding and file writing all happen in a pool of worker threads:
+
+    converter = Converter(workers=2, max_jobs=20)
+    job = converter.open_psp(upload_bytes)
+    job.add_done_callback(lambda job: loop.call_soon_threadsafe(got_image, job))
+
+The pool size is how many images are being worked on (and are in memory) at once. Jobs past that wait their
+turn - holding only what they were given, a file name or the file's bytes - and max_jobs limits how many can be
+waiting, so a burst of uploads gets turned away (Queue.Full), instead of piling up. A job can be cancelled until
+it starts - after that, it runs to the end, but is still marked cancelled, and its result is dropped.
+
+(This is Python 2, so no asyncio - but the callbacks, from the worker thread, are all an event loop needs.)
+"""
+
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from image import *
+
+
+class Job(object):
+    """ One conversion: pending, then running, then done - or cancelled, at any point before it's done. """
+
+    def __init__(self, func, args):
+
+        self.func = func
+        self.args = args
+        self.state = 'pending'
+        self._result = None
+        self._error = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+
+    def run(self):
+
+        with self._lock:
+            if self.state != 'pending':
+                return
+            self.state = 'running'
+
+        try:
+            result, error = self.func(*self.args), None
+        except Exception as e:
+            result, error = None, e
+
+        self._finish('done', result, error)
+
+    def cancel(self):
+        """ Returns False if it's too late (already done) - a running job is marked cancelled, but finishes. """
+
+        return self._finish('cancelled', None, None)
+
+    def _finish(self, state, result, error):
+
+        with self._lock:
+            if self.state in ['done', 'cancelled']:
+                return False
+            self.state = state
+            self._result = result
+            self._error = error
+            callbacks, self._callbacks = self._callbacks, []
+        self._finished.set()
+
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def add_done_callback(self, callback):
+        """ callback(job) is called when the job is done or cancelled - right away, if it already is. """
+
+        with self._lock:
+            if self.state not in ['done', 'cancelled']:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        return self._finished.is_set()
+
+    def cancelled(self):
+        return self.state == 'cancelled'
+
+    def wait(self, timeout=None):
+        """ Returns True if the job finished (or was cancelled) within timeout seconds. """
+
+        return self._finished.wait(timeout)
+
+    def result(self, timeout=None):
+        """ The job's result, waiting for it if needed - or raises whatever the job raised. """
+
+        if not self.wait(timeout):
+            raise RuntimeError("job still running after [{0}] seconds".format(timeout))
+        if self.state == 'cancelled':
+            raise RuntimeError('job was cancelled')
+        if self._error:
+            raise self._error
+        return self._result
+
+    def __repr__(self):
+        return "<Job {0} [{1}]>".format(getattr(self.func, '__name__', self.func), self.state)
+
+
+def export_image(source, out_file, file_format='png', mask_num=None, png=None, stages=None, trim=False):
+    """ Converts a PSPImage (or anything PSPImage() can open) to a BMP/PNG/raw/npy file - which can also be a
+        file-like object - with png as the PNG encoding (see png_options()), after running the image through
+        stages (see stages.py). With trim, it's just the visible part, plus a sidecar (see
+        PSPImage.save_as_bitmap()). Returns out_file.
+        An image it opens itself only keeps what the conversion needs, and is closed when it's done.
+    """
+
+    if isinstance(source, PSPImage):
+        convert_image(source, out_file, file_format, mask_num, png, stages, trim)
+    else:
+        with PSPImage(source, {'RETAIN': 'layers' if mask_num else 'composite'}) as p:
+            convert_image(p, out_file, file_format, mask_num, png, stages, trim)
+
+    return out_file
+
+
+def convert_image(p, out_file, file_format, mask_num, png, stages, trim=False):
+
+    if file_format == 'bmp':
+        p.save_as_bitmap(out_file, mask_num, stages, trim)
+    elif file_format == 'png':
+        p.save_as_PNG(out_file, mask_num, png, stages, trim)
+    elif file_format == 'raw':
+        p.save_as_raw(out_file, mask_num, stages=stages, trim=trim)
+    elif file_format == 'npy':
+        p.save_as_npy(out_file, mask_num, stages=stages, trim=trim)
+    else:
+        raise ValueError("format [{0}] must be one of [bmp, png, raw, npy]".format(file_format))
+
+
+class Converter(object):
+    """ Runs jobs in a pool of `workers` threads (default: one per CPU), with at most max_jobs of them pending
+        or running at once (default: no limit). Any pool with apply_async() will do, instead - a shared one, say.
+        That pool isn't closed by close(), the Converter's own is.
+    """
+
+    def __init__(self, workers=None, max_jobs=None, pool=None):
+
+        self.max_jobs = max_jobs
+        self.own_pool = pool is None
+        self.pool = pool if pool else pool_module.ThreadPool(workers)
+        self.jobs = set()
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        """ Queues func(*args) to run in the pool, and returns its Job - or raises Queue.Full. """
+
+        job = Job(func, args)
+        with self._lock:
+            if self.max_jobs and len(self.jobs) >= self.max_jobs:
+                raise queue.Full("[{0}] jobs already pending".format(len(self.jobs)))
+            self.jobs.add(job)
+        job.add_done_callback(self._forget)
+
+        self.pool.apply_async(job.run)
+        return job
+
+    def _forget(self, job):
+
+        with self._lock:
+            self.jobs.discard(job)
+
+    def open_psp(self, file_thing, cmd_options=None):
+        """ A Job for PSPImage(file_thing) - a file name, file pointer or the file's contents. """
+
+        return self.submit(PSPImage, file_thing, cmd_options)
+
+    def export(self, source, out_file, file_format='png', mask_num=None, png=None, stages=None, trim=False):
+        """ A Job for export_image() - source can be an already-open PSPImage, or something to open. """
+
+        return self.submit(export_image, source, out_file, file_format, mask_num, png, stages, trim)
+
+    def close(self, cancel=False):
+        """ Waits for the jobs to finish - or with cancel, cancels those that haven't started yet. """
+
+        if cancel:
+            with self._lock:
+                pending = list(self.jobs)
+            for job in pending:
+                job.cancel()
+
+        if self.own_pool:
+            self.pool.close()
+            self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+_default_converter = None
+_default_lock = threading.Lock()
+
+
+def default_converter():
+    """ The Converter used by open_psp()/export() - created the first time it's needed. """
+
+    global _default_converter
+
+    with _default_lock:
+        if _default_converter is None:
+            _default_converter = Converter()
+    return _default_converter
+
+
+def open_psp(file_thing, cmd_options=None):
+    return default_converter().open_psp(file_thing, cmd_options)
+
+
+def export(source, out_file, file_format='png', mask_num=None, png=None, stages=None, trim=False):
+    return default_converter().export(source, out_file, file_format, mask_num, png, stages, trim)
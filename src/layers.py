@@ -1,11 +1,12 @@
 import collections
 
+from blends import *
 from blocks import *
-from masks import *
+from canvas import *
 
 
 class Layer(object):
-    def __init__(self, img_fp, gia):
+    def __init__(self, img_fp, gia, parent=None):
 
         self.gia = gia
         header = read_header(img_fp, generic_header)
@@ -27,19 +28,21 @@ class Layer(object):
         self.abs_rect = None
         self.rect_mask_bits = None  # bitmap-list (RGB) for rectangle mask
 
-        self.layer_mask_bits = None  # bitmap-list (greyscale) for entire layer
-        self.layer_scaled_bits = None  # the visible-rectangle portion of the layer-mask (which can be larger)
-        self.layer_mask_rect = None  # rectangle from the grouped layer-mask, if any
-
-        self.omega_mask = []  # Both rect-mask and layer-mask (if any) combined.
+        self.omega_mask = []  # rect-mask, with layer opacity folded in (or the mask itself, for Mask layers)
         self.omega_rect = None
+        self.omega_spans = None  # omega_mask as runs of transparent/opaque/partial pixels, for compositing
 
         self.bitmap = None
 
         self.group_extension = None
         self.mask_extension = None
-        self.grouped = []
+        self.parent = parent  # the Group layer this layer is in, if any
+        self.children = []  # Group layers only - the layers in the group, bottom to top
+        self.composite = None  # Group layers only - Canvas of the children, composited together
+        self.dirty_rect = None  # Group layers only - part of the composite that is out of date
+        self.decoded = True  # False if the channels were skipped (hidden layer)
         self.kludge_coords = None
+        self._views = {}  # PixelViews, with the pixel lists they were packed from (see pixel_view())
 
         # This is my Information Chunk
         chunk_start = read_chunk(img_fp, layer_info_chunk_start)
@@ -50,6 +53,11 @@ class Layer(object):
         self.unused_chunk = read_chunk(img_fp, layer_info_chunk_unused)
         self.layer_type = self.info_chunk['layer_type']
         self.layer_str = PSPLayerType[self.layer_type]
+        self.visible = bool(self.info_chunk['layer_flags'] & layer_props.keVisibleFlag)
+        self.opacity = self.info_chunk['layer_opacity']
+        self.blend_mode = self.info_chunk['blending_mode']
+        self.bitmap_count = 0
+        self.channel_count = 0
 
         if self.gia['DEBUG']:
             print ("working on layer [{0}], type = {1}".format(self.layer_name, self.layer_str))
@@ -84,6 +92,16 @@ class Layer(object):
         self.kludge_fix_info_chunk()
         self.parse_rect_coords()
         self.compute_rectangles()
+
+        # Hidden raster layers never show up in the image, so don't bother decoding them. (Mask layers are
+        # still needed, even when hidden, for selecting an Alpha channel.)
+        if self.layer_type == layer_types.keGLTRaster and not self.shown and self.gia['SKIP_HIDDEN']:
+            if self.gia['VERBOSE'] or self.gia['DEBUG']:
+                print ("INFO: skipping hidden layer [{0}]".format(self.layer_name))
+            self.skip_channels(img_fp)
+            self.decoded = False
+            return
+
         self.process_channels(img_fp)
         self.kludge_fix_bitmap()
 
@@ -197,6 +215,17 @@ class Layer(object):
         if self.layer_type == layer_types.keGLTMask:
             self.bitmap = self.channels[0].uncompressed_data
 
+        # The layer has its own references to what it uses - the RGB lists were copied into the bitmap
+        if self.gia['RETAIN'] != 'all':
+            for channel in self.channels:
+                channel.release()
+
+    def skip_channels(self, img_fp):
+
+        for x in range(0, self.channel_count):
+            header = read_header(img_fp, generic_header)
+            skip_block(img_fp, header['block_length'])
+
     def kludge_fix_bitmap(self):
 
         if not self.kludge_coords:
@@ -213,40 +242,116 @@ class Layer(object):
     def generate_layer_mask(self):
         """ There are two different masks that a raster layer might need - a rectangle-mask, and a layer-mask.
             The rectangle-mask is already in the layer. The layer-mask is also in the layer for version 4.0,
-            but grouped with another layer (of type Mask) for version 8.0. Note this has to run after all layers
-            are read, because that layer-mask is in the following layer.
-            Also note that either mask can be larger than the other - the layer could be full-sized, whereas
-            the mask is only a subset of the image, or vice-versa. Or the layer might not be larger/smaller,
-            but just partially overlapping. So I need to compute the intersection of the rectangle-mask
-            and layer-mask.
+            but is a separate layer (of type Mask) for version 8.0 - which masks everything below it in the
+            same group, so that one gets applied to the group's composite (see composite_layers()), not here.
+            For Mask layers, this just gets the mask ready for compositing.
         """
 
-        if self.layer_type != layer_types.keGLTRaster:
+        if self.layer_type == layer_types.keGLTMask and self.bitmap:
+            self.omega_rect = self.abs_rect
+            self.omega_mask = self.bitmap
+            if self.opacity < 255:
+                self.omega_mask = [255 - apply_rect_mask_to_layer(255 - alpha, self.opacity) for alpha in self.bitmap]
+            self.omega_spans = SpanMask(self.omega_mask, self.omega_rect)
             return
 
-        # Get layer-mask, either from same layer (V4), or a grouped layer
-        if self.grouped:
-            self.layer_mask_bits = self.grouped[0].bitmap
-            self.layer_mask_rect = self.grouped[0].abs_rect
+        if self.layer_type != layer_types.keGLTRaster or not self.bitmap:
+            return
 
-        # Combine both the rectangle-mask and layer-mask into a single, Ultimate MASK!
-        # See docs/masks/sample_square_coords.png for visual example of mask-interaction
+        self.omega_mask = self.rect_mask_bits
+        self.omega_rect = self.abs_rect
 
-        if not self.layer_mask_bits or not self.rect_mask_bits:
-            self.omega_mask = self.rect_mask_bits
-            self.omega_rect = self.abs_rect
-            return
+        # Fold layer opacity (and Dissolve) into the mask once here, rather than on every pixel when compositing
+        if self.opacity < 255:
+            if not self.omega_mask:
+                self.omega_mask = [255] * (self.omega_rect.width * self.omega_rect.height)
+            self.omega_mask = [apply_rect_mask_to_layer(alpha, self.opacity) for alpha in self.omega_mask]
+        if self.blend_mode == blend_modes.LAYER_BLEND_DISSOLVE and self.omega_mask:
+            self.omega_mask = dissolve_mask(self.omega_mask, self.layer_number)
 
-        self.omega_rect = find_intersection_rect(self.layer_mask_rect, self.abs_rect)
+        if self.omega_mask:
+            self.omega_spans = SpanMask(self.omega_mask, self.omega_rect)
+        else:
+            self.omega_spans = SpanMask.opaque(self.omega_rect)
 
-        self.layer_scaled_bits = compute_sub_mask(self.layer_mask_bits, self.layer_mask_rect, self.omega_rect)
-        rect_mask_subset = compute_sub_mask(self.rect_mask_bits, self.abs_rect, self.omega_rect)
+    @property
+    def shown(self):
+        """ A layer is only seen if it, and every group it's in, are visible. """
+        if not self.visible:
+            return False
+        return self.parent.shown if self.parent else True
+
+    def render(self):
+        """ Group layers only: composites the children into a Canvas the size of their combined rectangles,
+            and keeps it - later renders reuse it, until invalidate() is called. If only part of it was
+            invalidated (and the children still cover the same rectangle), only that part is re-composited.
+            Returns None if there's nothing visible in the group.
+        """
 
-        for y in range(self.omega_rect.height):
-            for x in range(self.omega_rect.width):
-                pixel_loc = x + y * self.omega_rect.width
-                greyscale_pixel = apply_rect_mask_to_layer(rect_mask_subset[pixel_loc], self.layer_scaled_bits[pixel_loc])
-                self.omega_mask.append(greyscale_pixel)
+        if self.composite and not self.dirty_rect:
+            return self.composite
+
+        rects = [layer.layer_rect for layer in self.children if layer.visible and layer.layer_type != layer_types.keGLTMask]
+        rects = [rect for rect in rects if rect]
+        if not rects:
+            self.composite = None
+            self.dirty_rect = None
+            return None
+
+        group_rect = find_union_rect(rects)
+        if self.composite and self.composite.rect == group_rect:
+            area = find_intersection_rect(self.dirty_rect, group_rect)
+            if area.width > 0 and area.height > 0:
+                self.composite.clear(area)
+                composite_layers(self.composite, self.children, area)
+                y_lo = area.tl_y - group_rect.tl_y
+                y_hi = area.br_y - group_rect.tl_y
+                self.omega_spans.update_rows(self.group_alpha(y_lo, y_hi), y_lo, y_hi)
+        else:
+            self.composite = Canvas(group_rect)
+            composite_layers(self.composite, self.children)
+            self.omega_rect = group_rect
+            self.omega_spans = SpanMask(self.group_alpha(0, group_rect.height), group_rect)
+
+        self.dirty_rect = None
+        return self.composite
+
+    def group_alpha(self, y_lo, y_hi):
+        """ Group layers are blended into their parent using the alpha of their composite, with the group
+            opacity folded in. Returns rows y_lo to y_hi of that.
+        """
+
+        width = self.composite.rect.width
+        alpha = self.composite.alpha[y_lo * width:y_hi * width]
+        if self.opacity < 255:
+            alpha = [apply_rect_mask_to_layer(a, self.opacity) for a in alpha]
+
+        return alpha
+
+    def invalidate(self, rect=None):
+        """ Marks part of the cached composite of this group (and of every group it's in) as out of date -
+            or all of it, if no rectangle is given.
+        """
+
+        if self.layer_type == layer_types.keGLTGroup and self.composite:
+            if rect is None:
+                self.composite = None
+                self.dirty_rect = None
+            else:
+                self.dirty_rect = find_union_rect([self.dirty_rect, rect]) if self.dirty_rect else rect
+
+        if self.parent:
+            self.parent.invalidate(rect)
+
+    @property
+    def layer_rect(self):
+        """ The rectangle this layer covers in the image, once composited. """
+
+        if self.layer_type == layer_types.keGLTGroup:
+            group = self.render()
+            return group.rect if group else None
+
+        return self.abs_rect if self.bitmap else None
 
     @property
     def doc(self):
@@ -258,7 +363,12 @@ class Layer(object):
                   "    .height\n" + \
                   "    .rect\n" + \
                   "    .as_PIL\n" + \
-                  "    .as_XL"
+                  "    .as_XL\n" + \
+                  "    .as_RGBA\n" + \
+                  "    .bitmap_view\n" + \
+                  "    .rect_mask_view\n" + \
+                  "    .omega_view\n" + \
+                  "    .rgba"
 
         return lyr_doc
 
@@ -288,7 +398,7 @@ class Layer(object):
         """ Converts Raster RGB layers to greyscale mask, and Mask layers are... left alone.
         """
 
-        if self.layer_type not in [layer_types.keGLTRaster, layer_types.keGLTMask]:
+        if self.layer_type not in [layer_types.keGLTRaster, layer_types.keGLTMask] or not self.bitmap:
             return None
 
         if self.layer_type == layer_types.keGLTMask:
@@ -306,7 +416,7 @@ class Layer(object):
             a bitmap - Group-layers are skipped.
         """
 
-        if self.layer_type not in [layer_types.keGLTRaster, layer_types.keGLTMask]:
+        if self.layer_type not in [layer_types.keGLTRaster, layer_types.keGLTMask] or not self.bitmap:
             return None
 
         if self.layer_type == layer_types.keGLTMask:
@@ -324,7 +434,7 @@ class Layer(object):
         if the layer *has* a bitmap - Group-layers are skipped.
         """
 
-        if self.layer_type not in [layer_types.keGLTRaster, layer_types.keGLTMask]:
+        if self.layer_type not in [layer_types.keGLTRaster, layer_types.keGLTMask] or not self.bitmap:
             return None
 
         m_type = 'L' if self.layer_type == layer_types.keGLTMask else 'RGB'
@@ -333,6 +443,92 @@ class Layer(object):
 
         return mask_background
 
+    @property
+    def as_RGBA(self):
+        """ Like as_XL, but RGBA - with the layer's mask (rectangle-mask and opacity) as the alpha, and zero alpha
+            outside the layer. Mask layers are grey, and opaque inside their rectangle.
+        """
+
+        rgba = self.rgba
+        if not rgba:
+            return None
+
+        img = Image.new('RGBA', (self.gia['width'], self.gia['height']), (0, 0, 0, 0))
+        img.paste(rgba.as_PIL(), (self.abs_rect.tl_x, self.abs_rect.tl_y))
+        return img
+
+    def release(self, keep_mask=True):
+        """ Drops the layer's pixels, and everything built from them for compositing - once the image has been
+            composited (see the RETAIN option). A Mask layer keeps its bitmap, for an Alpha channel, unless
+            keep_mask is False.
+        """
+
+        for channel in self.channels:
+            channel.release()
+
+        if self.layer_type != layer_types.keGLTMask or not keep_mask:
+            self.bitmap = None
+        self.rect_mask_bits = None
+        self.omega_mask = []
+        self.omega_spans = None
+        self.composite = None
+        self.dirty_rect = None
+        self._views = {}
+
+    def pixel_view(self, name, sources, shape, pack):
+        """ A PixelView of pack(*sources), packed the first time it's asked for - and again only if one of the
+            source lists has been replaced (by an edit - they aren't changed in place).
+        """
+
+        cached = self._views.get(name)
+        if not cached or any(old is not new for old, new in zip(cached[0], sources)):
+            cached = (sources, PixelView(pack(*sources), shape))
+            self._views[name] = cached
+
+        return cached[1]
+
+    @property
+    def bitmap_view(self):
+        """ The layer's bitmap, [height, width, 3] (or [height, width] for Mask layers) - see PixelView. """
+
+        if self.layer_type not in [layer_types.keGLTRaster, layer_types.keGLTMask] or not self.bitmap:
+            return None
+
+        shape = [self.abs_rect.height, self.abs_rect.width]
+        if self.layer_type == layer_types.keGLTRaster:
+            shape.append(3)
+        return self.pixel_view('bitmap', (self.bitmap,), shape, pack_pixels)
+
+    @property
+    def rect_mask_view(self):
+        """ The rectangle-mask, [height, width] - None if the layer doesn't have one. """
+
+        if not self.rect_mask_bits:
+            return None
+        return self.pixel_view('rect_mask', (self.rect_mask_bits,), [self.abs_rect.height, self.abs_rect.width],
+                               pack_pixels)
+
+    @property
+    def omega_view(self):
+        """ The mask the layer is composited with - rectangle-mask and opacity - [height, width] of omega_rect. """
+
+        if not self.omega_mask or self.layer_type == layer_types.keGLTGroup:
+            return None
+        return self.pixel_view('omega', (self.omega_mask,), [self.omega_rect.height, self.omega_rect.width],
+                               pack_pixels)
+
+    @property
+    def rgba(self):
+        """ The layer's bitmap with its omega mask as alpha, [height, width, 4] - Mask layers are grey, and opaque. """
+
+        if self.layer_type not in [layer_types.keGLTRaster, layer_types.keGLTMask] or not self.bitmap:
+            return None
+
+        shape = [self.abs_rect.height, self.abs_rect.width, 4]
+        if self.layer_type == layer_types.keGLTMask:
+            return self.pixel_view('rgba', (self.bitmap,), shape, lambda grey: rgba_bytes(zip(grey, grey, grey)))
+        return self.pixel_view('rgba', (self.bitmap, self.omega_mask), shape, rgba_bytes)
+
     def __repr__(self):
         if self.gia['API_FORMAT']:
             return self.api_repr()
@@ -343,7 +539,7 @@ class Layer(object):
 
         layer_count = ''
         if self.layer_type == layer_types.keGLTGroup:
-            grouped_names = [layer.layer_name for layer in self.grouped]
+            grouped_names = [layer.layer_name for layer in self.children]
             layer_count = ", layers = [{0}], names = {1}".format(
                 self.group_extension.info_chunk['layer_count'], grouped_names)
         block_str = "{0}.{1}[{2}]: {3:,} bytes, channels = [{4}], name = [{5}]{6}"
@@ -358,7 +554,7 @@ class Layer(object):
         block_str = block_str.format(self.layer_number, self.block_length, self.layer_str, self.channel_count, self.layer_name)
 
         if self.layer_type == layer_types.keGLTGroup:
-            groups = [layer.layer_name for layer in self.grouped]
+            groups = [layer.layer_name for layer in self.children]
             block_str += "\n\tGrouped layers: {0}".format(groups)
             return block_str
 
@@ -368,8 +564,8 @@ class Layer(object):
             if self.rect_mask_bits:
                 block_str += "\n\tMask Rect[{0} pixels]: {1}".format(len(self.rect_mask_bits), str(self.rect_mask_bits[:20]))
 
-            if self.grouped:
-                block_str += "\n\tGrouped with:       [{0}]".format(self.grouped[0].layer_name)
+            if self.parent:
+                block_str += "\n\tIn group:           [{0}]".format(self.parent.layer_name)
 
             rect_str = "\n\t{0:20}topleft = ({1}, {2}), bottomright = ({3}, {4}), width/height = {5}/{6}"
 
@@ -397,42 +593,60 @@ class Layer(object):
 
         return block_str
 
-    def save_block_to_file(self, tmp_dir):
-        """ Mainly for debugging, saves all the intermediate layer/mask/bitmaps to a temp dir. """
+    def save_block_to_file(self, tmp_dir, kinds=artifact_kinds):
+        """ Mainly for debugging, saves all the intermediate layer/mask/bitmaps to a temp dir - just the
+            kinds asked for (see artifact_kinds).
+        """
 
-        if self.layer_type != layer_types.keGLTRaster:
+        if self.layer_type == layer_types.keGLTGroup:
+            if 'merges' in kinds and self.render():
+                save_layer_merge_debug(self.gia, tmp_dir, self.layer_name + '--group_merge.bmp',
+                                       self.layer_name + '--group_merge-trans.bmp',
+                                       self.composite.bitmap, self.composite.rect, self.composite.alpha)
             return
 
-        pic_width = self.gia['width']
-        pic_height = self.gia['height']
+        if self.layer_type != layer_types.keGLTRaster or not self.bitmap:
+            return
+
+        if 'layers' in kinds:
+            out_file = out_path(tmp_dir, self.layer_name + '--dbitmap_raw.bmp')
+            save_stuff_to_file(out_file, self.as_PIL, 'bmp')
+
+        if 'masks' in kinds and self.rect_mask_bits:
+            out_file = out_path(tmp_dir, self.layer_name + '--expanded_rect_mask.bmp')
+            save_layer_mask_debug(self.gia, out_file, self.rect_mask_bits, self.abs_rect)
+
+        if 'merges' in kinds:
+            save_layer_merge_debug(self.gia, tmp_dir, self.layer_name + '--merge_layer.bmp',
+                                   self.layer_name + '--merge_layer-trans.bmp',
+                                   self.bitmap, self.omega_rect, self.omega_mask)
 
-        out_file = os.path.join(tmp_dir, self.layer_name + '--dbitmap_raw.bmp')
-        # save_bitmap(out_file, self.bitmap, self.saved_img_rect)
-        save_stuff_to_file(out_file, self.as_PIL, 'bmp')
+        if 'channels' in kinds:
+            for b in self.channels:
+                func = getattr(b, 'save_block_to_file', None)
+                if func:
+                    func(tmp_dir, self.layer_name, self.width, self.height)
 
-        if self.rect_mask_bits:
-            expanded_rect_mask_bits = expand_rect_mask_debug(self.gia, self.rect_mask_bits, self.abs_rect)
-            out_file = os.path.join(tmp_dir, self.layer_name + '--expanded_rect_mask.bmp')
-            save_rect_mask_debug(out_file, expanded_rect_mask_bits, Rect(0, 0, pic_width, pic_height))
 
-        if self.layer_mask_bits:
-            out_file = os.path.join(tmp_dir, self.layer_name + '-group_layer_mask.bmp')
-            full_mask = expand_rect_mask_debug(self.gia, self.layer_mask_bits, self.layer_mask_rect)
-            save_rect_mask_debug(out_file, full_mask, Rect(0, 0, pic_width, pic_height))
-            out_file = os.path.join(tmp_dir, self.layer_name + '-group_layer_rect.bmp')
-            save_rect_mask_debug(out_file, self.layer_mask_bits, self.layer_mask_rect)
-            out_file = os.path.join(tmp_dir, self.layer_name + '-layer_scaled.bmp')
-            save_rect_mask_debug(out_file, self.layer_scaled_bits, self.omega_rect)
-            out_file = os.path.join(tmp_dir, self.layer_name + '-layer_final.bmp')
-            save_rect_mask_debug(out_file, self.omega_mask, self.omega_rect)
+def composite_layers(canvas, layers, clip=None):
+    """ Composites a list of layers (bottom to top) onto a Canvas. Raster layers, and the composites of Group
+        layers, are blended in with their own mask/opacity and blending mode. A Mask layer masks everything
+        below it in the list.
+    """
 
-        out_file = os.path.join(tmp_dir, self.layer_name + '--merge_layer.bmp')
-        save_layer_merge_debug(self.gia, out_file, self.bitmap, self.omega_rect, self.omega_mask)
+    for layer in layers:
+        if not layer.visible:
+            continue
 
-        for b in self.channels:
-            func = getattr(b, 'save_block_to_file', None)
-            if func:
-                func(tmp_dir, self.layer_name, self.width, self.height)
+        if layer.layer_type == layer_types.keGLTMask:
+            if layer.omega_spans:
+                canvas.apply_mask(layer.omega_spans, clip)
+        elif layer.layer_type == layer_types.keGLTGroup:
+            group = layer.render()
+            if group:
+                canvas.blend(group.rect, group.bitmap, layer.omega_spans, get_blend_kernel(layer.blend_mode), clip)
+        elif layer.layer_type == layer_types.keGLTRaster and layer.bitmap:
+            canvas.blend(layer.omega_rect, layer.bitmap, layer.omega_spans, get_blend_kernel(layer.blend_mode), clip)
 
 
 class LayerBank(Block):
@@ -440,10 +654,45 @@ class LayerBank(Block):
         pass
 
     def read_any_sub_blocks(self, img_fp):
+        """ Reads the layers, and builds the layer-tree as it goes - a Group layer comes just before the layers
+            in it (its group_extension has the count), and any of those can be a Group in turn.
+        """
+
         layer_count = self.gia['layer_count']
+        self.children = []  # top level of the layer-tree, bottom to top
+        self.dirty_rect = None  # part of the image that needs re-compositing, after an edit
+        self.packed = None  # the bitmap as bytes, once composite_view has been asked for - kept up to date after that
+        open_groups = []  # [group, layers still to come] for each group being read
+        bank_end = img_fp.tell() + self.block_length
 
         for x in range(0, layer_count):
-            sub_block = Layer(img_fp, self.gia)
+            parent = open_groups[-1][0] if open_groups else None
+            layer_start = img_fp.tell()
+            try:
+                sub_block = Layer(img_fp, self.gia, parent)
+            except Exception as e:
+                # With RECOVER, a damaged layer is left out (it still counts, for the group it was in)
+                if not self.gia['RECOVER']:
+                    raise
+                self.gia['damaged'].append("layer {0} at offset [{1}]: {2}".format(x, layer_start, e))
+                sub_block = None
+                if find_block(img_fp, layer_start + 1, bank_end, [blks.PSP_LAYER_BLOCK]) is None:
+                    img_fp.seek(bank_end)
+                    break
+
+            siblings = parent.children if parent else self.children
+            if open_groups:
+                open_groups[-1][1] -= 1
+            if not sub_block:
+                while open_groups and open_groups[-1][1] <= 0:
+                    open_groups.pop()
+                continue
+            siblings.append(sub_block)
+            if sub_block.layer_type == layer_types.keGLTGroup:
+                open_groups.append([sub_block, sub_block.group_extension.info_chunk['layer_count']])
+            while open_groups and open_groups[-1][1] <= 0:
+                open_groups.pop()
+
             if sub_block.layer_type not in supported_layers:
                 if self.gia['VERBOSE']:
                     print ("WARNING: layer type {0} not supported".format(sub_block.layer_str))
@@ -455,58 +704,179 @@ class LayerBank(Block):
                     PSP_Block_ID[sub_block.block_id], sub_block.block_length, sub_block.layer_name))
 
         self.info_chunk = {'layer_count': layer_count}
-        self.group_layers_and_gen_masks()
+        self.generate_masks()
         self.combine_layers()
 
-    def group_layers_and_gen_masks(self):
-        """ File format 4 stores a full-layer mask (not rect-mask) in the same layer, as a channel, whereas
-            File format 8 stores the layer-mask as an entirely separate layer, but grouped. As a result,
-            all of the layers have to be read, before a raster-layer can determine its layer-mask.
-        """
+        if self.gia['RETAIN'] == 'composite':
+            self.release()
+
+    def generate_masks(self):
+        """ Numbers the layers, and gets each layer's mask ready for compositing. """
 
         if self.gia['DEBUG']:
             print ("beginning layer and mask-processing. Layer blocks:")
             for block in self.sub_blocks:
                 print ("\t{0}".format(block.layer_name))
+
         for x, block in enumerate(self.sub_blocks):
             block.layer_number = x
-            if block.layer_type == layer_types.keGLTGroup:
-                group_count = block.group_extension.info_chunk['layer_count']
-                if group_count != 2:  # For now, only handling case of raster+mask grouped layers, no sub-groups
-                    continue
-
-                bitmap = self.sub_blocks[x + 1]
-                mask = self.sub_blocks[x + 2]
-                bitmap.grouped.append(mask)
-                mask.grouped.append(bitmap)
-
-                block.grouped.append(bitmap)
-                block.grouped.append(mask)
-
-        for block in self.sub_blocks:
             if self.gia['DEBUG']:
                 print ("generating layer-mask for [{0}]".format(block.layer_name))
             block.generate_layer_mask()
 
     def combine_layers(self):
         """ Builds up a bitmap from all layers, one at a time, starting with the bottom layer. So transparency masks
-        are applied to the lowest level that is visible.
+        are applied to the lowest level that is visible. Each Group layer is composited into its own Canvas first
+        (kept for later renders), which is then blended in like a single layer. The result is flattened onto
+        a black background.
         """
 
         pic_width = self.gia['width']
+        pic_height = self.gia['height']
 
-        # TODO - going to assume the first layer is the bottom layer, *and* it covered the full width/height - fix later
-        self.bitmap = self.sub_blocks[0].bitmap[:]
+        self.canvas = Canvas(Rect(0, 0, pic_width, pic_height))
+        composite_layers(self.canvas, self.children)
+        self.bitmap = self.canvas.flatten()
+        if self.packed is not None:
+            self.packed[:] = pack_pixels(self.bitmap)  # same size, so views of it stay valid
 
-        for layer in self.sub_blocks[1:]:
-            if layer.layer_type != layer_types.keGLTRaster:
-                continue
+    def release(self, keep_masks=True):
+        """ Drops everything but the final bitmap (and, with keep_masks, the Mask layers' bitmaps) - no more
+            editing after this. Without keep_masks (see PSPImage.close()), the layer-tree is taken apart too, so
+            the layers go as soon as nothing else refers to them, without waiting for the garbage collector.
+        """
+
+        for layer in self.sub_blocks:
+            layer.release(keep_masks)
+        self.coverage = self.canvas.alpha if self.canvas else None  # what the layers cover - see PSPImage.trim_rect()
+        self.canvas = None
+
+        if not keep_masks:
+            for layer in self.sub_blocks:
+                layer.parent = None
+                layer.children = []
+            self.children = []
+            self.sub_blocks = []
+            self.bitmap = None
+            self.packed = None
+            self.coverage = None
+
+    @property
+    def composite_view(self):
+        """ The final image, [height, width, 3] - a PixelView that follows edits (see update()). """
+
+        if self.packed is None:
+            self.packed = pack_pixels(self.bitmap)
+        return PixelView(self.packed, [self.gia['height'], self.gia['width'], 3])
+
+    def siblings_of(self, layer):
+        return layer.parent.children if layer.parent else self.children
+
+    def renumber(self):
+        """ After layers are moved around the tree, rebuild the flat layer-list in file order (each Group layer
+            followed by its contents).
+        """
+
+        def walk(layers):
+            for layer in layers:
+                if layer.layer_type in supported_layers:
+                    yield layer
+                for child in walk(layer.children):
+                    yield child
+
+        self.sub_blocks = list(walk(self.children))
+        for x, block in enumerate(self.sub_blocks):
+            block.layer_number = x
+
+    def is_decoded(self, layer):
+        if layer.layer_type == layer_types.keGLTGroup:
+            return all([self.is_decoded(child) for child in layer.children])
+        return layer.decoded
+
+    def mark_dirty(self, layer, rect):
+        """ Marks a rectangle of the image as out of date, in every group the layer is in, and in the final
+            bitmap. A Mask layer masks everything below it in its group, so that dirties the whole group.
+        """
+
+        full_rect = Rect(0, 0, self.gia['width'], self.gia['height'])
+        if layer.layer_type == layer_types.keGLTMask or not rect:
+            rect = layer.parent.composite.rect if layer.parent and layer.parent.composite else full_rect
+            if layer.layer_type == layer_types.keGLTMask and layer.omega_rect:
+                rect = find_union_rect([rect, layer.omega_rect])
+
+        if layer.parent:
+            layer.parent.invalidate(rect)
+        self.dirty_rect = find_union_rect([self.dirty_rect, rect]) if self.dirty_rect else rect
+
+    def update(self):
+        """ Re-composites just the out-of-date part of the image (reusing the cached composites of any groups
+            that weren't touched). Returns the rectangle that was updated, or None.
+        """
+
+        if not self.dirty_rect:
+            return None
+
+        pic_width = self.gia['width']
+        area = find_intersection_rect(self.dirty_rect, self.canvas.rect)
+        self.dirty_rect = None
+        if area.width <= 0 or area.height <= 0:
+            return None
+
+        self.canvas.clear(area)
+        composite_layers(self.canvas, self.children, area)
+
+        for y in range(area.tl_y, area.br_y):
+            lo = area.tl_x + y * pic_width
+            hi = lo + area.width
+            self.bitmap[lo:hi] = [apply_mask_to_layer((0, 0, 0), pixel, alpha)
+                                  for pixel, alpha in zip(self.canvas.bitmap[lo:hi], self.canvas.alpha[lo:hi])]
+            if self.packed is not None:
+                self.packed[lo * 3:hi * 3] = pack_pixels(self.bitmap[lo:hi])
+
+        return area
+
+    def set_visible(self, layer, visible):
+
+        if visible and not self.is_decoded(layer):
+            err_msg = "Layer [{0}] was hidden when the file was read, so it wasn't decoded - " \
+                      "use cmd_options={{'SKIP_HIDDEN': False}} to edit it".format(layer.layer_name)
+            raise ValueError(err_msg)
+
+        layer.visible = visible
+        self.mark_dirty(layer, layer.layer_rect)
+
+    def replace_bitmap(self, layer, bitmap, rect, rect_mask_bits=None):
+
+        old_rect = layer.layer_rect
+        layer.bitmap = bitmap
+        layer.rect_mask_bits = rect_mask_bits
+        layer.abs_rect = rect
+        layer.decoded = True
+        layer.generate_layer_mask()
+
+        self.mark_dirty(layer, find_union_rect([old_rect, rect]) if old_rect else rect)
+
+    def replace_mask(self, layer, bits, rect):
+        """ For Raster layers, replaces the rectangle-mask (same size as the layer). For Mask layers, replaces
+            the mask itself.
+        """
+
+        old_rect = layer.abs_rect
+        if layer.layer_type == layer_types.keGLTMask:
+            layer.bitmap = bits
+            layer.abs_rect = rect
+        else:
+            layer.rect_mask_bits = bits
+        layer.generate_layer_mask()
+
+        self.mark_dirty(layer, find_union_rect([old_rect, layer.abs_rect]))
+
+    def move(self, layer, new_index):
+        """ Moves a layer to a new position within its own group (or the top level), 0 being the bottom. """
+
+        siblings = self.siblings_of(layer)
+        siblings.remove(layer)
+        siblings.insert(new_index, layer)
+        self.renumber()
 
-            tl_x = layer.omega_rect.tl_x
-            tl_y = layer.omega_rect.tl_y
-            for y in range(layer.omega_rect.height):
-                for x in range(layer.omega_rect.width):
-                    lower_pixel = x + tl_x + (y + tl_y) * pic_width
-                    higher_pixel = x + y * layer.omega_rect.width
-                    transparent_pixel = apply_mask_to_layer(self.bitmap[lower_pixel], layer.bitmap[higher_pixel], layer.omega_mask[higher_pixel])
-                    self.bitmap[lower_pixel] = transparent_pixel
+        self.mark_dirty(layer, layer.layer_rect)
@@ -2,8 +2,76 @@
 Mask computations
 """
 
+import itertools
+
 from utils import Rect
 
+# Run kinds for SpanMask rows
+SPAN_TRANSPARENT = 0
+SPAN_OPAQUE = 1
+SPAN_PARTIAL = 2
+
+
+def span_kind(alpha):
+    if alpha == 0:
+        return SPAN_TRANSPARENT
+    if alpha == 255:
+        return SPAN_OPAQUE
+    return SPAN_PARTIAL
+
+
+class SpanMask(object):
+    """ Run-length version of a greyscale mask. Most masks are almost entirely 0 or 255, with partial
+        values only along the edges, so each row is stored as a list of runs (kind, start, end, alphas).
+        Only partial runs keep their alpha values - the other two kinds are implied by the run-kind.
+    """
+    def __init__(self, bits, rect):
+        self.rect = rect
+        self.rows = []
+        self.update_rows(bits, 0, rect.height)
+
+    def update_rows(self, bits, y_lo, y_hi):
+        """ Re-encodes rows y_lo to y_hi (relative to the rectangle) - bits is the greyscale mask for just those rows. """
+
+        width = self.rect.width
+        new_rows = []
+        for y in range(y_hi - y_lo):
+            row_bits = bits[y * width:(y + 1) * width]
+            runs = []
+            start = 0
+            for kind, group in itertools.groupby(row_bits, span_kind):
+                alphas = list(group)
+                end = start + len(alphas)
+                runs.append((kind, start, end, alphas if kind == SPAN_PARTIAL else None))
+                start = end
+            new_rows.append(runs)
+        self.rows[y_lo:y_hi] = new_rows
+
+    @classmethod
+    def opaque(cls, rect):
+        """ A mask with every pixel fully visible - for layers that have no mask at all. """
+        return cls([255] * (rect.width * rect.height), rect)
+
+    def to_bits(self):
+        """ Expands the runs back into a flat greyscale list. """
+
+        bits = []
+        for runs in self.rows:
+            for kind, start, end, alphas in runs:
+                if kind == SPAN_PARTIAL:
+                    bits.extend(alphas)
+                else:
+                    bits.extend([255 if kind == SPAN_OPAQUE else 0] * (end - start))
+
+        return bits
+
+    @property
+    def run_count(self):
+        return sum([len(runs) for runs in self.rows])
+
+    def __repr__(self):
+        return "SpanMask[{0}]: {1} rows, {2} runs".format(self.rect, len(self.rows), self.run_count)
+
 
 def find_intersection_rect(rect_one, rect_two):
     """ Given two rectangles, find the common section. """
@@ -18,6 +86,15 @@ def find_intersection_rect(rect_one, rect_two):
     return new_rect
 
 
+def find_union_rect(rects):
+    """ Given a list of rectangles, find the smallest one containing them all. """
+
+    new_rect = Rect(min([r.tl_x for r in rects]), min([r.tl_y for r in rects]),
+                    max([r.br_x for r in rects]), max([r.br_y for r in rects]))
+
+    return new_rect
+
+
 def apply_mask_to_layer(dest, source, alpha):
     """
     :param dest: a set of RGB triples (50, 100, 150), the lower bitmap layer that shows through the transparency
@@ -83,40 +160,43 @@ def compute_sub_mask(outer_mask, outer_rect, inner_rect):
     if width == outer_width and height == outer_height:
         return outer_mask
 
+    # Rows are contiguous in the outer mask, so copy a row-slice at a time
     inner_mask = []
     for y in range(height):
-        for x in range(width):
-            new_x = x + tl_x
-            new_y = y + tl_y
-            pixel_loc = new_x + new_y * outer_width
-            new_pixel = outer_mask[pixel_loc]
-            inner_mask.append(new_pixel)
+        row_start = tl_x + (y + tl_y) * outer_width
+        inner_mask.extend(outer_mask[row_start:row_start + width])
 
     return inner_mask
 
 
-def expand_rect_mask_debug(gia, bits, abs_rect):
-    """ Take a rectangle-mask that is smaller than full-size (probably),
-        and expand it to size of the entire image. Purely for debugging output.
-    :param gia: general-image attributes - originally a global, contains height/width, etc
-    :param bits: greyscale bitmap (0, 0, 0, 0, 250, 255, ...)
-    :param abs_rect: outer-border coordinates of rectangle-mask
-    :return: greyscale bitmap, with dimensions matching the entire image (0, 0, 0, 0, 250, 255, ...)
+def trim_mask_rect(mask, mask_rect, rect):
+    """ Shrinks rect to the part of it where a mask (covering mask_rect - zero outside it) isn't zero. Only the
+        edges are scanned: a row/column at a time, in from each side, stopping at the first one with anything in
+        it - so for a mask that fills most of rect, very little of it is looked at. None if it's all zero.
     """
 
-    pic_width = gia['width']
-    pic_height = gia['height']
-
-    black_bitmap = [0 for _ in range(pic_width * pic_height)]
-    tl_x = abs_rect.tl_x
-    tl_y = abs_rect.tl_y
-    rect_width = abs_rect.width
-    rect_height = abs_rect.height
-
-    for y in range(rect_height):
-        for x in range(rect_width):
-            pixel_loc = x + y * rect_width
-            new_pixel_loc = x + tl_x + (y + tl_y) * pic_width
-            black_bitmap[new_pixel_loc] = bits[pixel_loc]
-
-    return black_bitmap
+    area = find_intersection_rect(rect, mask_rect)
+    tl_x, tl_y, br_x, br_y = area.tl_x, area.tl_y, area.br_x, area.br_y
+    width = mask_rect.width
+
+    def row_empty(y):
+        row_start = (y - mask_rect.tl_y) * width - mask_rect.tl_x
+        return not any(mask[row_start + tl_x:row_start + br_x])
+
+    def column_empty(x):
+        return not any(mask[(y - mask_rect.tl_y) * width + x - mask_rect.tl_x] for y in range(tl_y, br_y))
+
+    if tl_x >= br_x:
+        return None
+    while tl_y < br_y and row_empty(tl_y):
+        tl_y += 1
+    while br_y > tl_y and row_empty(br_y - 1):
+        br_y -= 1
+    if tl_y >= br_y:
+        return None
+    while column_empty(tl_x):
+        tl_x += 1
+    while column_empty(br_x - 1):
+        br_x -= 1
+
+    return Rect(tl_x, tl_y, br_x, br_y)
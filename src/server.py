@@ -0,0 +1,134 @@
+"""
+Server mode - instead of starting a new psp_scan (Python, all the imports, argparse) for every file, one
+long-running psp_scan keeps a warm pool of worker processes, and runs conversion jobs as they arrive. A job is
+a line of JSON - the same arguments as the command-line, plus the directory they're relative to:
+
+    {"id": 7, "cwd": "/home/me/art", "args": ["ship.pspimage", "-f", "bmp", "-o", "out"]}
+
+and each result is a line of JSON too, with whatever the job would have printed:
+
+    {"id": 7, "ok": true, "output": "", "error": null}
+
+Jobs come in over a Unix socket (client.py is the other end), with the results in the same order as the jobs on
+that connection - or as lines on stdin, with the results on stdout as they finish.
+
+The jobs themselves are run by the function passed in (cli.run_job), so this doesn't know anything about PSP files.
+"""
+
+import json
+import signal
+import stat
+import threading
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+from archives import *
+
+
+def parse_job(line):
+    """ Returns the job from a line of JSON - or a result with the error, if it isn't one. """
+
+    try:
+        job = json.loads(line)
+        if not isinstance(job, dict) or not isinstance(job.get('args', []), list):
+            raise ValueError('job must be an object, with a list of args')
+    except ValueError as e:
+        return None, {'id': None, 'ok': False, 'output': '', 'error': "bad job: {0}".format(e)}
+
+    return job, None
+
+
+def serve_lines(in_fp, out_fp, run_job, workers=None):
+    """ Runs a job for each line of JSON in in_fp (until it ends), writing each result to out_fp as soon as it's done. """
+
+    lock = threading.Lock()
+
+    def write_result(result):
+        with lock:
+            out_fp.write(json.dumps(result) + '\n')
+            out_fp.flush()
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = []
+        # readline() instead of iterating the file, which reads ahead (and waits) in Python 2
+        for line in iter(in_fp.readline, ''):
+            if not line.strip():
+                continue
+            job, bad_job = parse_job(line)
+            if bad_job:
+                write_result(bad_job)
+                continue
+            pending.append(pool.apply_async(run_job, (job,), callback=write_result))
+
+        for result in pending:
+            result.wait()
+    finally:
+        pool.close()
+        pool.join()
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """ One client connection - runs each job in the worker pool, and sends back the result. """
+
+    def handle(self):
+
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            job, result = parse_job(line)
+            if job:
+                result = self.server.pool.apply_async(self.server.run_job, (job,)).get()
+            self.wfile.write(json.dumps(result) + '\n')
+            self.wfile.flush()
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ A thread per connection (they just wait on the pool), and a pool of worker processes to do the work. """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, run_job, workers=None):
+
+        # A socket left over from a server that was killed is fine to replace - anything else isn't
+        if os.path.exists(socket_path):
+            if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                raise ValueError("[{0}] already exists, and isn't a socket".format(socket_path))
+            os.remove(socket_path)
+
+        self.socket_path = socket_path
+        self.run_job = run_job
+        self.pool = multiprocessing.Pool(workers)
+        socketserver.UnixStreamServer.__init__(self, socket_path, JobHandler)
+
+    def server_bind(self):
+
+        # Only this user can connect - a job can read and write anything this user can
+        old_umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.socket_path, stat.S_IRUSR | stat.S_IWUSR)
+
+    def server_close(self):
+
+        socketserver.UnixStreamServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def serve_socket(socket_path, run_job, workers=None):
+    """ Runs jobs from a Unix socket, until killed - which cleans up the socket file, and the worker processes. """
+
+    server = JobServer(socket_path, run_job, workers)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,197 @@
+"""
+Converting a batch of files in worker processes, without copying the results back. Pickling a decoded image back
+from a worker copies megabytes per image - instead, each worker writes the pixels into a shared-memory segment
+(a file in /dev/shm, on Linux), and sends back just a SharedBuffer: the segment's name, and the image mode and
+size. The caller maps the segment, and Image.frombuffer() (or numpy.frombuffer()) wraps it without copying:
+
+    with SharedBatch(['ship.pspimage', 'hex.pspimage'], layers=True) as batch:
+        for result in batch.results:
+            img = result['composite'].as_PIL()
+
+The segments are removed when the batch is closed - anything still using one keeps it mapped (and readable)
+until it's gone, though. That's on POSIX - Windows won't remove a file that's still mapped, so there it's removed
+once nothing is using it any more (see SharedBuffer.unlink()), or at exit. Composites and Raster layers are RGBA, with an opaque alpha (Pillow can only wrap
+4-byte pixels without copying), Mask layers are L.
+"""
+
+import atexit
+import binascii
+import mmap
+import tempfile
+
+from jobs import *
+
+multiprocessing = LazyModule('multiprocessing')
+
+# Segments that couldn't be removed yet, because they were still mapped (Windows) - see remove_unlinked()
+unlinked_paths = set()
+unlinked_lock = threading.Lock()
+
+
+def shared_dir():
+    """ Where segments go - /dev/shm is memory, not disk. Anywhere else, the temp directory will have to do. """
+
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+class SharedBuffer(object):
+    """ Handle for an image's pixels in a shared-memory segment - just the name, mode and size get pickled. """
+
+    def __init__(self, name, mode, size):
+
+        self.name = name
+        self.mode = mode
+        self.size = size
+        self._map = None
+
+    @classmethod
+    def create(cls, data, mode, size):
+        """ Writes the pixel data to a new segment (only this user can read it), and returns its handle. """
+
+        name = "psp_scan-{0}-{1}".format(os.getpid(), binascii.hexlify(os.urandom(6)))
+        shared = cls(name, mode, size)
+        fd = os.open(shared.path, os.O_RDWR | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o600)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+
+        return shared
+
+    @property
+    def path(self):
+        return os.path.join(shared_dir(), self.name)
+
+    @property
+    def nbytes(self):
+        return self.size[0] * self.size[1] * len(self.mode)  # 4 for RGBA, 1 for L
+
+    @property
+    def buffer(self):
+        """ The segment, mapped into memory (the first time it's used) """
+
+        if self._map is None:
+            with open(self.path, 'r+b') as fp:
+                self._map = mmap.mmap(fp.fileno(), self.nbytes)
+        return self._map
+
+    def as_PIL(self):
+        """ A read-only Pillow.Image using the segment itself as its pixels """
+
+        return Image.frombuffer(self.mode, self.size, self.buffer, 'raw', self.mode, 0, 1)
+
+    def unlink(self):
+        """ Removes the segment. The mapping isn't closed, just dropped - it goes away with the last image using it.
+            If the file can't be removed while it's mapped (Windows), that's tried again by each later unlink(),
+            and at exit.
+        """
+
+        self._map = None
+        with unlinked_lock:
+            unlinked_paths.add(self.path)
+        remove_unlinked()
+
+    def __getstate__(self):
+        return {'name': self.name, 'mode': self.mode, 'size': self.size, '_map': None}
+
+    def __repr__(self):
+        return "<SharedBuffer {0} {1} {2}x{3}>".format(self.name, self.mode, self.size[0], self.size[1])
+
+
+def remove_unlinked():
+    """ Removes the unlinked segments that are gone from memory - any that are still mapped are left for later. """
+
+    with unlinked_lock:
+        for path in list(unlinked_paths):
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+                unlinked_paths.discard(path)
+            except OSError:
+                pass
+
+
+atexit.register(remove_unlinked)
+
+
+def share_image(file_thing, layers=False, stages=None):
+    """ Runs in a worker - loads an image, and returns a dict with a SharedBuffer for the composite, and with
+        layers, one for each Raster/Mask layer that has a bitmap (with its name and rectangle). The composite is
+        run through stages first (names are best - a function has to pickle) - and may change size.
+    """
+
+    p = PSPImage(file_thing, {'RETAIN': 'layers' if layers else 'composite'})
+    made = []
+
+    try:
+        bank = p.get_block(blks.PSP_LAYER_BANK_BLOCK)
+        if stages:
+            img = apply_stages(Image.frombytes('RGBA', (p.width, p.height), bytes(rgba_bytes(bank.bitmap))),
+                               load_stages(stages))
+            made.append(SharedBuffer.create(img.convert('RGBA').tobytes(), 'RGBA', img.size))
+            img.close()
+        else:
+            made.append(SharedBuffer.create(rgba_bytes(bank.bitmap), 'RGBA', (p.width, p.height)))
+        result = {'file_name': p.file_name, 'composite': made[0], 'layers': []}
+
+        for layer in p.layers if layers else []:
+            if layer.layer_type not in [layer_types.keGLTRaster, layer_types.keGLTMask] or not layer.bitmap:
+                continue
+            size = (layer.abs_rect.width, layer.abs_rect.height)
+            if layer.layer_type == layer_types.keGLTMask:
+                made.append(SharedBuffer.create(string_to_bytes(layer.bitmap), 'L', size))
+            else:
+                made.append(SharedBuffer.create(rgba_bytes(layer.bitmap), 'RGBA', size))
+            result['layers'].append({'name': layer.layer_name, 'rect': layer.abs_rect.coords_api, 'buffer': made[-1]})
+    except Exception:
+        for shared in made:
+            shared.unlink()
+        raise
+    finally:
+        p.close()
+
+    return result
+
+
+class SharedBatch(object):
+    """ Converts files (names, or their contents) in a pool of `workers` processes - results has share_image()'s
+        dict for each one, in the same order. If any file fails, everything is cleaned up, and its error raised.
+    """
+
+    def __init__(self, file_things, layers=False, workers=None, stages=None):
+
+        self.results = []
+        error = None
+
+        pool = multiprocessing.Pool(workers)
+        try:
+            pending = [pool.apply_async(share_image, (file_thing, layers, stages)) for file_thing in file_things]
+            for job in pending:
+                try:
+                    self.results.append(job.get())
+                except Exception as e:
+                    error = error or e
+        finally:
+            pool.close()
+            pool.join()
+
+        if error:
+            self.close()
+            raise error
+
+    def buffers(self):
+
+        for result in self.results:
+            yield result['composite']
+            for layer in result['layers']:
+                yield layer['buffer']
+
+    def close(self):
+
+        for shared in self.buffers():
+            shared.unlink()
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
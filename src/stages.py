@@ -0,0 +1,178 @@
+"""
+Post-processing stages - run on each converted image (a Pillow.Image), after compositing and just before it's
+encoded, so resizing, trimming and so on don't mean writing a PNG, then re-opening it for every step. A stage is
+a function that takes a Pillow.Image and returns one (the same one, changed, or a new one):
+
+    pic.save_as_PNG('ship.png', stages=['trim', 'resize=50%', 'pad', 'sharpen'])
+    pic.save_as_PNG('ship.png', stages=[lambda img: img.rotate(90, expand=True)])
+
+Stages named in a list (or with psp_scan --stage) are made by a factory, which gets whatever came after the '='
+(or None), and returns the stage function. The factory is found by name, in this order:
+
+    - the built-in stages (stage_factories, below - register_stage() adds more)
+    - 'some.module:factory' - imported from that module
+    - setuptools entry points in the 'psp_scan.stages' group - so a package can add its own stages:
+
+        entry_points={'psp_scan.stages': ['outline = my_package.stages:outline']}
+
+Names are looked up in the process that does the converting, so they work in worker processes (SharedBatch,
+--serve) where a function might not pickle. Stages may run in several threads at once (save_mask_variants()).
+
+stage_factories isn't locked - register your stages when your module is imported, before anything converts,
+not while other threads might be looking names up.
+"""
+
+from files import *
+
+ImageFilter = LazyModule('PIL.ImageFilter')
+
+STAGE_GROUP = 'psp_scan.stages'
+
+
+def next_power_of_two(value):
+
+    power = 1
+    while power < value:
+        power *= 2
+    return power
+
+
+def parse_size(arg, width, height):
+    """ 'WxH' => (W, H) - either one can be left out ('256x'), to keep the aspect ratio, and 'N%' scales both. """
+
+    try:
+        if arg.endswith('%'):
+            scale = float(arg[:-1]) / 100
+            return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+        new_width, new_height = [int(x) if x else None for x in arg.lower().split('x')]
+    except ValueError:
+        raise ValueError("size must be WxH, Wx, xH or N%: [{0}]".format(arg))
+
+    if not new_width and not new_height:
+        raise ValueError("size must be WxH, Wx, xH or N%: [{0}]".format(arg))
+    new_width = new_width or max(1, int(round(width * float(new_height) / height)))
+    new_height = new_height or max(1, int(round(height * float(new_width) / width)))
+
+    return new_width, new_height
+
+
+def trim_stage(_=None):
+    """ Crops to the visible pixels - the Alpha channel's bounding box, or without one, whatever isn't black.
+        An image with nothing visible is left alone.
+    """
+
+    def trim(img):
+        bbox = img.split()[-1].getbbox() if img.mode == 'RGBA' else img.getbbox()
+        if not bbox or bbox == (0, 0) + img.size:
+            return img
+        return img.crop(bbox)
+
+    return trim
+
+
+def resize_stage(arg):
+    """ Resizes to 'WxH' (see parse_size()), with a Lanczos filter. """
+
+    if not arg:
+        raise ValueError('resize needs a size - WxH, Wx, xH or N%')
+    parse_size(arg, 1, 1)  # bad sizes fail here, not on the first image
+
+    def resize(img):
+        size = parse_size(arg, img.width, img.height)
+        return img if size == img.size else img.resize(size, Image.LANCZOS)
+
+    return resize
+
+
+def pad_stage(arg=None):
+    """ Pads the right and bottom edges out to power-of-two width and height - or, with 'WxH', to at least that
+        size. The padding is transparent (black, without an Alpha channel).
+    """
+
+    if arg:
+        parse_size(arg, 1, 1)
+
+    def pad(img):
+        if arg:
+            size = parse_size(arg, img.width, img.height)
+            size = (max(size[0], img.width), max(size[1], img.height))
+        else:
+            size = (next_power_of_two(img.width), next_power_of_two(img.height))
+        if size == img.size:
+            return img
+        padded = Image.new(img.mode, size)
+        padded.paste(img, (0, 0))
+        return padded
+
+    return pad
+
+
+def sharpen_stage(arg=None):
+    """ Unsharp mask - arg is its strength, in percent (default 150). """
+
+    try:
+        percent = int(arg) if arg else 150
+    except ValueError:
+        raise ValueError("sharpen strength must be a whole number (percent): [{0}]".format(arg))
+
+    def sharpen(img):
+        return img.filter(ImageFilter.UnsharpMask(radius=2, percent=percent, threshold=3))
+
+    return sharpen
+
+
+# name => factory(arg) - see the top of the file
+stage_factories = {
+    'trim': trim_stage,
+    'resize': resize_stage,
+    'pad': pad_stage,
+    'sharpen': sharpen_stage,
+}
+
+
+def register_stage(name, factory):
+    """ Adds a named stage - factory(arg) returns the stage function, arg being the text after 'name=' (or None).
+        Call it at import time, not while conversions are running (stage_factories isn't locked).
+    """
+
+    stage_factories[name] = factory
+
+
+def find_stage_factory(name):
+
+    if name in stage_factories:
+        return stage_factories[name]
+
+    if ':' in name:
+        module_name, func_name = name.split(':', 1)
+        try:
+            return getattr(importlib.import_module(module_name), func_name)
+        except (ImportError, AttributeError) as e:
+            raise ValueError("can't load stage [{0}]: {1}".format(name, e))
+
+    # Entry points need setuptools - without it, only the built-in and module:factory stages are there
+    try:
+        import pkg_resources
+    except ImportError:
+        pkg_resources = None
+    for entry_point in pkg_resources.iter_entry_points(STAGE_GROUP, name) if pkg_resources else []:
+        return entry_point.load()
+
+    raise ValueError("unknown stage [{0}] - built-in stages are [{1}]".format(name, ', '.join(sorted(stage_factories))))
+
+
+def load_stage(spec):
+    """ A stage function, from a spec - 'name', or 'name=arg' - or a stage function, as-is. """
+
+    if callable(spec):
+        return spec
+
+    name, _, arg = spec.partition('=')
+    return find_stage_factory(name)(arg or None)
+
+
+def load_stages(specs):
+    """ load_stage() for a list of specs/functions (or None, for no stages). """
+
+    return [load_stage(spec) for spec in specs or []]
@@ -154,6 +154,38 @@ alpha_channel_chunk = OrderedDict([
     ('channel_count', 'H'),
 ])
 
+# Composite Image Bank Block
+composite_image_bank_info_chunk = OrderedDict([
+    ('chunk_size', 'I'),
+    ('composite_image_count', 'I'),
+])
+
+# One of these for each image in the Composite Image Bank, in the same order as the images
+composite_image_attributes_chunk = OrderedDict([
+    ('chunk_size', 'I'),
+    ('width', 'I'),
+    ('height', 'I'),
+    ('bit_depth', 'H'),
+    ('compression_type', 'H'),
+    ('plane_count', 'H'),
+    ('color_count', 'I'),
+    ('composite_image_type', 'H'),
+])
+
+# JPEG Block - a JPEG Information Chunk, then the JPEG itself (the thumbnail in the Composite Image Bank)
+jpeg_info_chunk = OrderedDict([
+    ('chunk_size', 'I'),
+    ('compressed_length', 'I'),
+    ('uncompressed_length', 'I'),
+    ('image_type', 'H'),
+])
+
+composite_image_info_chunk = OrderedDict([
+    ('chunk_size', 'I'),
+    ('bitmap_count', 'H'),
+    ('channel_count', 'H'),
+])
+
 # Channel Block
 channel_info_chunk = OrderedDict([
     ('chunk_size', 'I'),
@@ -235,6 +267,42 @@ PSPCompression = [
     'PSP_COMP_JPEG',
 ]
 
+# Layer blending modes - LAYER_BLEND_ADJUST is the odd one out, at 255 instead of the next number
+PSPBlendModes = [
+    'LAYER_BLEND_NORMAL',
+    'LAYER_BLEND_DARKEN',
+    'LAYER_BLEND_LIGHTEN',
+    'LAYER_BLEND_LEGACY_HUE',
+    'LAYER_BLEND_LEGACY_SATURATION',
+    'LAYER_BLEND_LEGACY_COLOR',
+    'LAYER_BLEND_LEGACY_LUMINOSITY',
+    'LAYER_BLEND_MULTIPLY',
+    'LAYER_BLEND_SCREEN',
+    'LAYER_BLEND_DISSOLVE',
+    'LAYER_BLEND_OVERLAY',
+    'LAYER_BLEND_HARD_LIGHT',
+    'LAYER_BLEND_SOFT_LIGHT',
+    'LAYER_BLEND_DIFFERENCE',
+    'LAYER_BLEND_DODGE',
+    'LAYER_BLEND_BURN',
+    'LAYER_BLEND_EXCLUSION',
+    'LAYER_BLEND_TRUE_HUE',
+    'LAYER_BLEND_TRUE_SATURATION',
+    'LAYER_BLEND_TRUE_COLOR',
+    'LAYER_BLEND_TRUE_LIGHTNESS',
+]
+
+# Bit-flags in layer_info_chunk_rest['layer_flags']
+PSPLayerProperties = {
+    'keVisibleFlag': 0x01,
+    'keMaskPresenceFlag': 0x02,
+}
+
+PSPCompositeImageType = [
+    'keCITComposite',
+    'keCITThumbnail',
+]
+
 PSPChannelType = [
     'PSP_CHANNEL_COMPOSITE',
     'PSP_CHANNEL_RED',
@@ -267,3 +335,6 @@ blks = enum(*PSP_Block_ID)
 layer_types = enum(*PSPLayerType)
 dibs = enum(*PSPDIBType)
 comps = enum(*PSPCompression)
+blend_modes = enum(*PSPBlendModes, LAYER_BLEND_ADJUST=255)
+layer_props = enum(**PSPLayerProperties)
+composite_types = enum(*PSPCompositeImageType)
@@ -1,18 +1,59 @@
 from __future__ import print_function
 
 import contextlib
+import importlib
+import itertools
 import os
 import string
 import struct
 import sys
+import threading
 import time
 
 from structs import *
 
+# For DEBUG output - the name of each struct, looked up by the struct itself
+struct_names = dict((id(v), k) for k, v in globals().items() if isinstance(v, OrderedDict) and not k.startswith('_'))
+
+
+class LazyModule(object):
+    """ Stands in for a module that's slow to import (Pillow, mostly), and imports it the first time one of its
+        names is used - so just importing psp_scan, or reading a file's header, doesn't pay for it. After that,
+        on_import(module) is called, once - before any other thread gets to use the module.
+    """
+    def __init__(self, module_name, on_import=None):
+        self._module_name = module_name
+        self._on_import = on_import
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    module = importlib.import_module(self._module_name)
+                    if self._on_import:
+                        self._on_import(module)
+                    self._module = module
+
+        return getattr(self._module, attr)
+
+    @property
+    def imported(self):
+        return self._module is not None
+
+
+def sibling_module(module_name):
+    """ Full name of another psp_scan module - the package name depends on how psp_scan was started. """
+
+    package = __name__.rpartition('.')[0]
+    return package + '.' + module_name if package else module_name
+
 
 def accept(prefix):
-    """ Used by Pillow to quickly verify file type (Pillow only used first 16 bytes, however) """
-    return prefix == valid_file_marker
+    """ Used by Pillow to quickly verify file type (Pillow only passes in the first 16 bytes, however) """
+    return len(prefix) >= 16 and valid_file_marker.startswith(prefix)
 
 
 def string_to_hex(data_string):
@@ -23,20 +64,15 @@ def string_to_hex(data_string):
 
 
 def string_to_bytes(data_string):
-    """ Converts a series of characters into bytes. """
+    """ Converts a series of characters (well, byte values) into bytes - bytearray does the whole thing in C. """
 
-    sb = ''.join([chr(x) for x in data_string])
-    return sb
+    return str(bytearray(data_string))
 
 
 def flatten_RGB(pixel_triples):
     """ Converts a list of triples [(0, 255,0), ...] into flat list [0, 255, 0, ...] """
 
-    # TODO - this is a kinda kludgy way of flattening lists, itertools.chain might be better
-    flattened = []
-    _ = [flattened.extend([x[0], x[1], x[2]]) for x in pixel_triples]
-
-    return flattened
+    return list(itertools.chain.from_iterable(pixel_triples))
 
 
 def transmute_struct(block_struct):
@@ -70,8 +106,7 @@ def read_chunk(file_fp, block_struct, DEBUG=False):
     """
 
     if DEBUG:
-        potential_struct = [str(k) for k, v in globals().items() if v == block_struct]
-        some_struct = potential_struct if potential_struct else block_struct
+        some_struct = struct_names.get(id(block_struct), block_struct)
         msg = "struct = [{0}]".format(some_struct)
         print (msg)
 
@@ -90,12 +125,122 @@ def skip_block(file_fp, block_length):
     file_fp.read(block_length)
 
 
+class BufferReader(object):
+    """ A read-only file pointer over bytes/bytearray/memoryview data, for opening images that are already in
+        memory. Unlike StringIO, it doesn't copy the data first - each read() just copies out the bytes asked for.
+    """
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def read(self, size=-1):
+        end = len(self.data) if size is None or size < 0 else min(self.pos + size, len(self.data))
+        chunk = self.data[self.pos:end].tobytes()
+        self.pos = max(end, self.pos)
+        return chunk
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += len(self.data)
+        if offset < 0:
+            raise ValueError("negative seek position [{0}]".format(offset))
+        self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+
+def is_seekable(file_fp):
+    """ Files can seek, sockets/pipes/HTTP responses can't - Python 3 streams just say so, for Python 2 I have to try it. """
+
+    seekable = getattr(file_fp, 'seekable', None)
+    if seekable:
+        return seekable()
+    try:
+        file_fp.seek(file_fp.tell())
+    except (AttributeError, IOError, OSError, ValueError):
+        return False
+    return True
+
+
+def read_exactly(file_fp, size):
+    """ Streams can return less than asked for - keep reading, until there's enough or the stream ends. """
+
+    data = file_fp.read(size)
+    while data and len(data) < size:
+        more = file_fp.read(size - len(data))
+        if not more:
+            break
+        data += more
+
+    return data
+
+
+def is_image_data(file_thing):
+    """ True for an image that's already in memory, rather than a filename or file pointer. """
+
+    if isinstance(file_thing, (bytearray, memoryview, buffer)):
+        return True
+    return isinstance(file_thing, str) and file_thing.startswith(valid_file_marker)
+
+
+def out_path(out_dir, file_name):
+    """ Where a file goes - either a directory, or a function that takes the file name and returns an
+        open (writable) file-like object, for saving to memory/sockets/etc instead of the file system.
+        A file name that would end up outside the directory is a ValueError.
+    """
+
+    if callable(out_dir):
+        return out_dir(file_name)
+
+    # File names can come from archive members, layer names, etc - none of them get to write outside out_dir
+    file_path = os.path.join(out_dir, file_name)
+    if not os.path.abspath(file_path).startswith(os.path.join(os.path.abspath(out_dir), '')):
+        raise ValueError("file name [{0}] is outside the output directory [{1}]".format(file_name, out_dir))
+
+    return file_path
+
+
 def more_blocks(file_fp, file_length):
     if file_fp.tell() < file_length:
         return True
     return False
 
 
+def find_block(file_fp, start, end, block_ids, block_end=None, chunk_size=65536):
+    """ For recovering from a damaged block - scans from start to end for the next ~BK marker that starts a
+        believable header: one of block_ids, with a block that fits before block_end (default: end). Leaves the
+        file pointer at the header and returns its offset, or returns None if there isn't one.
+    """
+
+    _, header_length = transmute_struct(generic_header)
+    marker_length = len(valid_header_identifier)
+    block_end = block_end or end
+
+    pos = start
+    while pos + marker_length <= end:
+        file_fp.seek(pos)
+        data = file_fp.read(min(chunk_size, end - pos))
+
+        found = data.find(valid_header_identifier)
+        while found >= 0:
+            file_fp.seek(pos + found)
+            header = read_chunk(file_fp, generic_header) if pos + found + header_length <= block_end else None
+            if header and header['block_id'] in block_ids and file_fp.tell() + header['block_length'] <= block_end:
+                file_fp.seek(pos + found)
+                return pos + found
+            found = data.find(valid_header_identifier, found + 1)
+
+        if pos + len(data) >= end:
+            break
+        pos += len(data) - (marker_length - 1)  # a marker could straddle two chunks
+
+    return None
+
+
 class Rect(object):
     def __init__(self, a, b, c, d):
         """ top_left_x/y value, bottom_right_x/y value... """
@@ -117,6 +262,13 @@ class Rect(object):
         foo = {'tl_x': self.tl_x, 'tl_y': self.tl_y, 'br_x': self.br_x, 'br_y': self.br_y}
         return foo
 
+    def __eq__(self, other):
+        return isinstance(other, Rect) and \
+            (self.tl_x, self.tl_y, self.br_x, self.br_y) == (other.tl_x, other.tl_y, other.br_x, other.br_y)
+
+    def __ne__(self, other):
+        return not self == other
+
     # TODO fix this, now that coords_api() isn't used
     def __repr__(self):
         return "{0}/{1} - {2}/{3}".format(self.tl_x, self.tl_y, self.br_x, self.br_y)
@@ -125,6 +277,9 @@ class Rect(object):
 # TODO - much refactoring, that expand-flag is kludgy
 def get_or_create_dir(tmp_dir, file_name, prefix, expand=False):
 
+    if callable(tmp_dir):  # not a directory at all - see out_path()
+        return tmp_dir
+
     if not tmp_dir and not file_name:
         raise ValueError('Must supply a temporary directory parameter (or use a filename instead of file pointer)')
 
@@ -0,0 +1,59 @@
+"""
+PNG encoding benchmark - for each file in tests/bmps, how long each preset takes to encode, and how big the PNG
+comes out. The image is read and composited once, up front - each timed run is building the Pillow image, plus
+the encoding (and any reduction). Best of a few runs. Not a unit test, run it by hand, from the top directory:
+
+    python -m tests.bench_png [repeats]
+"""
+
+import io
+import time
+
+from src.__main__ import *
+
+BMP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bmps')
+PRESETS = ['fast', 'balanced', 'smallest']
+
+
+def bench_file(p, repeats=3):
+    """ Returns {preset: (best encode time in seconds, PNG size in bytes)} for one image. """
+
+    results = {}
+    for preset in PRESETS:
+        best = None
+        for _ in range(repeats):
+            out_fp = io.BytesIO()
+            start = time.time()
+            p.save_as_PNG(out_fp, png=preset)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[preset] = (best, len(out_fp.getvalue()))
+
+    return results
+
+
+def main(repeats=3):
+
+    totals = dict((preset, [0.0, 0]) for preset in PRESETS)
+    print ("{0:<22}".format('file') + ''.join("{0:>22}".format(preset) for preset in PRESETS))
+
+    for file_name in sorted(os.listdir(BMP_DIR)):
+        if not file_name.endswith('.pspimage') or file_name.startswith('1'):  # 1x are the unsupported files
+            continue
+        p = PSPImage(os.path.join(BMP_DIR, file_name))
+        results = bench_file(p, repeats)
+
+        row = "{0:<22}".format(file_name.replace('.pspimage', ''))
+        for preset in PRESETS:
+            elapsed, size = results[preset]
+            totals[preset][0] += elapsed
+            totals[preset][1] += size
+            row += "{0:>10.1f} ms {1:>8,}".format(elapsed * 1000, size)
+        print (row)
+
+    print ("{0:<22}".format('total') +
+           ''.join("{0:>10.1f} ms {1:>8,}".format(totals[preset][0] * 1000, totals[preset][1]) for preset in PRESETS))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
@@ -9,10 +9,17 @@ Originally I used namedtuples, but had to constantly do join() on the attributes
 just make a new Class to do all the joining.
 """
 
+import io
 import os
+import shutil
+import stat
+import tempfile
+import threading
 import unittest
 
 from src.cli import *
+from src.client import send_job
+from src.server import JobServer
 
 
 # Data for test_warp_dir():
@@ -133,3 +140,189 @@ class CLI_Tester(unittest.TestCase):
         files_expected = [FileData(*f).files_out for f in files_to_alpha]
 
         self.assertListEqual(files_returned, files_expected)
+
+    def test_mask_list(self):
+        """ The --mask argument takes a layer number, a list of them, or 'all'. """
+
+        self.assertEqual('all', mask_list('all'))
+        self.assertListEqual([3], mask_list('3'))
+        self.assertListEqual([3, 5], mask_list('3,5'))
+        self.assertRaises(argparse.ArgumentTypeError, lambda: mask_list('three'))
+
+    def test_stage_arg(self):
+        """ --stage specs are checked when they're parsed, and kept as they are, in order. """
+
+        args = parse_cli_args(make_parser(), ['x.pspimage', '--stage', 'trim', '--stage', 'resize=50%'])
+        self.assertListEqual(['trim', 'resize=50%'], args.stages)
+        self.assertRaises(argparse.ArgumentTypeError, lambda: stage_arg('blur'))
+        self.assertRaises(argparse.ArgumentTypeError, lambda: stage_arg('no_such_module:stage'))
+
+    def test_trim(self):
+        """ --trim saves just the visible part, with where it goes in a .json next to it - not one per mask. """
+
+        bmp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bmps')
+        out_dir = tempfile.mkdtemp()
+        try:
+            args = parse_cli_args(make_parser(), [os.path.join(bmp_dir, '04_hex_mask.pspimage'), '--trim'])
+            with open_image(args, args.file_in) as p:
+                save_output(p, args, out_dir, 'hex.png')
+                self.assertEqual((84, 96), Image.open(os.path.join(out_dir, 'hex.png')).size)
+                with open(os.path.join(out_dir, 'hex.png.json')) as sidecar:
+                    self.assertEqual({'x': 150, 'y': 25, 'w': 84, 'h': 96}, json.load(sidecar)['spriteSourceSize'])
+                args.mask = 'all'
+                self.assertRaises(ValueError, lambda: save_converted(p, args, os.path.join(out_dir, 'hex.png')))
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_expand(self):
+        """ -x with --artifacts only writes the kinds asked for - and the checkerboard is still the same one. """
+
+        self.assertEqual(('masks', 'merges'), artifact_list('masks,merges'))
+        self.assertRaises(argparse.ArgumentTypeError, lambda: artifact_list('masks,bitmaps'))
+
+        def is_checkered(x, y):
+            return ((x / 16) % 2 == 0) == ((y / 16) % 2 == 0)
+        old_board = ''.join(chr(192 if is_checkered(x, y) else 255) for y in range(40) for x in range(70))
+        self.assertEqual(old_board, checkerboard(70, 40).tobytes())
+
+        bmp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bmps')
+        out_dir = tempfile.mkdtemp()
+        try:
+            args = argparse.Namespace(file_in=os.path.join(bmp_dir, '04_hex_mask.pspimage'), output_dir=out_dir,
+                                      artifacts=artifact_list('masks,merges'))
+            cli_expand_file(args)
+            self.assertListEqual(['blocks.04_hex_mask'], os.listdir(out_dir))
+
+            written = os.listdir(os.path.join(out_dir, 'blocks.04_hex_mask'))
+            self.assertIn('Alpha--Mask #1.bmp', written)
+            self.assertIn('L1_red_hex--expanded_rect_mask.bmp', written)
+            self.assertIn('Group - L2_green_hex--group_merge.bmp', written)
+            self.assertIn('Group - L2_green_hex--group_merge-trans.bmp', written)
+            self.assertIn('L1_red_hex--merge_layer.bmp', written)
+            self.assertIn('L1_red_hex--merge_layer-trans.bmp', written)
+            self.assertFalse([name for name in written if 'chan_' in name or 'dbitmap' in name])
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_null_delimited(self):
+        """ Names split on nulls, even when a name is split across reads - trailing newline from echo ignored. """
+
+        names_fp = io.BytesIO('alpha.pspimage\0beta gamma.pspimage\0\0delta.pspimage\n')
+        self.assertListEqual(['alpha.pspimage', 'beta gamma.pspimage', 'delta.pspimage'],
+                             list(null_delimited(names_fp, chunk_size=5)))
+
+    def test_null_files(self):
+        """ Batch-convert files named on "stdin", check converted names come back on "stdout". """
+
+        bmp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bmps')
+        in_files = [os.path.join(bmp_dir, f) for f in ['00_multi_colors.pspimage', 'no_such_file.pspimage']]
+        args = argparse.Namespace(format='png', mask=None, output_dir=None, verbose=False)
+        out_fp = io.BytesIO()
+
+        cli_null_files(args, io.BytesIO('\0'.join(in_files)), out_fp)
+        out_file = os.path.join(bmp_dir, '00_multi_colors.png')
+        self.assertEqual(out_file + '\0', out_fp.getvalue())
+        self.assertTrue(os.path.isfile(out_file))
+        os.remove(out_file)
+
+    def test_archives(self):
+        """ Convert the files in a zip archive, straight into a tar archive - skipping anything that isn't a
+            .pspimage, or that would end up outside the output directory.
+        """
+
+        bmp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bmps')
+        tmp_dir = tempfile.mkdtemp()
+        in_zip = os.path.join(tmp_dir, 'in.zip')
+        out_tar = os.path.join(tmp_dir, 'out.tar')
+
+        with zipfile.ZipFile(in_zip, 'w') as zip_file:
+            zip_file.write(os.path.join(bmp_dir, '00_multi_colors.pspimage'), 'pics/00_multi_colors.pspimage')
+            zip_file.write(os.path.join(bmp_dir, '01_quadrants.pspimage'), 'win\\01_quadrants.pspimage')
+            with open(os.path.join(bmp_dir, '04_hex_mask.pspimage'), 'rb') as fp:
+                hex_data = fp.read()
+            for bad_name in ['../04_hex_mask.pspimage', '..\\evil.pspimage', 'C:/x.pspimage', 'c:x.pspimage',
+                             '\\\\host\\share\\x.pspimage', '//host/share/x.pspimage', '/abs.pspimage']:
+                zip_file.writestr(bad_name, hex_data)
+            zip_file.writestr('pics/notes.txt', 'not a picture')
+
+        args = argparse.Namespace(input_dir=in_zip, output_dir=out_tar, format='png', mask=None,
+                                  non_recursive=False, verbose=False)
+        cli_many_files(args)
+
+        with tarfile.open(out_tar) as tar_file:
+            self.assertListEqual(['pics/00_multi_colors.png', 'win/01_quadrants.png'], tar_file.getnames())
+            out_img = Image.open(tar_file.extractfile('pics/00_multi_colors.png'))
+            good_img = Image.open(os.path.join(bmp_dir, '00_multi_colors_good.png'))
+            self.assertEqual(good_img.tobytes(), out_img.tobytes())
+
+        self.assertEqual('win/x.pspimage', member_path('win\\x.pspimage'))
+        self.assertEqual(os.path.join(tmp_dir, 'a', 'b.png'), out_path(tmp_dir, os.path.join('a', 'b.png')))
+        for bad_name in ['../x.png', os.path.join('a', '..', '..', 'x.png'), '/tmp/x.png']:
+            self.assertRaises(ValueError, lambda: out_path(tmp_dir, bad_name))
+
+        shutil.rmtree(tmp_dir)
+
+    def test_check(self):
+        """ --check sorts a directory into convertible/unsupported/corrupt (a cut-off file, even if it would half-load). """
+
+        bmp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bmps')
+        tmp_dir = tempfile.mkdtemp()
+        for f_name in ['03_ship.pspimage', '10_rle_comp.pspimage', '11_version_six.pspimage']:
+            shutil.copy(os.path.join(bmp_dir, f_name), tmp_dir)
+        with open(os.path.join(bmp_dir, '04_hex_mask.pspimage'), 'rb') as fp:
+            file_data = fp.read()
+        with open(os.path.join(tmp_dir, 'truncated.pspimage'), 'wb') as fp:
+            fp.write(file_data[:-1000])
+        with open(os.path.join(tmp_dir, 'not_psp.pspimage'), 'wb') as fp:
+            fp.write('just some text, in a file named like a picture')
+
+        args = parse_cli_args(make_parser(), ['--check', '-i', tmp_dir])
+        out_fp = io.BytesIO()
+        totals = cli_check_files(args, out_fp)
+        reports = [json.loads(line) for line in out_fp.getvalue().splitlines()]
+        statuses = {os.path.basename(report['file']): report['status'] for report in reports}
+
+        self.assertEqual({'03_ship.pspimage': 'convertible', '10_rle_comp.pspimage': 'unsupported',
+                          '11_version_six.pspimage': 'unsupported', 'truncated.pspimage': 'corrupt',
+                          'not_psp.pspimage': 'corrupt'}, statuses)
+        self.assertEqual({'convertible': 1, 'unsupported': 2, 'corrupt': 2}, totals)
+        for report in reports:
+            if report['status'] == 'convertible':
+                PSPImage(str(report['file']))
+            else:
+                self.assertTrue(report['reason'])
+
+        shutil.rmtree(tmp_dir)
+
+    def test_server(self):
+        """ Jobs sent over a socket run in the worker pool - same arguments as the command-line, same output. """
+
+        bmp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bmps')
+        tmp_dir = tempfile.mkdtemp()
+        socket_path = os.path.join(tmp_dir, 'psp_scan.sock')
+
+        server = JobServer(socket_path, run_job, workers=1)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+        try:
+            self.assertEqual(0o600, stat.S_IMODE(os.stat(socket_path).st_mode))
+            result = send_job(socket_path, ['00_multi_colors.pspimage', '-o', tmp_dir, '-v'], cwd=bmp_dir, job_id=3)
+            self.assertTrue(result['ok'])
+            self.assertEqual(3, result['id'])
+            self.assertIn('00_multi_colors.png', result['output'])
+            self.assertTrue(os.path.isfile(os.path.join(tmp_dir, '00_multi_colors.png')))
+
+            result = send_job(socket_path, ['--bogus'])
+            self.assertFalse(result['ok'])
+            self.assertIn('unrecognized arguments', result['output'])
+
+            cwd = os.getcwd()
+            self.assertFalse(run_job({'cwd': bmp_dir, 'args': ['no_such_file.pspimage']})['ok'])
+            self.assertEqual(cwd, os.getcwd())
+        finally:
+            server.shutdown()
+            server_thread.join()
+            server.server_close()
+
+        self.assertFalse(os.path.exists(socket_path))
+        shutil.rmtree(tmp_dir)
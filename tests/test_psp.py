@@ -6,6 +6,12 @@ Alpha-compositing algorithm does not exactly match that used by PSP, so some bit
 (either high/low) in the generated bmp/pngs.
 """
 
+import io
+import json
+import pickle
+import re
+import struct
+import threading
 import unittest
 
 from src.__main__ import *
@@ -41,6 +47,15 @@ def cmp_files(first, second):
     return first_len, second_len, mismatches
 
 
+class Trickle(object):
+    """ A socket-like stream - can't seek or tell, and never returns more than a few hundred bytes per read. """
+    def __init__(self, data):
+        self.data_fp = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self.data_fp.read(min(size, 333) if size >= 0 else 333)
+
+
 class PSP_Tester(unittest.TestCase):
     def test_bits_to_value(self):
         """ Read in a file, see if it has some basic numbers correct. """
@@ -96,3 +111,595 @@ class PSP_Tester(unittest.TestCase):
         test_file = os.path.join(BMP_DIR, bad_version_file)
         with open(test_file, 'rb') as fp:
             self.assertRaises(ValueError, lambda: PSPImage(fp))
+
+    def test_span_mask(self):
+        """ Span-encoded masks should expand back to the same bits, with runs split on 0/255/partial. """
+
+        bits = [0, 0, 255, 255, 128, 0,
+                255, 255, 255, 255, 255, 255,
+                10, 20, 0, 0, 0, 255]
+        spans = SpanMask(bits, Rect(4, 4, 10, 7))
+        self.assertListEqual(bits, spans.to_bits())
+        self.assertEqual(4, len(spans.rows[0]))
+        self.assertListEqual([(SPAN_OPAQUE, 0, 6, None)], spans.rows[1])
+        self.assertEqual((SPAN_PARTIAL, 0, 2, [10, 20]), spans.rows[2][0])
+
+    def test_blend_kernels(self):
+        """ Spot-check a few blending modes against their textbook values. """
+
+        lower = [(0, 128, 255), (255, 255, 255)]
+        upper = [(255, 128, 0), (128, 128, 128)]
+
+        self.assertIsNone(get_blend_kernel(blend_modes.LAYER_BLEND_NORMAL))
+        self.assertListEqual([(0, 64, 0), (128, 128, 128)], get_blend_kernel(blend_modes.LAYER_BLEND_MULTIPLY)(lower, upper))
+        self.assertListEqual([(255, 192, 255), (255, 255, 255)], get_blend_kernel(blend_modes.LAYER_BLEND_SCREEN)(lower, upper))
+        self.assertListEqual([(0, 128, 0), (128, 128, 128)], get_blend_kernel(blend_modes.LAYER_BLEND_DARKEN)(lower, upper))
+        self.assertListEqual([(255, 0, 255), (127, 127, 127)], get_blend_kernel(blend_modes.LAYER_BLEND_DIFFERENCE)(lower, upper))
+
+        # threads wanting the same mode at once all get the one table, built once
+        tables = []
+        threads = [threading.Thread(target=lambda: tables.append(lookup_table(blend_modes.LAYER_BLEND_BURN)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(set(id(table) for table in tables)))
+
+    def test_layer_properties(self):
+        """ Compositing honours opacity, blending mode and visibility - patched into a copy of 02_layered.
+            Hidden layers aren't even decoded.
+        """
+
+        file_path = os.path.join(BMP_DIR, '02_layered.pspimage')
+        data = bytearray(open(file_path, 'rb').read())
+        p = PSPImage(file_path)
+        back, blue, red, green = [layer.as_XL for layer in p.layers[:4]]
+
+        def patch(layer_name, field, value):
+            # layer_info_chunk_rest follows the name - layer_type and eight rectangle coords, then these three
+            fields = ['layer_opacity', 'blending_mode', 'layer_flags']
+            data[data.index(layer_name) + len(layer_name) + 33 + fields.index(field)] = value
+
+        patch('layer_1_blue', 'layer_opacity', 128)
+        patch('Layer_2_red', 'blending_mode', blend_modes.LAYER_BLEND_MULTIPLY)
+        patch('Layer_3_green', 'layer_flags', 0)
+        patched = PSPImage(data)
+        img = patched.as_PIL
+
+        def assert_close(expected, actual):
+            self.assertTrue(all(abs(x - y) <= 1 for x, y in zip(expected, actual)), (expected, actual))
+
+        below, above = back.getpixel((30, 5)), blue.getpixel((30, 5))
+        assert_close([(x * 127 + y * 128) / 255 for x, y in zip(below, above)], img.getpixel((30, 5)))
+        below, above = back.getpixel((200, 5)), red.getpixel((200, 5))
+        assert_close([x * y / 255 for x, y in zip(below, above)], img.getpixel((200, 5)))
+
+        hidden = patched.layers[3]
+        self.assertFalse(hidden.visible)
+        self.assertFalse(hidden.decoded)
+        self.assertIsNone(hidden.bitmap)
+        self.assertEqual((0, 192, 0), green.getpixel((150, 100)))
+        self.assertEqual(back.getpixel((150, 100)), img.getpixel((150, 100)))
+
+    def test_layer_tree(self):
+        """ Group layers should hold the layers that follow them, and keep their composite between renders. """
+
+        p = PSPImage(os.path.join(BMP_DIR, '03_ship.pspimage'))
+        bank = p.get_block(blks.PSP_LAYER_BANK_BLOCK)
+
+        top_names = [layer.layer_name for layer in bank.children]
+        self.assertListEqual(['Background', 'Layer_1_red', 'Group - layer_2_mask', 'Group - Layer_3_mask'], top_names)
+
+        group = bank.children[2]
+        self.assertListEqual(['layer_2_mask', 'Mask - layer_2_mask'], [layer.layer_name for layer in group.children])
+        self.assertIs(group, group.children[0].parent)
+
+        composite = group.render()
+        self.assertIs(composite, group.render())
+        self.assertEqual(repr(group.children[0].abs_rect), repr(composite.rect))
+
+    def test_layer_edits(self):
+        """ Editing layers re-composites just part of the image - it should match compositing from scratch. """
+
+        p = PSPImage(os.path.join(BMP_DIR, '04_hex_mask.pspimage'))
+        bank = p.get_block(blks.PSP_LAYER_BANK_BLOCK)
+        original = bank.bitmap[:]
+
+        changed = p.set_layer_visible(1, False)
+        self.assertEqual(Rect(18, 27, 97, 118), changed)
+        p.set_layer_visible(1, True)
+        self.assertListEqual(original, bank.bitmap)
+
+        p.replace_layer_bitmap(3, Image.new('RGBA', (40, 30), (255, 0, 255, 128)), (150, 30))
+        p.move_layer(0, 2)
+        edited = bank.bitmap[:]
+        for layer in p.layers:
+            layer.invalidate()
+        bank.combine_layers()
+        self.assertListEqual(edited, bank.bitmap)
+
+    def test_mask_variants(self):
+        """ One PNG per mask - the Alpha-channel variant should match the normal PNG output. """
+
+        p = PSPImage(os.path.join(BMP_DIR, '04_hex_mask.pspimage'))
+        out_png = os.path.join(BMP_DIR, '04_hex_mask_out.png')
+        written = p.save_mask_variants(out_png)
+        self.assertEqual(3, len(written))
+
+        alpha_png = os.path.join(BMP_DIR, '04_hex_mask_out--Mask #1.png')
+        good_img = Image.open(os.path.join(BMP_DIR, '04_hex_mask_good.png'))
+        out_img = Image.open(alpha_png)
+        self.assertEqual(good_img.tobytes(), out_img.tobytes())
+        good_img.close()
+        out_img.close()
+
+        for fyle in written:
+            os.remove(fyle)
+
+    def test_png_presets(self):
+        """ Every PNG preset decodes to the same pixels - smallest is smallest, and a 2-colour image gets a palette. """
+
+        p = PSPImage(os.path.join(BMP_DIR, '06_game_hex.pspimage'))
+        sizes = {}
+        for preset in ['fast', 'balanced', 'smallest']:
+            out_fp = io.BytesIO()
+            p.save_as_PNG(out_fp, png=preset)
+            sizes[preset] = len(out_fp.getvalue())
+            out_fp.seek(0)
+            out_img = Image.open(out_fp)
+            self.assertEqual(p.as_PIL.tobytes(), out_img.convert('RGB').tobytes())
+            self.assertEqual('P' if preset == 'smallest' else 'RGB', out_img.mode)
+
+        self.assertLess(sizes['smallest'], sizes['balanced'])
+        self.assertLess(sizes['balanced'], sizes['fast'])
+
+        grey = Image.merge('RGB', [Image.linear_gradient('L')] * 3)
+        self.assertEqual('L', reduce_colors(grey).mode)
+        self.assertEqual(grey.tobytes(), reduce_colors(grey).convert('RGB').tobytes())
+
+        self.assertEqual(9, png_options('fast', compress_level=9)['compress_level'])
+        self.assertRaises(ValueError, lambda: png_options('tiny'))
+        self.assertRaises(ValueError, lambda: png_options(strategy='zip'))
+
+    def test_raw_output(self):
+        """ Raw RGBA (and its sidecar) and .npy hold the same pixels as the PNG - .npy headers being what numpy
+            expects. Stacked layers are one full-size RGBA image per layer.
+        """
+
+        p = PSPImage(os.path.join(BMP_DIR, '04_hex_mask.pspimage'))
+        png_fp = io.BytesIO()
+        p.save_as_PNG(png_fp)
+        png_fp.seek(0)
+        png_bytes = Image.open(png_fp).convert('RGBA').tobytes()
+
+        raw_fp, sidecar_fp = io.BytesIO(), io.BytesIO()
+        info = p.save_as_raw(raw_fp, sidecar=sidecar_fp)
+        self.assertEqual(png_bytes, raw_fp.getvalue())
+        self.assertEqual(info, json.loads(sidecar_fp.getvalue()))
+        self.assertEqual([256, 256, 4], info['shape'])
+
+        npy_fp = io.BytesIO()
+        info = p.save_as_npy(npy_fp, layers=True)
+        npy_data = npy_fp.getvalue()
+        header_length = struct.unpack('<H', npy_data[8:10])[0]
+        self.assertEqual('\x93NUMPY\x01\x00', npy_data[:8])
+        self.assertEqual(0, (10 + header_length) % 64)
+        self.assertEqual(10 + header_length, info['offset'])
+        header = eval(npy_data[10:info['offset']])
+        self.assertEqual((7, 256, 256, 4), header['shape'])
+        self.assertEqual(len(info['layers']), 7)
+
+        layer_size = 256 * 256 * 4
+        background = npy_data[info['offset']:info['offset'] + layer_size]
+        self.assertEqual(p.layers[0].as_RGBA.tobytes(), background)
+        self.assertEqual(info['offset'] + 7 * layer_size, len(npy_data))
+
+    def test_pixel_views(self):
+        """ Views are packed once, and shared - the composite view follows edits, layer views are repacked after
+            a layer's pixels are replaced.
+        """
+
+        p = PSPImage(os.path.join(BMP_DIR, '04_hex_mask.pspimage'))
+        composite = p.composite
+        self.assertEqual((256, 256, 3), composite.__array_interface__['shape'])
+        self.assertEqual(p.as_PIL.tobytes(), composite.as_PIL().tobytes())
+        self.assertEqual(256 * 256 * 3, len(memoryview(composite.data)))
+
+        p.set_layer_visible(1, False)
+        self.assertEqual(p.as_PIL.tobytes(), composite.tobytes())
+
+        layer = p.layers[3]
+        rgba = layer.rgba
+        self.assertIs(rgba, layer.rgba)
+        self.assertEqual((layer.abs_rect.height, layer.abs_rect.width, 4), rgba.shape)
+        self.assertEqual(layer.as_PIL.tobytes(), layer.bitmap_view.tobytes())
+        self.assertEqual(layer.omega_view.data, rgba.data[3::4])
+
+        p.replace_layer_bitmap(3, Image.new('RGBA', (40, 30), (255, 0, 255, 128)), (150, 30))
+        self.assertEqual((30, 40, 4), layer.rgba.shape)
+        self.assertEqual('\xff\x00\xff\x80', layer.rgba.tobytes()[:4])
+
+        alpha = p.alpha_views[0]
+        self.assertEqual('L', alpha.mode)
+        alpha_channel = p.get_block(blks.PSP_ALPHA_BANK_BLOCK).sub_blocks[0].channel
+        self.assertEqual(string_to_bytes(alpha_channel.uncompressed_data), alpha.tobytes())
+
+    def test_retention(self):
+        """ Whatever RETAIN drops, the image comes out the same - and close() leaves nothing to use. """
+
+        file_name = os.path.join(BMP_DIR, '04_hex_mask.pspimage')
+        full = PSPImage(file_name)
+        self.assertRaises(ValueError, lambda: PSPImage(file_name, {'RETAIN': 'most'}))
+
+        p = PSPImage(file_name, {'RETAIN': 'layers'})
+        self.assertEqual([None] * 4, [channel.content_chunk for channel in p.layers[3].channels])
+        self.assertEqual(full.as_PIL.tobytes(), p.as_PIL.tobytes())
+        self.assertEqual(full.set_layer_visible(1, False), p.set_layer_visible(1, False))
+        self.assertEqual(full.as_PIL.tobytes(), p.as_PIL.tobytes())
+        self.assertEqual(full.alpha_views[0].tobytes(), p.alpha_views[0].tobytes())
+
+        with PSPImage(file_name, {'RETAIN': 'composite'}) as p:
+            full.set_layer_visible(1, True)
+            self.assertEqual(full.as_PIL.tobytes(), p.as_PIL.tobytes())
+            self.assertIsNone(p.layers[3].bitmap)
+            self.assertEqual(full.layers[4].bitmap, p.layers[4].bitmap)  # Mask layers are kept, for the Alpha channel
+            self.assertIsNone(p.get_block(blks.PSP_LAYER_BANK_BLOCK).canvas)
+            self.assertRaises(ValueError, lambda: p.set_layer_visible(1, False))
+            self.assertRaises(ValueError, lambda: p.save_as_npy(io.BytesIO(), layers=True))
+            self.assertRaises(ValueError, lambda: p.save_as_PNG(io.BytesIO(), 3))
+            composite = p.composite
+
+        self.assertTrue(p.closed)
+        self.assertEqual([], p.blocks)
+        self.assertRaises(ValueError, lambda: p.layers)
+        self.assertEqual(full.as_PIL.tobytes(), composite.tobytes())  # views handed out are still good
+        p.close()
+
+    def test_pillow_plugin(self):
+        """ Image.open() should give the same pixels as PSPImage, whether it finds raw tiles or not. The Composite
+            Image Bank was composited by PSP itself, so (see above) it's only off-by-one/two close to mine.
+        """
+
+        for file_name, tiled, max_diff in [('04_hex_mask', True, 2), ('00_multi_colors', True, 0), ('05_fubar_red', False, 0)]:
+            file_path = os.path.join(BMP_DIR, file_name + '.pspimage')
+            img = Image.open(file_path)
+            self.assertEqual('PSP', img.format)
+            self.assertEqual((file_vals[file_name]['image_width'], file_vals[file_name]['image_height']), img.size)
+            self.assertIsNone(img.im)  # nothing decoded yet
+
+            self.assertEqual(tiled, bool(img.find_tiles()))
+            img.load()
+            good_data = PSPImage(file_path).as_PIL.tobytes()
+            out_data = img.tobytes()
+            self.assertEqual(len(good_data), len(out_data))
+            self.assertLessEqual(max(abs(ord(x) - ord(y)) for x, y in zip(good_data, out_data)), max_diff)
+            img.close()
+
+        # thumbnail() uses the saved JPEG thumbnail (300x300, for this 1024x1024 file) when it's big enough
+        file_path = os.path.join(BMP_DIR, '05_fubar_red.pspimage')
+        good_img = PSPImage(file_path).as_PIL
+        for size, from_jpeg in [((128, 128), True), ((512, 512), False)]:
+            img = Image.open(file_path)
+            img.thumbnail(size)
+            self.assertEqual(size, img.size)
+            self.assertEqual(from_jpeg, bool(img.thumbnail_jpeg))
+            self.assertEqual(good_img.resize(size).getcolors(), img.getcolors())
+            img.close()
+
+    def test_in_memory(self):
+        """ Open from bytes/bytearray/memoryview, and save to file-like objects - nothing touches the disk. """
+
+        file_path = os.path.join(BMP_DIR, '04_hex_mask.pspimage')
+        with open(file_path, 'rb') as fp:
+            file_data = fp.read()
+        good_img = Image.open(os.path.join(BMP_DIR, '04_hex_mask_good.png'))
+
+        for data in [file_data, bytearray(file_data), memoryview(file_data)]:
+            p = PSPImage(data)
+            self.assertEqual(file_vals['04_hex_mask']['layer_count'], p.header['layer_count'])
+            out_fp = io.BytesIO()
+            p.save_as_PNG(out_fp)
+            out_fp.seek(0)
+            self.assertEqual(good_img.tobytes(), Image.open(out_fp).tobytes())
+        good_img.close()
+
+        saved = {}
+
+        def opener(name):
+            saved[name] = io.BytesIO()
+            return saved[name]
+
+        p.save_layers_to_file(opener)
+        self.assertIn('Background.bmp', saved)
+        p.save_mask_variants(opener)
+        self.assertIn('Mask #1.png', saved)
+        p.save_blocks_to_file(opener)
+        self.assertTrue(all(fp.getvalue() for fp in saved.values()))
+
+    def test_stream(self):
+        """ A stream that can't seek parses the same as the file - unless it's cut off. """
+
+        file_path = os.path.join(BMP_DIR, '03_ship.pspimage')
+        with open(file_path, 'rb') as fp:
+            file_data = fp.read()
+
+        p = PSPImage(Trickle(file_data))
+        good = PSPImage(file_path)
+        self.assertEqual(len(file_data), p.file_size)
+        self.assertEqual(good.as_PIL.tobytes(), p.as_PIL.tobytes())
+
+        self.assertRaises(SyntaxError, lambda: PSPImage(Trickle(file_data[:-100])))
+
+    def test_import_time(self):
+        """ Importing psp_scan shouldn't import Pillow (or the other slow modules) - and should stay quick. """
+
+        import subprocess
+        script = "import sys, time; start = time.time(); import src; " \
+                 "print(time.time() - start); print(' '.join(sorted(sys.modules)))"
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=os.path.dirname(BASE_DIR))
+        import_time, modules = output.decode('utf-8').splitlines()
+        modules = modules.split()
+
+        for slow_module in ['PIL', 'PIL.Image', 'argparse', 'multiprocessing', 'tarfile', 'zipfile']:
+            self.assertNotIn(slow_module, modules)
+        self.assertNotIn('src.image', modules)  # nothing until a public name is used
+        self.assertLess(float(import_time), 0.25)  # ~1ms here - the budget's loose, for slow test machines
+
+        import src
+        for name in src.__all__:
+            getattr(src, name)
+        self.assertIs(PSPImage, src.PSPImage)
+        self.assertRaises(AttributeError, lambda: src.Layer)
+
+    def test_jobs(self):
+        """ Jobs run in the pool, past max_jobs are turned away, and can be cancelled until they start. """
+
+        file_path = os.path.join(BMP_DIR, '03_ship.pspimage')
+        release = threading.Event()
+
+        with Converter(workers=1, max_jobs=2) as converter:
+            blocker = converter.submit(release.wait, 10)  # keeps the only worker busy
+            waiting = converter.open_psp(file_path)
+            self.assertRaises(queue.Full, lambda: converter.open_psp(file_path))
+
+            self.assertTrue(waiting.cancel())
+            self.assertTrue(waiting.cancelled())
+            self.assertRaises(RuntimeError, waiting.result)
+            release.set()
+            self.assertTrue(blocker.result(10))
+
+            finished = []
+            out_fp = io.BytesIO()
+            job = converter.export(file_path, out_fp, 'bmp')
+            job.add_done_callback(finished.append)
+            self.assertIs(out_fp, job.result(10))
+            self.assertEqual([job], finished)
+
+            bad_job = converter.open_psp(bytearray('not a PSP file at all'))
+            self.assertRaises(TypeError, lambda: bad_job.result(10))
+
+        good_fp = io.BytesIO()
+        PSPImage(file_path).save_as_bitmap(good_fp)
+        self.assertEqual(good_fp.getvalue(), out_fp.getvalue())
+
+    def test_threads(self):
+        """ Separate images loaded and saved in threads, all at once, come out the same as one at a time. """
+
+        file_paths = [os.path.join(BMP_DIR, f_key) + '.pspimage' for f_key in sorted(file_vals)]
+
+        def convert(file_path):
+            out_fp = io.BytesIO()
+            PSPImage(file_path).save_as_PNG(out_fp)
+            return out_fp.getvalue()
+
+        results = {}
+        threads = [threading.Thread(target=lambda x=x: results.__setitem__(x, convert(file_paths[x])))
+                   for x in range(len(file_paths))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for x, file_path in enumerate(file_paths):
+            self.assertEqual(convert(file_path), results[x])
+
+    def test_shared_batch(self):
+        """ Workers hand back small handles to shared memory, which wrap as images, and are gone after close(). """
+
+        file_paths = [os.path.join(BMP_DIR, f_key) + '.pspimage' for f_key in ['03_ship', '04_hex_mask']]
+
+        with SharedBatch(file_paths, layers=True, workers=2) as batch:
+            self.assertEqual(2, len(batch.results))
+            for file_path, result in zip(file_paths, batch.results):
+                p = PSPImage(file_path)
+                composite = result['composite']
+                self.assertLess(len(pickle.dumps(composite, -1)), 200)
+                self.assertEqual(p.as_PIL.tobytes(), composite.as_PIL().convert('RGB').tobytes())
+
+                layer_images = [layer.as_PIL for layer in p.layers if layer.as_PIL]
+                self.assertEqual(len(layer_images), len(result['layers']))
+                for img, layer in zip(layer_images, result['layers']):
+                    self.assertEqual(img.tobytes(), layer['buffer'].as_PIL().convert(img.mode).tobytes())
+            paths = [shared.path for shared in batch.buffers()]
+            self.assertTrue(all(os.path.exists(path) for path in paths))
+
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+        self.assertRaises(TypeError, lambda: SharedBatch(file_paths + ['not_a_file.txt'], workers=2))
+
+        # Windows won't remove a mapped file - it's left until a later unlink() (or exit) can remove it
+        shared = SharedBuffer.create('\x01' * 16, 'L', (4, 4))
+        img = shared.as_PIL()
+        real_remove = os.remove
+
+        def mapped_remove(path):
+            raise OSError(13, 'still mapped', path)
+        os.remove = mapped_remove
+        try:
+            shared.unlink()
+        finally:
+            os.remove = real_remove
+        self.assertTrue(os.path.exists(shared.path))
+        self.assertIn(shared.path, unlinked_paths)
+        self.assertEqual(16, sum(img.getdata()))
+        img.close()
+        remove_unlinked()
+        self.assertFalse(os.path.exists(shared.path))
+        self.assertNotIn(shared.path, unlinked_paths)
+
+    def test_recover(self):
+        """ With RECOVER, a damaged layer or a wrong block-length is skipped, and the rest of the file still loads. """
+
+        file_path = os.path.join(BMP_DIR, '03_ship.pspimage')
+        with open(file_path, 'rb') as fp:
+            file_data = fp.read()
+        good = PSPImage(file_path)
+
+        # Offsets of the top-level blocks, and the layer blocks
+        blocks = []
+        pos = 36
+        while pos < len(file_data):
+            blocks.append((pos, struct.unpack('<HI', file_data[pos + 4:pos + 10])))
+            pos += 10 + blocks[-1][1][1]
+        layer_offsets = [b.start() for b in re.finditer(valid_header_identifier + '\x04\x00', file_data)]
+
+        # Creator block claims 30 bytes more than it has - the Composite Image Bank after it is found anyway
+        bad_length = bytearray(file_data)
+        creator_start, (_, creator_length) = [b for b in blocks if b[1][0] == blks.PSP_CREATOR_BLOCK][0]
+        bad_length[creator_start + 6:creator_start + 10] = struct.pack('<I', creator_length + 30)
+        self.assertRaises(SyntaxError, lambda: PSPImage(bad_length))
+
+        p = PSPImage(bad_length, {'RECOVER': True})
+        self.assertEqual(1, len(p.damaged))
+        self.assertEqual([b.block_type for b in good.blocks], [b.block_type for b in p.blocks])
+        self.assertEqual(good.as_PIL.tobytes(), p.as_PIL.tobytes())
+
+        # Layer 4's header is gone - it's left out, the other layers are still there
+        bad_layer = bytearray(file_data)
+        bad_layer[layer_offsets[4]:layer_offsets[4] + 4] = 'XXXX'
+        self.assertRaises(SyntaxError, lambda: PSPImage(bad_layer))
+
+        p = PSPImage(bad_layer, {'RECOVER': True})
+        self.assertIn('layer 4', p.damaged[0])
+        self.assertEqual([layer.layer_name for x, layer in enumerate(good.layers) if x != 4],
+                         [layer.layer_name for layer in p.layers])
+        self.assertEqual(good.as_PIL.size, p.as_PIL.size)
+
+    def test_atlas(self):
+        """ Packed sprites don't overlap, or leave their atlas - and each frame holds its sprite's trimmed pixels. """
+
+        packer = MaxRects(100, 100)
+        placed = [packer.insert(w, h) for w, h in [(50, 50), (50, 30), (40, 50), (50, 20), (10, 100), (10, 10)]]
+        self.assertTrue(all(placed[:4] + placed[5:]))
+        self.assertEqual(None, placed[4])  # no free column is that tall, by then
+        for x, one in enumerate(placed):
+            if not one:
+                continue
+            self.assertTrue(one.tl_x >= 0 and one.tl_y >= 0 and one.br_x <= 100 and one.br_y <= 100)
+            for other in placed[x + 1:]:
+                if other:
+                    self.assertTrue(one.br_x <= other.tl_x or other.br_x <= one.tl_x or
+                                    one.br_y <= other.tl_y or other.br_y <= one.tl_y)
+
+        p = PSPImage(os.path.join(BMP_DIR, '04_hex_mask.pspimage'))
+        hex_sprite = Sprite.from_psp('hex', p)
+        self.assertTrue(hex_sprite.trimmed)
+        self.assertEqual(Rect(150, 25, 234, 121), hex_sprite.trim_rect)
+        self.assertEqual(Rect(0, 0, 10, 10), Sprite('rgb', Image.new('RGB', (10, 10))).trim_rect)  # opaque, once RGBA
+
+        squares = [Sprite("square_{0}".format(x), Image.new('RGBA', (60, 60), (x, 0, 0, 255))) for x in range(6)]
+        saved = {}
+
+        def opener(name):
+            saved[name] = io.BytesIO()
+            return saved[name]
+
+        self.assertRaises(ValueError, lambda: save_atlas(opener, 'sprites', squares + [squares[0]]))
+        self.assertEqual({}, saved)
+        frame_map = save_atlas(opener, 'sprites', squares + [hex_sprite], max_size=128, padding=2)
+        self.assertEqual(['sprites-0.png', 'sprites-1.png', 'sprites-2.png', 'sprites.json'], sorted(saved))
+        self.assertEqual(frame_map, json.loads(saved['sprites.json'].getvalue()))
+
+        frame = frame_map['frames']['hex']
+        self.assertEqual({'x': 150, 'y': 25, 'w': 84, 'h': 96}, frame['spriteSourceSize'])
+        saved["sprites-{0}.png".format(frame['atlas'])].seek(0)
+        atlas = Image.open(saved["sprites-{0}.png".format(frame['atlas'])])
+        box = frame['frame']
+        self.assertEqual(hex_sprite.image.tobytes(),
+                         atlas.crop((box['x'], box['y'], box['x'] + box['w'], box['y'] + box['h'])).tobytes())
+        self.assertRaises(ValueError, lambda: pack_sprites([hex_sprite], max_size=64))
+
+    def test_stages(self):
+        """ Stages run on the image before it's encoded, in order - by name, or as functions. """
+
+        p = PSPImage(os.path.join(BMP_DIR, '04_hex_mask.pspimage'))
+        out_fp = io.BytesIO()
+        p.save_as_PNG(out_fp, stages=['trim', 'pad'])
+        out_fp.seek(0)
+        out_img = Image.open(out_fp)
+        self.assertEqual((128, 128), out_img.size)  # trimmed to 84x96 - see test_atlas
+        self.assertEqual(Sprite.from_psp('hex', p).image.tobytes(), out_img.crop((0, 0, 84, 96)).tobytes())
+        self.assertEqual((0, 0, 0, 0), out_img.getpixel((100, 100)))
+
+        sizes = []
+        out_fp = io.BytesIO()
+        p.save_as_bitmap(out_fp, stages=['resize=x128', lambda img: sizes.append(img.size) or img.rotate(90)])
+        self.assertEqual([(128, 128)], sizes)
+        self.assertEqual([128, 128, 4], p.save_as_npy(io.BytesIO(), stages=['resize=50%'])['shape'])
+        for mode in ['L', 'RGB']:  # stages that change the mode still get RGBA, as the sidecar says
+            out_fp = io.BytesIO()
+            info = p.save_as_npy(out_fp, stages=[lambda img: img.convert(mode)])
+            self.assertEqual([256, 256, 4], info['shape'])
+            self.assertEqual(info['offset'] + 256 * 256 * 4, len(out_fp.getvalue()))
+        self.assertEqual((42, 48), parse_size('x48', 84, 96))
+
+        self.assertRaises(ValueError, lambda: p.save_as_npy(io.BytesIO(), layers=True, stages=['trim']))
+        self.assertRaises(ValueError, lambda: load_stage('blur'))
+        self.assertRaises(ValueError, lambda: load_stage('resize'))
+        self.assertRaises(ValueError, lambda: load_stage('sharpen=lots'))
+
+        register_stage('grey', lambda _: lambda img: img.convert('L'))
+        self.assertEqual('L', apply_stages(p.as_PIL, load_stages(['grey'])).mode)
+        stage_factories.pop('grey')
+        dot = Image.new('RGBA', (10, 10))
+        dot.putpixel((2, 3), (1, 1, 1, 255))
+        self.assertEqual((1, 1), load_stage(sibling_module('stages') + ':trim_stage')(dot).size)
+
+        shared = share_image(os.path.join(BMP_DIR, '04_hex_mask.pspimage'), stages=['resize=50%'])
+        try:
+            self.assertEqual((128, 128), shared['composite'].size)
+            self.assertEqual('RGBA', shared['composite'].as_PIL().mode)
+        finally:
+            shared['composite'].unlink()
+
+    def test_trim(self):
+        """ trim saves just the visible part (the same pixels as the full image there), and says where it goes. """
+
+        p = PSPImage(os.path.join(BMP_DIR, '04_hex_mask.pspimage'))
+        self.assertEqual(Rect(150, 25, 234, 121), p.trim_rect())  # same as the sprite, in test_atlas
+
+        full_fp = io.BytesIO()
+        p.save_as_PNG(full_fp)
+        full_fp.seek(0)
+        sidecar = io.BytesIO()
+        out_fp = io.BytesIO()
+        info = p.save_as_PNG(out_fp, trim=True, sidecar=sidecar)
+        out_fp.seek(0)
+        self.assertEqual(Image.open(full_fp).crop((150, 25, 234, 121)).tobytes(), Image.open(out_fp).tobytes())
+        self.assertEqual({'trimmed': True, 'spriteSourceSize': {'x': 150, 'y': 25, 'w': 84, 'h': 96},
+                          'sourceSize': {'w': 256, 'h': 256}}, info)
+        self.assertEqual(info, json.loads(sidecar.getvalue()))
+        self.assertEqual([96, 84, 4], p.save_as_npy(io.BytesIO(), trim=True)['shape'])
+        self.assertEqual([7, 96, 84, 4], p.save_as_raw(io.BytesIO(), layers=True, trim=True)['shape'])
+
+        # No Alpha channel - the layers' rectangles, refined by what they cover
+        p = PSPImage(os.path.join(BMP_DIR, '02_layered.pspimage'))
+        p.set_layer_visible(0, False)
+        self.assertEqual(Rect(25, 0, 256, 256), p.trim_rect())
+        self.assertFalse(PSPImage(os.path.join(BMP_DIR, '01_quadrants.pspimage')).trim_info(Rect(0, 0, 64, 64))['trimmed'])
+
+        mask = Image.new('L', (10, 10))
+        mask.putpixel((2, 3), 255)
+        mask.putpixel((6, 4), 1)
+        self.assertEqual(Rect(7, 8, 12, 10), trim_mask_rect(bytearray(mask.tobytes()), Rect(5, 5, 15, 15), Rect(0, 0, 20, 20)))
+        self.assertEqual(None, trim_mask_rect(bytearray(mask.tobytes()), Rect(5, 5, 15, 15), Rect(0, 0, 6, 6)))